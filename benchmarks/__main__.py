@@ -0,0 +1,163 @@
+"""Run the benchmarks of f2ap's hot paths, offline, on synthetic data, and write their results as JSON.
+
+Run with: python -m benchmarks [--output results.json] [--compare previous.json]
+
+The results of two versions can be compared to catch the regressions: with --compare, the benchmarks
+that got slower than the threshold are listed, and the exit code is 1 if there is any.
+The timings depend on the machine, so compare results made on the same one.
+"""
+
+import sys
+import json
+import logging
+import platform
+import subprocess
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from importlib import metadata
+
+from . import (
+    database_operations,
+    markup_parse,
+    collection_pages,
+    http_signatures,
+    feed_update,
+    startup,
+)
+from .harness import Suite, format_params
+
+BENCHMARKS = {
+    "database": database_operations,
+    "markup": markup_parse,
+    "collections": collection_pages,
+    "signatures": http_signatures,
+    "feed": feed_update,
+    "startup": startup,
+}
+
+
+def get_version() -> str:
+    try:
+        return metadata.version("f2ap")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_key(result: dict) -> str:
+    return f"{result['name']} {format_params(result['params'])}"
+
+
+def compare(results: [dict], previous: [dict], threshold: float) -> bool:
+    """Print how much each benchmark changed since the previous results. Returns True if one got slower."""
+    previous = {get_key(result): result for result in previous}
+    regression = False
+
+    for result in results:
+        key = get_key(result)
+        if key not in previous:
+            continue
+
+        ratio = result["best"] / previous[key]["best"]
+        slower = ratio > threshold
+        regression = regression or slower
+        print(
+            f"{key:<58} x{ratio:>6.2f}{'  SLOWER' if slower else ''}",
+            file=sys.stderr,
+        )
+
+    return regression
+
+
+def main() -> int:
+    args = get_args()
+    # The updates of the feeds log every entry.
+    logging.basicConfig(level=logging.WARNING)
+
+    names = args.only.split(",") if args.only is not None else list(BENCHMARKS)
+    sizes = [int(size) for size in args.sizes.split(",")] if args.sizes else None
+    suite = Suite(repeat=args.repeat, min_time=args.min_time)
+
+    for name in names:
+        BENCHMARKS[name].run(suite, sizes)
+
+    report = {
+        "version": get_version(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now(tz=timezone.utc).isoformat(),
+        "results": suite.results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            previous = json.load(file)["results"]
+        if compare(suite.results, previous, args.threshold):
+            return 1
+
+    return 0
+
+
+def get_args():
+    args = ArgumentParser(prog="python -m benchmarks")
+    args.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="File where the results are written as JSON. Defaults to the standard output.",
+    )
+    args.add_argument(
+        "--only",
+        type=str,
+        default=None,
+        help=f"Comma-separated benchmarks to run, among: {', '.join(BENCHMARKS)}.",
+    )
+    args.add_argument(
+        "--sizes",
+        type=str,
+        default=None,
+        help="Comma-separated sizes of the data sets, e.g. 1000,10000. Each benchmark has its own defaults.",
+    )
+    args.add_argument("--repeat", type=int, default=5)
+    args.add_argument(
+        "--min-time",
+        dest="min_time",
+        type=float,
+        default=0.2,
+        help="Minimum duration of each repetition, in seconds.",
+    )
+    args.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Results of a previous run to compare with.",
+    )
+    args.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Ratio from which a benchmark is considered slower than in the previous run.",
+    )
+
+    return args.parse_args()
+
+
+if __name__ == "__main__":
+    exit(main())
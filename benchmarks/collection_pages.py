@@ -0,0 +1,52 @@
+"""Measure the making of the outbox and followers collections and of their pages, from their models to JSON.
+
+Run with: python -m benchmarks.collection_pages
+"""
+
+from f2ap.json import encode_json
+from f2ap.model import OrderedCollection
+from f2ap.serializers import serialize
+
+from .harness import Suite
+from .outbox_serialize import make_outbox_page
+
+SIZES = [1000, 10000, 100000]
+
+
+def run(suite: Suite, sizes: [int] = None):
+    # The messages are the ones of a full page, so the page of the outbox has the same content whatever its size.
+    messages = make_outbox_page(10).orderedItems
+    outbox = "https://example.com/actors/blog/outbox"
+    followers = "https://example.com/actors/blog/followers"
+
+    for size in sizes if sizes is not None else SIZES:
+        items = messages * (size // len(messages))
+        accounts = [
+            f"https://instance{i % 500}.example/users/user{i}" for i in range(size)
+        ]
+
+        suite.measure(
+            "outbox.collection",
+            lambda: encode_json(serialize(OrderedCollection.make(outbox, items))),
+            items=size,
+        )
+        suite.measure(
+            "outbox.page",
+            lambda: encode_json(serialize(OrderedCollection.make(outbox, items, 1))),
+            items=size,
+        )
+        suite.measure(
+            "followers.page",
+            lambda: encode_json(
+                serialize(OrderedCollection.make(followers, accounts, 1))
+            ),
+            items=size,
+        )
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Measure the operations of the database on the notes, the messages and the followers,
+on databases of 1k, 10k and 100k rows.
+The databases are filled through the Database class, like f2ap does: the largest one takes a few minutes.
+
+Run with: python -m benchmarks.database_operations
+"""
+
+import tempfile
+
+from datetime import datetime, timedelta, timezone
+from itertools import count
+
+from f2ap.data import Database
+from f2ap.model import Tag
+
+from .harness import Suite, make_config
+
+SIZES = [1000, 10000, 100000]
+
+# The followers are spread on this many instances.
+INSTANCES = 500
+
+
+def populate(db: Database, size: int):
+    """Add `size` notes with their message and `size` followers."""
+    actor = db.config.actor
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    tags = [Tag.make(db.config, "python"), Tag.make(db.config, "fediverse")]
+
+    with db.transaction():
+        for i in range(size):
+            note_uuid = db.insert_note(
+                actor,
+                f"[Article n°{i}](https://example.com/blog/{i})\nA summary. #python #fediverse",
+                published - timedelta(hours=i),
+                f"https://example.com/blog/{i}",
+                tags=tags,
+            )
+            db.insert_message(note_uuid)
+            db.insert_follower(
+                actor, f"https://instance{i % INSTANCES}.example/users/user{i}"
+            )
+
+
+def run(suite: Suite, sizes: [int] = None):
+    for size in sizes if sizes is not None else SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            config = make_config(directory)
+            db = Database(config)
+            db.init_database()
+            populate(db, size)
+
+            actor = config.actor
+            message_uuids = [
+                row[0]
+                for row in db.execute(
+                    "SELECT uuid FROM messages ORDER BY uuid LIMIT 100"
+                ).fetchall()
+            ]
+            # Look up different rows, so the measure does not rely on the cache of a single page.
+            indexes = count()
+            new_notes = count(size)
+            new_followers = count(size)
+
+            suite.measure(
+                "db.get_note",
+                lambda: db.get_note(
+                    f"https://example.com/blog/{next(indexes) * 7919 % size}"
+                ),
+                rows=size,
+            )
+            suite.measure(
+                "db.get_message",
+                lambda: db.get_message(
+                    message_uuids[next(indexes) % len(message_uuids)]
+                ),
+                rows=size,
+            )
+            suite.measure(
+                "db.insert_note",
+                lambda: db.insert_message(
+                    db.insert_note(
+                        actor,
+                        "A new note #python",
+                        datetime.now(tz=timezone.utc),
+                        f"https://example.com/blog/{next(new_notes)}",
+                        tags=[Tag.make(config, "python")],
+                    )
+                ),
+                rows=size,
+            )
+            suite.measure("db.get_messages", lambda: db.get_messages(actor), rows=size)
+            suite.measure(
+                "db.get_messages_page",
+                lambda: db.get_messages(actor, offset=0, limit=10),
+                rows=size,
+            )
+            suite.measure(
+                "db.get_tagged_notes",
+                lambda: db.get_tagged_notes("python", 0, 10),
+                rows=size,
+            )
+            suite.measure(
+                "db.count_followers", lambda: db.count_followers(actor), rows=size
+            )
+            suite.measure(
+                "db.get_followers", lambda: db.get_followers(actor), rows=size
+            )
+
+            def follow_and_unfollow():
+                account = f"https://new.example/users/user{next(new_followers)}"
+                db.insert_follower(actor, account)
+                db.delete_follower(actor, account)
+
+            suite.measure(
+                "db.insert_and_delete_follower", follow_and_unfollow, rows=size
+            )
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Measure the update of the feeds from end to end, on synthetic RSS and Atom feeds:
+the first import of all their entries, and the following updates, when they have not changed.
+
+Run with: python -m benchmarks.feed_update
+"""
+
+import os
+import tempfile
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from f2ap.data import Database
+from f2ap.feed import UpdateFeedThread
+from f2ap.leader import LeaderThread
+
+from .harness import Suite, make_config
+
+SIZES = [100, 1000]
+
+
+def write_rss(path: str, size: int):
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel>'
+        )
+        file.write("<title>Blog</title><link>https://example.com/blog/</link>")
+        for i in range(size):
+            file.write(
+                f"<item><title>Article n°{i}</title>"
+                f"<link>https://example.com/blog/{i}</link>"
+                f"<guid>https://example.com/blog/{i}</guid>"
+                f"<pubDate>{format_datetime(published - timedelta(hours=i))}</pubDate>"
+                f"<category>python</category><category>fediverse</category>"
+                f"<description>A summary mentioning @someone@mastodon.example.</description></item>\n"
+            )
+        file.write("</channel></rss>")
+
+
+def write_atom(path: str, size: int):
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">'
+        )
+        file.write(
+            f"<title>Blog</title><id>https://example.com/blog/</id><updated>{published.isoformat()}</updated>"
+        )
+        for i in range(size):
+            date = (published - timedelta(hours=i)).isoformat()
+            file.write(
+                f"<entry><title>Article n°{i}</title>"
+                f'<link href="https://example.com/blog/{i}"/>'
+                f"<id>https://example.com/blog/{i}</id>"
+                f"<published>{date}</published><updated>{date}</updated>"
+                f'<category term="python"/><category term="fediverse"/>'
+                f"<summary>A summary mentioning @someone@mastodon.example.</summary></entry>\n"
+            )
+        file.write("</feed>")
+
+
+def run(suite: Suite, sizes: [int] = None):
+    for feed_format, write in [("rss", write_rss), ("atom", write_atom)]:
+        for size in sizes if sizes is not None else SIZES:
+            with tempfile.TemporaryDirectory() as directory:
+                feed = os.path.join(directory, f"feed.{feed_format}.xml")
+                write(feed, size)
+                config = make_config(directory, [feed])
+                db = Database(config)
+                thread = UpdateFeedThread(config, db, LeaderThread(db))
+                feeds = config.actor.website.feeds
+
+                def reset_database():
+                    if os.path.exists(config.db):
+                        os.remove(config.db)
+                    db.init_database()
+
+                suite.measure(
+                    "feed.update.import",
+                    lambda: thread.update(feeds),
+                    setup=reset_database,
+                    number=1,
+                    format=feed_format,
+                    entries=size,
+                )
+                suite.measure(
+                    "feed.update.unchanged",
+                    lambda: thread.update(feeds),
+                    format=feed_format,
+                    entries=size,
+                )
+                thread.executor.shutdown()
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""The helpers of the benchmark suite run by `python -m benchmarks`."""
+
+import os
+import sys
+import statistics
+
+from time import perf_counter
+from typing import Callable, Optional
+
+from Crypto.PublicKey import RSA
+
+from f2ap.config import Configuration
+
+DOMAIN = "example.com"
+
+# The RSA keys are slow to generate, so they are made once for all the benchmarks.
+_keys = None
+
+
+class Suite:
+    """Measure the duration of the calls of functions and collect the results.
+    Each function is called enough times to take at least min_time seconds, and this is repeated `repeat` times.
+    """
+
+    def __init__(self, repeat: int = 5, min_time: float = 0.2):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.results = []
+
+    def measure(
+        self,
+        name: str,
+        f: Callable,
+        setup: Optional[Callable] = None,
+        number: Optional[int] = None,
+        **params,
+    ):
+        """Measure f. If defined, setup is called before each repetition, out of the measure.
+        The number of calls by repetition is calibrated on the first call, unless it is given.
+        """
+        if setup is not None:
+            setup()
+
+        if number is None:
+            start = perf_counter()
+            f()
+            first = perf_counter() - start
+            number = max(1, int(self.min_time / first)) if first > 0 else 1000
+
+        durations = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+
+            start = perf_counter()
+            for _ in range(number):
+                f()
+            durations.append((perf_counter() - start) / number)
+
+        result = {
+            "name": name,
+            "params": params,
+            "number": number,
+            "repeat": self.repeat,
+            "best": min(durations),
+            "median": statistics.median(durations),
+            "unit": "s",
+        }
+        self.results.append(result)
+
+        print(
+            f"{name:<32} {format_params(params):<24} {result['best'] * 1000:>12.4f} ms",
+            file=sys.stderr,
+        )
+
+
+def format_params(params: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in sorted(params.items()))
+
+
+def write_keys(directory: str) -> (str, str):
+    global _keys
+    if _keys is None:
+        key = RSA.generate(2048)
+        _keys = (key.public_key().export_key(), key.export_key())
+
+    public_key = os.path.join(directory, "public.pem")
+    private_key = os.path.join(directory, "private.pem")
+    for path, content in [(public_key, _keys[0]), (private_key, _keys[1])]:
+        with open(path, "wb") as file:
+            file.write(content)
+
+    return public_key, private_key
+
+
+def make_config(directory: str, feeds: [str] = None) -> Configuration:
+    """Make the configuration of an actor whose database and keys are in the directory.
+    By default, its feed is a file of the directory, which is never read.
+    """
+    public_key, private_key = write_keys(directory)
+    if feeds is None:
+        feeds = [os.path.join(directory, "feed.xml")]
+
+    return Configuration(
+        url=DOMAIN,
+        db=os.path.join(directory, "db.sqlite"),
+        website={
+            "url": f"https://{DOMAIN}/blog/",
+            "feeds": feeds,
+        },
+        actor={
+            "username": "blog",
+            "display_name": "Blog",
+            "summary": "A blog with @someone@mastodon.example as author.",
+            "public_key": public_key,
+            "private_key": private_key,
+            "attachments": {"Website": f"https://{DOMAIN}"},
+        },
+        message={"format": "[{title}]({url})\n{summary}\n{tags}"},
+    )
@@ -0,0 +1,41 @@
+"""Measure the signature of the deliveries and the validation of the signatures of the inbox requests.
+
+Run with: python -m benchmarks.http_signatures
+"""
+
+import tempfile
+
+from f2ap.signature import sign_headers, validate_headers
+
+from .harness import Suite, make_config
+
+HEADERS = {
+    "Host": "mastodon.example",
+    "Date": "Mon, 01 Jan 2024 10:00:00 GMT",
+    "Digest": "SHA-256=47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=",
+    "Content-Type": "application/activity+json",
+}
+
+
+def run(suite: Suite, sizes: [int] = None):
+    with tempfile.TemporaryDirectory() as directory:
+        actor = make_config(directory).actor
+
+    signature = sign_headers(actor, "/inbox", HEADERS)
+    # The inbox reads the headers of the request, whose names are lowercase.
+    headers = {key.lower(): value for key, value in HEADERS.items()}
+    headers["signature"] = signature
+
+    suite.measure("sign_headers", lambda: sign_headers(actor, "/inbox", HEADERS))
+    suite.measure(
+        "validate_headers",
+        lambda: validate_headers(actor.public_key, headers, "/inbox"),
+    )
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare the serialization of a 100-item outbox page with the standard library and with orjson.
+
+Run with: python -m benchmarks.json_render
+"""
+
+import json
+import timeit
+
+from datetime import datetime, timedelta, timezone
+
+from f2ap import json as f2ap_json
+from f2ap.json import ActivityJsonEncoder
+
+ITEMS = 100
+RUNS = 200
+
+
+def make_outbox_page(items: int = ITEMS) -> dict:
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    ordered_items = []
+
+    for i in range(items):
+        url = f"https://example.com/blog/{i}"
+        ordered_items.append(
+            {
+                "id": f"https://example.com/messages/{i:08x}-0000-0000-0000-000000000000",
+                "type": "Create",
+                "actor": "https://example.com/actors/blog",
+                "published": published - timedelta(days=i, microseconds=i),
+                "to": ["https://www.w3.org/ns/activitystreams#Public"],
+                "cc": [],
+                "object": {
+                    "id": url,
+                    "type": "Note",
+                    "inReplyTo": None,
+                    "published": published - timedelta(days=i, microseconds=i),
+                    "url": url,
+                    "attributedTo": "https://example.com/actors/blog",
+                    "to": ["https://www.w3.org/ns/activitystreams#Public"],
+                    "cc": ["https://example.com/actors/blog/followers"],
+                    "content": f'<p><a href="{url}">Article n°{i} — «&nbsp;été&nbsp;» 👀</a><br />\n'
+                    f"Some summary with &quot;quotes&quot;, \\ backslashes and a tab\t.</p>",
+                    "attachment": [],
+                    "tag": ["python", "fediverse"],
+                },
+            }
+        )
+
+    return {
+        "type": "OrderedCollectionPage",
+        "totalItems": items,
+        "first": "https://example.com/actors/blog/outbox?page=1",
+        "last": "https://example.com/actors/blog/outbox?page=10",
+        "prev": None,
+        "next": "https://example.com/actors/blog/outbox?page=2",
+        "orderedItems": ordered_items,
+    }
+
+
+def encode_stdlib(content: dict) -> bytes:
+    return json.dumps(
+        content,
+        cls=ActivityJsonEncoder,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def main():
+    page = make_outbox_page()
+    stdlib_time = min(timeit.repeat(lambda: encode_stdlib(page), number=RUNS, repeat=5))
+    print(f"stdlib json: {stdlib_time / RUNS * 1000:.3f} ms per page")
+
+    if f2ap_json.orjson is None:
+        print("orjson is not installed, skipping the fast path.")
+        return
+
+    if f2ap_json.encode_json(page) != encode_stdlib(page):
+        raise AssertionError("orjson output differs from the standard library output")
+
+    orjson_time = min(
+        timeit.repeat(lambda: f2ap_json.encode_json(page), number=RUNS, repeat=5)
+    )
+    print(f"orjson:      {orjson_time / RUNS * 1000:.3f} ms per page")
+    print(f"speedup:     x{stdlib_time / orjson_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
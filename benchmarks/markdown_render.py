@@ -0,0 +1,49 @@
+"""Compare the number of notes rendered per second with a new Markdown instance for each note
+and with the reused instance of f2ap.markdown.
+
+Run with: python -m benchmarks.markdown_render
+"""
+
+import timeit
+
+from markdown import markdown
+
+from f2ap.markdown import parse_markdown, EXT_NL2BR, EXT_LINKIFY
+from f2ap.markdown_extension import FediverseExtension
+
+NOTES = 500
+
+NOTE = (
+    "[Article n°{i}](https://example.com/blog/{i})\n"
+    "A summary of the article, which mentions @someone@mastodon.example and links to https://example.org.\n"
+    "[#python](https://example.com/tags/python) [#fediverse](https://example.com/tags/fediverse)"
+)
+
+
+def render_with_new_instance(text: str) -> str:
+    # How the notes were rendered before: the instance and its extensions are built for each note.
+    return markdown(
+        text.replace("#", "&num;").replace("&&num;", "&#"),
+        extensions=[EXT_NL2BR, EXT_LINKIFY, FediverseExtension()],
+    )
+
+
+def main():
+    notes = [NOTE.format(i=i) for i in range(NOTES)]
+
+    for note in notes[:10]:
+        if render_with_new_instance(note) != parse_markdown(note):
+            raise AssertionError("The renderings differ")
+
+    for name, render in [
+        ("new instance per note", render_with_new_instance),
+        ("reused instance", parse_markdown),
+    ]:
+        duration = min(
+            timeit.repeat(lambda: [render(note) for note in notes], number=1, repeat=5)
+        )
+        print(f"{name:<22} {NOTES / duration:>8.0f} notes/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Measure the rendering of the notes from Markdown to HTML and the parsing of their hashtags and mentions.
+
+Run with: python -m benchmarks.markup_parse
+"""
+
+from f2ap.markdown import parse_markdown, link_tags, find_hashtags
+
+from .harness import Suite
+
+NOTE = (
+    "[Article n°42](https://example.com/blog/42)\n"
+    "A summary of the article, which mentions @someone@mastodon.example and links to https://example.org.\n"
+    "#python #fediverse #activityPub"
+)
+
+# A long note with many tags, to show how the parsing scales with the length of the text.
+LONG_NOTE = "\n".join(
+    f"Paragraph {i} about #tag{i}, written with @author{i}@instance{i}.example. See https://example.com/{i}."
+    for i in range(50)
+)
+
+
+def run(suite: Suite, sizes: [int] = None):
+    for name, note in [("short", NOTE), ("long", LONG_NOTE)]:
+        suite.measure("parse_markdown", lambda: parse_markdown(note), note=name)
+        suite.measure(
+            "link_tags",
+            lambda: link_tags(note, "https://example.com/tags"),
+            note=name,
+        )
+        suite.measure("find_hashtags", lambda: list(find_hashtags(note)), note=name)
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
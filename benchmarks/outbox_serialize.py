@@ -0,0 +1,67 @@
+"""Compare the serialization of a 100-item outbox page made of models,
+with FastAPI's encoder as the routes did before, and with the compiled serializers of f2ap.
+
+Run with: python -m benchmarks.outbox_serialize
+"""
+
+import timeit
+
+from datetime import datetime, timedelta, timezone
+from fastapi.encoders import jsonable_encoder
+
+from f2ap.json import encode_json
+from f2ap.model import Message, Note, OrderedCollection, Tag
+from f2ap.serializers import serialize
+
+ITEMS = 100
+RUNS = 100
+
+
+def make_outbox_page(items: int = ITEMS) -> OrderedCollection:
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    messages = []
+
+    for i in range(items):
+        url = f"https://example.com/blog/{i}"
+        messages.append(
+            Message(
+                id=f"https://example.com/messages/{i:08x}-0000-0000-0000-000000000000",
+                actor="https://example.com/actors/blog",
+                published=published - timedelta(days=i),
+                object=Note(
+                    id=url,
+                    published=published - timedelta(days=i),
+                    url=url,
+                    attributedTo="https://example.com/actors/blog",
+                    cc=["https://example.com/actors/blog/followers"],
+                    content=f'<p><a href="{url}">Article n°{i}</a><br />\nSome summary.</p>',
+                    tag=[
+                        Tag(name="#python", href="https://example.com/tags/python"),
+                        Tag(
+                            type="Mention",
+                            name="@someone@mastodon.example",
+                            href="https://mastodon.example/@someone",
+                        ),
+                    ],
+                ),
+            )
+        )
+
+    return OrderedCollection.make(
+        "https://example.com/actors/blog/outbox", messages, 1, items
+    )
+
+
+def main():
+    page = make_outbox_page()
+
+    for name, render in [
+        ("FastAPI encoder", lambda: encode_json(jsonable_encoder(page))),
+        ("compiled serializer", lambda: encode_json(serialize(page))),
+    ]:
+        duration = min(timeit.repeat(render, number=RUNS, repeat=5))
+        print(f"{name:<20} {duration / RUNS * 1000:>7.3f} ms per page")
+
+
+if __name__ == "__main__":
+    main()
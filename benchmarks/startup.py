@@ -0,0 +1,42 @@
+"""Measure the cold start of f2ap: the import of its modules in a new interpreter, and the loading of the configuration.
+The imports are measured for the whole program and for the web server workers, which only serve the requests.
+
+Run with: python -m benchmarks.startup
+"""
+
+import sys
+import tempfile
+import subprocess
+
+from .harness import Suite, make_config
+
+MODULES = {
+    "main": "f2ap.__main__",
+    "webserver": "f2ap.webserver",
+}
+
+
+def import_module(module: str):
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+
+
+def run(suite: Suite, sizes: [int] = None):
+    # Python itself, to subtract from the imports.
+    suite.measure("startup.python", lambda: import_module("sys"), number=5)
+
+    for name, module in MODULES.items():
+        suite.measure(
+            "startup.import", lambda: import_module(module), number=5, module=name
+        )
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Writes the keys, then loads the configuration, which parses them.
+        suite.measure("startup.config", lambda: make_config(directory))
+
+
+def main():
+    run(Suite())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Compare the memory and the time needed to read a large synthetic RSS feed,
+with feedparser on the whole document and with the streaming parser,
+then measure its first import in an empty database, from the download to the saved notes.
+
+Run with: python -m benchmarks.streaming_parse [--size 50]
+"""
+
+import os
+import tempfile
+import feedparser
+import tracemalloc
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from itertools import islice
+from time import perf_counter
+
+from f2ap.data import Database
+from f2ap.feed import UpdateFeedThread, iter_file
+from f2ap.leader import LeaderThread
+from f2ap.streaming import StreamingFeed
+
+from .harness import make_config
+
+# The number of new entries at the top of the feed, when the rest is already known.
+NEW_ENTRIES = 20
+
+
+def write_feed(path: str, size: int):
+    published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    summary = (
+        "&lt;p&gt;"
+        + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+        + "&lt;/p&gt;"
+    )
+
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel>'
+        )
+        file.write("<title>Archive</title><link>https://example.com/</link>")
+
+        i = 0
+        while file.tell() < size:
+            file.write(
+                f"<item><title>Article n°{i}</title>"
+                f"<link>https://example.com/blog/{i}</link>"
+                f"<guid>https://example.com/blog/{i}</guid>"
+                f"<pubDate>{format_datetime(published - timedelta(hours=i))}</pubDate>"
+                f"<category>python</category><description>{summary}</description></item>\n"
+            )
+            i += 1
+
+        file.write("</channel></rss>")
+
+
+def measure(name: str, read) -> None:
+    start = perf_counter()
+    entries = read()
+    duration = perf_counter() - start
+
+    # The memory is measured in a second run, as tracing it slows everything down.
+    tracemalloc.start()
+    read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:<34} {entries:>7} entries  {duration:>7.2f} s  peak {peak / 1024 / 1024:>8.1f} MiB"
+    )
+
+
+def main():
+    args = ArgumentParser()
+    args.add_argument("--size", type=int, default=50, help="Size of the feed, in MB")
+    args = args.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "feed.xml")
+        write_feed(path, args.size * 1000 * 1000)
+        print(f"Feed of {os.path.getsize(path) / 1000 / 1000:.1f} MB")
+
+        def read_whole():
+            with open(path, "rb") as file:
+                return len(feedparser.parse(file.read(), sanitize_html=True).entries)
+
+        def stream_all():
+            return sum(1 for _ in StreamingFeed(iter_file(path), path).entries)
+
+        def stream_new():
+            # The known entries are met right after the new ones, so the rest of the feed is not read.
+            feed = StreamingFeed(iter_file(path), path)
+            count = sum(1 for _ in islice(feed.entries, NEW_ENTRIES))
+            feed.close()
+            return count
+
+        def import_streamed():
+            # All the entries are new, so they are all rendered and saved.
+            with tempfile.TemporaryDirectory() as db_directory:
+                config = make_config(db_directory, [{"url": path, "streaming": True}])
+                db = Database(config)
+                db.init_database()
+                thread = UpdateFeedThread(config, db, LeaderThread(db))
+                thread.update(config.actor.website.feeds)
+                thread.executor.shutdown()
+                return db.count_messages(config.actor)
+
+        measure(f"streaming, {NEW_ENTRIES} new entries", stream_new)
+        measure("streaming, whole feed", stream_all)
+        measure("feedparser, whole feed", read_whole)
+        measure("streaming, first import", import_streamed)
+
+
+if __name__ == "__main__":
+    main()
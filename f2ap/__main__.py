@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
+import os
+import signal
 import logging
+import threading
 
 from argparse import ArgumentParser
 
-from .feed import UpdateFeedThread
+from . import activitypub
 
 from .config import get_config
 from .data import Database
-from .webserver import start_server
+from .delivery import DeliveryThread
+from .leader import LeaderThread
+from .webserver import start_server, create_app, FOLLOW_PENDING_FLAG
+
+ENV_CONFIG_FILE = "F2AP_CONFIG"
+ENV_LOG_LEVEL = "F2AP_LOG_LEVEL"
 
 
 def main() -> int:
@@ -27,18 +35,116 @@ def main() -> int:
     elif db.upgrade_database():
         logging.info("Database has been upgraded")
 
-    update_feed_thread = UpdateFeedThread(config, db)
-    update_feed_thread.start()
+    if args.check_counters:
+        # The counters are kept up to date: recounting the collections is only needed to repair them.
+        for key, saved, actual in db.check_counters():
+            logging.warning(
+                f"Counter {key} was {saved} instead of {actual}, it has been fixed."
+            )
+
+    if args.command == "export":
+        from .export import export
+
+        directory = args.output
+        if directory is None and config.export is not None:
+            directory = config.export.directory
+        if directory is None:
+            logging.critical(
+                "No output directory: use --output or define export.directory in the configuration."
+            )
+            return 1
+
+        export(config, db, directory)
+        return 0
+
+    # Without a command, all the roles run in this process.
+    serving = args.command in [None, "serve"]
+    polling = args.command in [None, "poll"]
+    delivering = args.command in [None, "deliver"]
+
+    leader = None
+    update_feed_thread = None
+    delivery_thread = None
+
+    if polling:
+        leader = LeaderThread(db)
+        leader.campaign()
+        leader.start()
+
+        if args.skip_following:
+            logging.debug("Following is disabled.")
+        elif leader.is_leader:
+            # The users will be followed on a request to the web server, when it is ready to answer their instance.
+            db.set_metadata(FOLLOW_PENDING_FLAG, 1)
+
+        # The web server workers import this module too, but they don't read the feeds: they don't need feedparser.
+        from .feed import UpdateFeedThread
+
+        update_feed_thread = UpdateFeedThread(config, db, leader)
+        update_feed_thread.start()
+
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: update_feed_thread.poll_now())
+
+    if delivering:
+        delivery_thread = DeliveryThread(config, db)
+        delivery_thread.start()
+
+    if serving:
+        for actor in config.actors.values():
+            logging.info(
+                f"Profile discoverable at @{actor.preferred_username}@{config.url}"
+            )
+
+        if args.workers > 1:
+            os.environ[ENV_CONFIG_FILE] = args.config_file
+            os.environ[ENV_LOG_LEVEL] = args.log_level
+            app = "f2ap.__main__:create_worker_app"
+        else:
+            app = create_app(
+                config,
+                on_push=(
+                    update_feed_thread.notify_push
+                    if update_feed_thread is not None
+                    else None
+                ),
+            )
+
+        start_server(app, args.webserver_port, args.log_level, args.workers)
+    else:
+        wait_for_termination()
+
+    if update_feed_thread is not None:
+        update_feed_thread.stop()
+
+    if delivery_thread is not None:
+        delivery_thread.stop()
+
+    if leader is not None:
+        if leader.is_leader and not args.skip_following:
+            for actor in config.actors.values():
+                activitypub.unfollow_users(actor, db.get_followings(actor))
+                db.delete_followings(actor)
+
+        leader.stop()
 
-    logging.info(
-        f"Profile discoverable at @{config.actor.preferred_username}@{config.url}"
-    )
+    return 0
 
-    start_server(config, args.webserver_port, args.log_level, args.skip_following)
 
-    update_feed_thread.stop = True
+def wait_for_termination():
+    """Wait until the process is asked to stop, like the web server does."""
+    stopped = threading.Event()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *_: stopped.set())
+
+    stopped.wait()
+    logging.info("Stopping.")
 
-    return 0
+
+def create_worker_app():
+    """Build the application in each worker process, when the server runs with several workers."""
+    configure_logging(os.environ[ENV_LOG_LEVEL])
+    return create_app(get_config(os.environ[ENV_CONFIG_FILE]))
 
 
 def configure_logging(log_level: str):
@@ -64,12 +170,51 @@ def get_args():
         default="INFO",
     )
     args.add_argument("--port", dest="webserver_port", type=int, default=8000)
+    args.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of web server processes. They share the state through the database.",
+    )
     args.add_argument(
         "--skip-following",
         dest="skip_following",
         action="store_true",
         help="Prevent following the accounts defined in the configuration file. Useful for development tests.",
     )
+    args.add_argument(
+        "--check-counters",
+        dest="check_counters",
+        action="store_true",
+        help="Count the followers, followings and messages again at start, and fix their saved numbers if they are wrong.",
+    )
+
+    # Without a command, the web server, the feed poller and the delivery worker run in the same process.
+    commands = args.add_subparsers(dest="command")
+    commands.add_parser(
+        "serve",
+        help="Only run the web server. Several ones can share the same database.",
+    )
+    commands.add_parser(
+        "poll",
+        help="Only check the feeds and queue the new messages. If several ones share the same database, only one is active.",
+    )
+    commands.add_parser(
+        "deliver",
+        help="Only deliver the queued messages. Several ones can share the same database.",
+    )
+    export_command = commands.add_parser(
+        "export",
+        help="Export all the documents as static files, then exit.",
+    )
+    export_command.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default=None,
+        help="Directory where the files are written. Defaults to export.directory from the configuration.",
+    )
 
     return args.parse_args()
 
@@ -2,12 +2,13 @@ import re
 import requests
 import logging
 
-from typing import Union
+from typing import Optional, Union
 from uuid import uuid4
 
 from . import postie, model
-from .config import Configuration
-from .markdown import parse_markdown, find_hashtags
+from .config import Actor
+from .data import Database
+from .serializers import serialize
 
 W3_PUBLIC_STREAM = "https://www.w3.org/ns/activitystreams#Public"
 
@@ -16,10 +17,11 @@ MIME_JSON_ACTIVITY = "application/activity+json"
 
 def search_actor(domain: str, username: str) -> Union[None, dict]:
     try:
-        actor = requests.get(
+        actor = postie.pool.session.get(
             f"https://{domain}/.well-known/webfinger",
             params={"resource": f"acct:{username}@{domain}"},
             headers={"Accept": MIME_JSON_ACTIVITY},
+            timeout=postie.DELIVERY_TIMEOUT,
         )
 
         actor.raise_for_status()
@@ -39,7 +41,11 @@ def search_actor(domain: str, username: str) -> Union[None, dict]:
 
 def get_actor(href: str):
     try:
-        actor = requests.get(href, headers={"Accept": "application/activity+json"})
+        actor = postie.pool.session.get(
+            href,
+            headers={"Accept": "application/activity+json"},
+            timeout=postie.DELIVERY_TIMEOUT,
+        )
         actor.raise_for_status()
         return actor.json()
     except requests.HTTPError:
@@ -66,76 +72,107 @@ def parse_user(
     return matches
 
 
-def follow_users(config: Configuration, users: [str]):
+def follow_users(actor: Actor, users: [str]):
     for user in users:
         username, domain = parse_user(user)
-        actor = search_actor(domain, username)
+        remote = search_actor(domain, username)
 
-        if actor is None:
+        if remote is None:
             logging.error(f"Cannot follow {user}: not found.")
             continue
 
-        inbox = actor.get("inbox")
+        inbox = remote.get("inbox")
         if inbox is None:
             logging.error(f"Cannot follow {user}: no inbox.")
             continue
 
         try:
             postie.deliver(
-                config,
+                actor,
                 inbox,
                 {
-                    "id": f"https://{config.url}/{uuid4()}",
+                    "id": f"https://{actor.config.url}/{uuid4()}",
                     "type": "Follow",
-                    "actor": config.actor.id,
-                    "object": f"{actor.get('id')}",
+                    "actor": actor.id,
+                    "object": f"{remote.get('id')}",
                 },
             )
 
-            logging.debug(f"Sent follow request to {actor.get('id')}")
+            logging.debug(f"Sent follow request to {remote.get('id')}")
         except postie.DeliveryException as e:
             logging.error(f"Cannot follow {user}: {e.message}")
 
 
-def unfollow_users(config: Configuration, users: [tuple[str, str]]):
+def unfollow_users(actor: Actor, users: [tuple[str, str]]):
     for follow_id, user in users:
-        actor = get_actor(user)
+        remote = get_actor(user)
 
-        if actor is None:
+        if remote is None:
             logging.error(f"Cannot unfollow {user}: not found.")
             continue
 
-        inbox = actor.get("inbox")
+        inbox = remote.get("inbox")
         if inbox is None:
             logging.error(f"Cannot unfollow {user}: no inbox.")
             continue
 
         try:
             postie.deliver(
-                config,
+                actor,
                 inbox,
                 {
-                    "id": f"https://{config.url}/{uuid4()}",
+                    "id": f"https://{actor.config.url}/{uuid4()}",
                     "type": "Undo",
-                    "actor": config.actor.id,
+                    "actor": actor.id,
                     "object": {
                         "id": follow_id,
                         "type": "Follow",
-                        "actor": config.actor.id,
-                        "object": actor.get("id"),
+                        "actor": actor.id,
+                        "object": remote.get("id"),
                     },
                 },
             )
 
-            logging.debug(f"Unfollowed {actor.get('id')}")
+            logging.debug(f"Unfollowed {remote.get('id')}")
         except postie.DeliveryException as e:
             logging.error(f"Cannot unfollow {user}: {e.message}")
 
 
-def propagate_messages(
-    config: Configuration, inboxes: [str], messages: [model.Message]
+def get_inbox(follower: str) -> Optional[str]:
+    """Returns the inbox to deliver the activities to the follower: the shared inbox of its server if it has one."""
+    try:
+        remote = get_actor(follower)
+    except requests.RequestException:
+        remote = None
+
+    if remote is None:
+        logging.warning(
+            f"Could not get inbox for user {follower}, they won't receive the message."
+        )
+        return None
+
+    return (remote.get("endpoints") or {}).get("sharedInbox") or remote.get("inbox")
+
+
+def get_inboxes(followers: [str]) -> {str}:
+    # The followers on the same server usually share its inbox: the messages are sent once to it.
+    return {inbox for inbox in postie.pool.executor.map(get_inbox, followers) if inbox}
+
+
+def queue_messages(
+    db: Database, actor: Actor, followers: [str], messages: [model.Message]
 ):
-    for message in messages:
-        message.object.content = parse_markdown(message.object.content)
-        for inbox in inboxes:
-            postie.deliver(config, inbox, message.dict())
+    """Queue the messages for the followers of the actor in the database, for the delivery workers."""
+    if len(messages) == 0:
+        return
+
+    # The content of the notes is already rendered to HTML.
+    documents = [serialize(message) for message in messages]
+    db.insert_deliveries(
+        actor,
+        [
+            (inbox, document)
+            for inbox in get_inboxes(followers)
+            for document in documents
+        ],
+    )
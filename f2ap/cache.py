@@ -0,0 +1,87 @@
+import hashlib
+
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Mapping
+
+from fastapi.responses import Response
+
+from . import metrics
+
+# Headers that must be repeated in a 304 response, as per RFC 9110 section 15.4.5.
+NOT_MODIFIED_HEADERS = ["cache-control", "etag", "expires", "last-modified", "vary"]
+
+
+def cache_control(max_age: int) -> str:
+    return f"public, max-age={max_age}"
+
+
+def make_etag(content: bytes) -> str:
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+def make_etag_variant(etag: str, variant: str) -> str:
+    """Make the ETag of another representation of the same content, e.g. a compressed one."""
+    return etag.removesuffix('"') + f'-{variant}"'
+
+
+def http_date(dt: datetime) -> str:
+    return format_datetime(dt, usegmt=True)
+
+
+def is_not_modified(
+    request_headers: Mapping[str, str], response_headers: Mapping[str, str]
+) -> bool:
+    """Returns True if the client already has the representation described by the response headers.
+    The conditional requests are counted as hits or misses of the HTTP cache in the metrics.
+    """
+    if (
+        "if-none-match" not in request_headers
+        and "if-modified-since" not in request_headers
+    ):
+        return False
+
+    not_modified = match_validators(request_headers, response_headers)
+    metrics.cache_requests.inc("http", "hit" if not_modified else "miss")
+
+    return not_modified
+
+
+def match_validators(
+    request_headers: Mapping[str, str], response_headers: Mapping[str, str]
+) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    etag = response_headers.get("etag")
+
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since when both are present.
+        if etag is None:
+            return False
+
+        return if_none_match.strip() == "*" or etag.removeprefix("W/") in [
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        ]
+
+    if_modified_since = request_headers.get("if-modified-since")
+    last_modified = response_headers.get("last-modified")
+
+    if if_modified_since is None or last_modified is None:
+        return False
+
+    try:
+        return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(
+            last_modified
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified(response_headers: Mapping[str, str]) -> Response:
+    return Response(
+        status_code=304,
+        headers={
+            key: value
+            for key, value in response_headers.items()
+            if key.lower() in NOT_MODIFIED_HEADERS
+        },
+    )
@@ -0,0 +1,100 @@
+import gzip
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from . import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BROTLI = "br"
+GZIP = "gzip"
+
+# Below this size, the compressed document would not be significantly smaller.
+MINIMUM_SIZE = 512
+
+# How many compressed documents are kept in memory.
+CACHE_SIZE = 1024
+
+
+def get_supported_encodings() -> [str]:
+    """Returns the supported encodings, from the most to the least preferred."""
+    return [BROTLI, GZIP] if brotli is not None else [GZIP]
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Choose the best encoding accepted by the client, as defined in the Accept-Encoding header."""
+    if accept_encoding is None:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.strip().lower().split(";")
+        quality = 1.0
+
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        accepted[coding.strip()] = quality
+
+    for encoding in get_supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def compress(content: bytes, encoding: str, best: bool = False) -> bytes:
+    """Compress the content with the given encoding.
+    With best=True, the content is compressed as much as possible, which is slower but worth it
+    when the result is reused.
+    """
+    if encoding == BROTLI:
+        return brotli.compress(content, quality=11 if best else 5)
+
+    if encoding == GZIP:
+        return gzip.compress(content, compresslevel=9 if best else 6, mtime=0)
+
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+class CompressedCache:
+    """A thread-safe LRU cache for the compressed versions of the documents, indexed by ETag.
+    As the ETag is computed from the content, a modified document gets a new entry.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, etag: str, content: bytes, encoding: str) -> bytes:
+        key = (etag, encoding)
+
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                metrics.cache_requests.inc("compression", "hit")
+                return self.items[key]
+
+        metrics.cache_requests.inc("compression", "miss")
+        compressed = compress(content, encoding, best=True)
+
+        with self.lock:
+            self.items[key] = compressed
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+        return compressed
+
+
+compressed_cache = CompressedCache()
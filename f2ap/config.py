@@ -1,23 +1,169 @@
 import toml
 import humps
+import mimetypes
 
-from typing import Callable, Union
+from functools import cached_property
+from typing import Callable, Optional, Union
+
+from Crypto.PublicKey import RSA
+
+from .markdown import parse_markdown
+
+
+class Feed:
+    def __init__(
+        self,
+        url: str,
+        update_freq: int,
+        max_update_freq: int = None,
+        streaming: bool = False,
+    ):
+        self.url = url
+        self.update_freq = update_freq
+        self.streaming = streaming
+        # The actor which publishes the entries of the feed, set when the actor is created.
+        self.actor = None
+        self.max_update_freq = (
+            max_update_freq if max_update_freq is not None else update_freq * 4
+        )
+
+        if self.max_update_freq < self.update_freq:
+            raise ValueError(
+                f"The max_update_freq of feed {url} must not be lower than its update_freq."
+            )
 
 
 class Website:
-    def __init__(self, url: str, feed: str, update_freq: int = 30):
+    def __init__(
+        self,
+        url: str,
+        feed: str = None,
+        feeds: [Union[str, dict]] = None,
+        update_freq: int = 30,
+        max_update_freq: int = None,
+        fetch_timeout: int = 30,
+        max_feed_size: int = 20,
+        websub: bool = True,
+        streaming: bool = False,
+        max_streamed_feed_size: int = 1024,
+        max_streamed_entries: int = 100000,
+        backfill_announce: int = 0,
+        backfill_announce_interval: int = 60,
+    ):
         self.url = url
-        self.feed = feed
         self.update_freq = update_freq
+        self.backfill_announce = backfill_announce
+        self.backfill_announce_interval = backfill_announce_interval
+        self.fetch_timeout = fetch_timeout
+        self.max_feed_size = max_feed_size
+        self.max_streamed_feed_size = max_streamed_feed_size
+        self.max_streamed_entries = max_streamed_entries
+        self.websub = websub
+        self.feeds = []
+
+        if feed is not None:
+            self.feeds.append(Feed(feed, update_freq, max_update_freq, streaming))
+
+        for f in feeds if feeds is not None else []:
+            if isinstance(f, str):
+                f = {"url": f}
+            if "update_freq" not in f:
+                f = {
+                    "update_freq": update_freq,
+                    "max_update_freq": max_update_freq,
+                    **f,
+                }
+            self.feeds.append(Feed(**{"streaming": streaming, **f}))
+
+        if len(self.feeds) == 0:
+            raise ValueError("At least one feed must be defined in website.")
+
+
+class Cache:
+    def __init__(
+        self,
+        images_max_age: int = 86400,
+        collections_max_age: int = 60,
+        objects_max_age: int = 3600,
+    ):
+        self.images_max_age = images_max_age
+        self.collections_max_age = collections_max_age
+        self.objects_max_age = objects_max_age
+
+
+class Export:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+
+class Metrics:
+    def __init__(self, token: str = None):
+        self.token = token
+
+
+class Profiling:
+    def __init__(
+        self, server_timing: bool = True, routes: [str] = None, directory: str = None
+    ):
+        self.server_timing = server_timing
+        self.routes = routes if routes is not None else []
+        self.directory = directory
+
+        if len(self.routes) > 0 and directory is None:
+            raise ValueError("profiling.directory is needed to profile routes.")
 
 
 class Configuration:
-    def __init__(self, url: str, db: str, website: dict, actor: dict, message: dict):
+    def __init__(
+        self,
+        url: str,
+        db: str,
+        website: dict = None,
+        actor: dict = None,
+        message: dict = None,
+        actors: [dict] = None,
+        cache: dict = None,
+        export: dict = None,
+        metrics: dict = None,
+        profiling: dict = None,
+    ):
         self.db = db
         self.url = url
-        self.website = Website(**website)
-        self.actor = Actor(self, **actor)
-        self.message = Message(**message)
+        self.cache = Cache(**(cache if cache is not None else {}))
+        self.export = Export(**export) if export is not None else None
+        self.metrics = Metrics(**metrics) if metrics is not None else None
+        self.profiling = Profiling(**profiling) if profiling is not None else None
+        # The actors by username, and the feeds of all the actors by URL.
+        self.actors = {}
+        self.feeds = {}
+
+        if actor is not None:
+            self.add_actor(Actor(self, website=website, message=message, **actor))
+
+        for a in actors if actors is not None else []:
+            # The message format can be shared by all the actors.
+            self.add_actor(Actor(self, **{"message": message, **a}))
+
+        if len(self.actors) == 0:
+            raise ValueError("At least one actor must be defined.")
+
+    def add_actor(self, actor: "Actor"):
+        if actor.preferred_username in self.actors:
+            raise ValueError(f"Actor {actor.preferred_username} is defined twice.")
+
+        for feed in actor.website.feeds:
+            if feed.url in self.feeds:
+                raise ValueError(
+                    f"Feed {feed.url} is used by several actors, it can only be used by one."
+                )
+            self.feeds[feed.url] = feed
+
+        self.actors[actor.preferred_username] = actor
+
+    @property
+    def actor(self) -> "Actor":
+        """The first actor. The data saved before several actors could be hosted belongs to it."""
+        return next(iter(self.actors.values()))
 
 
 class Actor:
@@ -27,6 +173,8 @@ class Actor:
         username: str,
         public_key: str,
         private_key: str,
+        website: dict = None,
+        message: dict = None,
         display_name: str = None,
         summary: str = None,
         avatar: str | None = None,
@@ -34,20 +182,57 @@ class Actor:
         followings: [str] = None,
         attachments: {str: str} = None,
     ):
+        if website is None or message is None:
+            raise ValueError(f"Actor {username} must have a website and a message.")
+
         self.config = config
         self.preferred_username = username
+        self.website = Website(**website)
+        self.message = Message(**message)
         self.display_name = display_name
         self.summary = summary
         self.avatar = avatar
+        self.avatar_type = self.get_image_type(avatar)
         self.header = header
+        self.header_type = self.get_image_type(header)
         self.following = followings if followings is not None else []
-        self.attachments = attachments
+        self.attachments = attachments if attachments is not None else {}
+
+        for feed in self.website.feeds:
+            feed.actor = self
 
         with open(public_key, "r") as file:
             self.public_key = file.read()
         with open(private_key, "r") as file:
             self.private_key = file.read()
 
+        # Parsing the private key is much slower than signing with it, so it is done once.
+        try:
+            self.signing_key = RSA.import_key(self.private_key)
+        except ValueError:
+            raise ValueError(f"Invalid private key for actor {username}.")
+
+    @staticmethod
+    def get_image_type(path: Optional[str]) -> Optional[str]:
+        if path is None:
+            return None
+
+        file_type, _ = mimetypes.guess_type(path, strict=True)
+        if file_type not in ["image/jpeg", "image/png"]:
+            raise ValueError(
+                f'Invalid file type for image "{path}": must be a JPEG or PNG file.'
+            )
+
+        return file_type
+
+    @cached_property
+    def summary_html(self) -> str:
+        return parse_markdown(self.summary)
+
+    @cached_property
+    def attachments_html(self) -> {str: str}:
+        return {name: parse_markdown(value) for name, value in self.attachments.items()}
+
     @property
     def id(self) -> str:
         return f"https://{self.config.url}/actors/{self.preferred_username}"
@@ -1,29 +1,188 @@
 import json
 import sqlite3
+import threading
 
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from uuid import uuid4, UUID
 from typing import Union, Optional
 from os.path import exists
+from time import perf_counter
 
-from . import model
-from .config import Configuration
+from . import model, metrics, profiling
+from .config import Configuration, Actor
+from .json import encode_json
+from .serializers import serialize
 
 W3C_PUBLIC_STREAM = "https://www.w3.org/ns/activitystreams#Public"
 
-DATABASE_VERSION = 1
+DATABASE_VERSION = 10
+
+TABLES = {
+    "metadata": {
+        "key": "VARCHAR(50) PRIMARY KEY",
+        "value": "TEXT",
+    },
+    "messages": {
+        "uuid": "VARCHAR(36) PRIMARY KEY",
+        "msg_type": "VARCHAR(20) NOT NULL",
+        "note": "VARCHAR(36) NOT NULL",
+    },
+    "notes": {
+        "uuid": "VARCHAR(36) PRIMARY KEY",
+        # The username of the actor who published the note.
+        "actor": "VARCHAR(50) NOT NULL",
+        "published_time": "INTEGER NOT NULL",
+        "url": "VARCHAR(255) NOT NULL",
+        "reply_to": "VARCHAR(255)",
+        "content": "TEXT NOT NULL",
+        "tags": "TEXT",
+        "updated_time": "INTEGER",
+        # The content rendered to HTML, so it is rendered only once.
+        "html": "TEXT",
+    },
+    "followers": {
+        "uuid": "VARCHAR(36) PRIMARY KEY",
+        "actor": "VARCHAR(50) NOT NULL",
+        "follower_since": "INTEGER NOT NULL",
+        "link": "VARCHAR(255) NOT NULL",
+    },
+    "followings": {
+        "actor": "VARCHAR(50) NOT NULL",
+        "link": "VARCHAR(255) NOT NULL",
+        "follow_id": "VARCHAR(255) NOT NULL",
+        "following_since": "INTEGER NOT NULL",
+        "PRIMARY KEY": "(actor, link)",
+    },
+    "locks": {
+        "name": "VARCHAR(50) PRIMARY KEY",
+        "owner": "VARCHAR(36) NOT NULL",
+        "expiration_time": "INTEGER NOT NULL",
+    },
+    # An entry can be in several feeds, with a different content in each one.
+    "entries": {
+        "id": "VARCHAR(255) NOT NULL",
+        "feed": "VARCHAR(255) NOT NULL",
+        "hash": "CHAR(32)",
+        "note": "VARCHAR(36)",
+        "PRIMARY KEY": "(id, feed)",
+    },
+    "subscriptions": {
+        "uuid": "VARCHAR(36) PRIMARY KEY",
+        "feed": "VARCHAR(255) NOT NULL UNIQUE",
+        "hub": "VARCHAR(255) NOT NULL",
+        "topic": "VARCHAR(255) NOT NULL",
+        "secret": "CHAR(64) NOT NULL",
+        "expiration_time": "INTEGER",
+    },
+    "pushes": {
+        "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "feed": "VARCHAR(255) NOT NULL",
+        "content": "BLOB NOT NULL",
+        "content_type": "VARCHAR(255)",
+    },
+    # The hashtags of the notes, normalized with normalize_tag(), to find the notes of a hashtag without reading them all.
+    "note_tags": {
+        "tag": "VARCHAR(255) NOT NULL",
+        "note": "VARCHAR(36) NOT NULL",
+        "published_time": "INTEGER NOT NULL",
+        "PRIMARY KEY": "(tag, note)",
+    },
+    # The activities to deliver, to each inbox in the order of their id. The delivery workers claim all the activities
+    # of an inbox for a while, so an inbox is only delivered to by one worker at a time.
+    "deliveries": {
+        "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "actor": "VARCHAR(50) NOT NULL",
+        "inbox": "VARCHAR(255) NOT NULL",
+        "document": "TEXT NOT NULL",
+        "attempts": "INTEGER NOT NULL DEFAULT 0",
+        "next_attempt_time": "INTEGER NOT NULL",
+        "claim": "VARCHAR(36)",
+        "claim_expiration_time": "INTEGER",
+    },
+}
+
+INDEXES = {
+    "notes_url": "notes(url)",
+    "note_tags_published": "note_tags(tag, published_time)",
+    "notes_actor": "notes(actor, published_time)",
+    "followers_actor": "followers(actor, link)",
+    "messages_note": "messages(note)",
+    "note_tags_note": "note_tags(note)",
+    "deliveries_inbox": "deliveries(inbox)",
+}
+
+# The queries which count the items of the collections of each actor. Their totals are kept in the metadata table,
+# updated along with the items, so the collections don't have to count them at each request.
+COUNTERS = {
+    "followers": "SELECT actor, COUNT(uuid) FROM followers GROUP BY actor",
+    "following": "SELECT actor, COUNT(link) FROM followings GROUP BY actor",
+    "outbox": "SELECT n.actor, COUNT(m.uuid) FROM messages m JOIN notes n ON m.note = n.uuid GROUP BY n.actor",
+}
+
+NOTE_FIELDS = "n.uuid, n.published_time, n.url, n.reply_to, n.html, n.tags, n.updated_time, n.actor"
+
+
+def get_counter_key(collection: str, username: str) -> str:
+    return f"{collection}_count:{username}"
+
+
+def normalize_tag(tag: str) -> str:
+    """Hashtags are case-insensitive."""
+    return tag.removeprefix("#").lower()
 
 
 class Database:
     def __init__(self, config: Configuration):
         self.file_path = config.db
         self.config = config
+        # The connection of the transaction in progress in each thread, if any.
+        self.local = threading.local()
 
     def execute(self, sql: str, params: {str: str} = None):
-        with sqlite3.connect(self.file_path) as connection:
-            return connection.cursor().execute(
-                sql, params if params is not None else {}
-            )
+        # The duration is measured without a context manager, which would cost more than most queries.
+        start = perf_counter()
+        try:
+            connection = getattr(self.local, "connection", None)
+            if connection is not None:
+                return connection.cursor().execute(
+                    sql, params if params is not None else {}
+                )
+
+            with sqlite3.connect(self.file_path) as connection:
+                return connection.cursor().execute(
+                    sql, params if params is not None else {}
+                )
+        finally:
+            duration = perf_counter() - start
+            metrics.query_duration.observe(duration, sql.split(None, 1)[0].upper())
+            profiling.record("db", duration)
+
+    @contextmanager
+    def transaction(self):
+        """Run all the queries of the block, in the current thread, in one transaction on one connection.
+        The changes are committed at the end of the block, or rolled back if it raises an exception.
+        """
+        if getattr(self.local, "connection", None) is not None:
+            # Already in a transaction: the queries are part of it.
+            yield
+            return
+
+        # The write lock is taken at the start of the transaction, so the rows it reads can't be changed
+        # by another process before it writes, e.g. when a counter is read then updated.
+        connection = sqlite3.connect(self.file_path, isolation_level=None)
+        self.local.connection = connection
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                connection.rollback()
+                raise
+            connection.commit()
+        finally:
+            self.local.connection = None
+            connection.close()
 
     def get_metadata(self, key: str):
         result = self.execute(
@@ -38,18 +197,58 @@ class Database:
         return v
 
     def set_metadata(self, key: str, value):
-        if self.get_metadata(key) is None:
-            self.execute(
-                "INSERT INTO metadata(key, value) VALUES(:key, :value)",
-                {"key": key, "value": value},
-            )
+        self.execute(
+            """
+            INSERT INTO metadata(key, value) VALUES(:key, :value)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+            {"key": key, "value": value},
+        )
+
+    def get_counter(self, collection: str, actor: Actor) -> int:
+        value = self.get_metadata(get_counter_key(collection, actor.preferred_username))
+
+        return int(value) if value is not None else 0
+
+    def add_to_counter(self, collection: str, username: str, amount: int):
+        """Add the amount to the counter. Call it in the transaction which adds or removes the items."""
+        if amount == 0:
             return
 
         self.execute(
-            "UPDATE metadata SET value = :value WHERE key = :key",
-            {"key": key, "value": value},
+            """
+            INSERT INTO metadata(key, value) VALUES(:key, :amount)
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + :amount
+        """,
+            {"key": get_counter_key(collection, username), "amount": amount},
         )
 
+    def check_counters(self) -> [tuple[str, int, int]]:
+        """Count the items of the collections and fix the counters which don't match.
+        Returns the fixed counters, as (key, saved value, actual value) tuples.
+        """
+        fixed = []
+        with self.transaction():
+            saved = {
+                key: int(value)
+                for key, value in self.execute(
+                    "SELECT key, value FROM metadata WHERE key GLOB '*_count:*'"
+                ).fetchall()
+            }
+            actual = {
+                get_counter_key(collection, username): count
+                for collection, sql in COUNTERS.items()
+                for username, count in self.execute(sql).fetchall()
+            }
+
+            for key in saved.keys() | actual.keys():
+                # A missing counter is 0, e.g. for an actor which has just been added.
+                if saved.get(key, 0) != actual.get(key, 0):
+                    fixed.append((key, saved.get(key), actual.get(key, 0)))
+                    self.set_metadata(key, actual.get(key, 0))
+
+        return fixed
+
     def get_database_version(self):
         return int(self.get_metadata("version"))
 
@@ -61,68 +260,152 @@ class Database:
 
     def upgrade_database(self) -> bool:
         """Returns True if the database has been upgraded"""
-        if self.get_database_version() == DATABASE_VERSION:
+        version = self.get_database_version()
+        if version == DATABASE_VERSION:
             return False
 
-        # Add upgrade instructions here
+        with sqlite3.connect(self.file_path) as connection:
+            cursor = connection.cursor()
+
+            if version < 2:
+                # The followings and the leader lock moved from the process memory to the database.
+                cursor.execute("PRAGMA journal_mode=WAL")
+                self.create_table(cursor, "followings")
+                self.create_table(cursor, "locks")
+
+            if version < 3:
+                # The feed entries are indexed, so the known ones can be skipped cheaply.
+                # The existing notes are indexed by their URL, with no feed and no hash: they will be considered unchanged.
+                self.create_table(cursor, "entries")
+                cursor.execute("ALTER TABLE notes ADD COLUMN updated_time INTEGER")
+                cursor.execute(
+                    "INSERT OR IGNORE INTO entries(id, feed, hash, note) SELECT url, '', NULL, uuid FROM notes"
+                )
+                self.create_index(cursor, "notes_url")
+
+            if version < 4:
+                # The feeds can be pushed through WebSub.
+                self.create_table(cursor, "subscriptions")
+                self.create_table(cursor, "pushes")
+
+            if version < 5:
+                # The notes are rendered when they are saved instead of each time they are read.
+                cursor.execute("ALTER TABLE notes ADD COLUMN html TEXT")
+                for uuid, content in cursor.execute(
+                    "SELECT uuid, content FROM notes"
+                ).fetchall():
+                    cursor.execute(
+                        "UPDATE notes SET html = :html WHERE uuid = :uuid",
+                        {"uuid": uuid, "html": str(model.Markdown(content))},
+                    )
+
+            if version < 6:
+                # The notes are indexed by hashtag.
+                self.create_table(cursor, "note_tags")
+                self.create_index(cursor, "note_tags_published")
+                for uuid, published_time, tags in cursor.execute(
+                    "SELECT uuid, published_time, tags FROM notes"
+                ).fetchall():
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO note_tags(tag, note, published_time) VALUES(?, ?, ?)",
+                        [
+                            (tag, uuid, published_time)
+                            for tag in self.get_hashtags(
+                                [self.make_tag(tag) for tag in json.loads(tags or "[]")]
+                            )
+                        ],
+                    )
+
+            if version < 7:
+                # Several actors can be hosted: the notes, the followers and the followings belong to one of them.
+                # The existing ones belong to the first actor, as well as the entries indexed with no feed.
+                actor = self.config.actor
+                for table in ["notes", "followers"]:
+                    cursor.execute(
+                        f"ALTER TABLE {table} ADD COLUMN actor VARCHAR(50) NOT NULL DEFAULT ''"
+                    )
+                    cursor.execute(
+                        f"UPDATE {table} SET actor = :actor",
+                        {"actor": actor.preferred_username},
+                    )
+                cursor.execute("ALTER TABLE followings RENAME TO followings_v6")
+                self.create_table(cursor, "followings")
+                cursor.execute(
+                    """
+                    INSERT INTO followings(actor, link, follow_id, following_since)
+                    SELECT :actor, link, follow_id, following_since FROM followings_v6
+                """,
+                    {"actor": actor.preferred_username},
+                )
+                cursor.execute("DROP TABLE followings_v6")
+                cursor.execute(
+                    "UPDATE OR IGNORE entries SET feed = :feed WHERE feed = ''",
+                    {"feed": actor.website.feeds[0].url},
+                )
+                self.create_index(cursor, "notes_actor")
+                self.create_index(cursor, "followers_actor")
+
+            if version < 8:
+                # The outbox is filtered by actor, so its messages are found from their notes,
+                # and the tags of a note are replaced when it is saved.
+                self.create_index(cursor, "messages_note")
+                self.create_index(cursor, "note_tags_note")
+
+            if version < 9:
+                # The activities are delivered by workers which can run in other processes.
+                self.create_table(cursor, "deliveries")
+                self.create_index(cursor, "deliveries_inbox")
+
+        if version < 10:
+            # The sizes of the collections are counted once, then kept up to date.
+            self.check_counters()
 
         self.set_metadata("version", DATABASE_VERSION)
 
         return True
 
+    @staticmethod
+    def create_table(cursor: sqlite3.Cursor, table: str):
+        sql = f"CREATE TABLE {table}("
+        sep = ""
+
+        for field in TABLES[table]:
+            sql += f"{sep}{field} {TABLES[table][field]}"
+            sep = ", "
+
+        sql += ")"
+        cursor.execute(sql)
+
+    @staticmethod
+    def create_index(cursor: sqlite3.Cursor, index: str):
+        cursor.execute(f"CREATE INDEX {index} ON {INDEXES[index]}")
+
     def init_database(self):
         if exists(self.file_path):
             raise IOError(
                 f"Database already exists. If you really want to reinitialize the data, delete it or rename it first."
             )
 
-        tables = {
-            "metadata": {
-                "key": "VARCHAR(50) PRIMARY KEY",
-                "value": "TEXT",
-            },
-            "messages": {
-                "uuid": "VARCHAR(36) PRIMARY KEY",
-                "msg_type": "VARCHAR(20) NOT NULL",
-                "note": "VARCHAR(36) NOT NULL",
-            },
-            "notes": {
-                "uuid": "VARCHAR(36) PRIMARY KEY",
-                "published_time": "INTEGER NOT NULL",
-                "url": "VARCHAR(255) NOT NULL",
-                "reply_to": "VARCHAR(255)",
-                "content": "TEXT NOT NULL",
-                "tags": "TEXT",
-            },
-            "followers": {
-                "uuid": "VARCHAR(36) PRIMARY KEY",
-                "follower_since": "INTEGER NOT NULL",
-                "link": "VARCHAR(255) NOT NULL",
-            },
-        }
-
         with sqlite3.connect(self.file_path) as connection:
             cursor = connection.cursor()
-            for table in tables:
-                sql = f"CREATE TABLE {table}("
-                sep = ""
+            # The WAL mode lets the readers work while another process is writing.
+            cursor.execute("PRAGMA journal_mode=WAL")
 
-                for field in tables[table]:
-                    sql += f"{sep}{field} {tables[table][field]}"
-                    sep = ", "
+            for table in TABLES:
+                self.create_table(cursor, table)
 
-                sql += ")"
-                cursor.execute(sql)
+            for index in INDEXES:
+                self.create_index(cursor, index)
 
         self.set_metadata("version", DATABASE_VERSION)
 
     def get_message(self, uuid: UUID) -> Optional[model.Message]:
         result = self.execute(
-            """
-            SELECT m.uuid as msg_uuid, m.msg_type, n.url
+            f"""
+            SELECT m.uuid, m.msg_type, {NOTE_FIELDS}
             FROM messages m
             JOIN notes n ON n.uuid = m.note
-            WHERE msg_uuid = :uuid
+            WHERE m.uuid = :uuid
         """,
             {"uuid": str(uuid)},
         ).fetchone()
@@ -130,13 +413,19 @@ class Database:
         if result is None:
             return None
 
-        msg_uuid, msg_type, url = result
-        note = self.get_note(url)
+        return self.make_message(result)
+
+    def make_message(self, row: tuple) -> Optional[model.Message]:
+        msg_uuid, msg_type = row[:2]
+        note = self.make_note(row[2:])
+
+        if note is None:
+            return None
 
         return model.Message(
             id=f"https://{self.config.url}/messages/{msg_uuid}",
             type=msg_type,
-            actor=self.config.actor.id,
+            actor=note.attributedTo,
             published=note.published,
             object=note,
         )
@@ -144,8 +433,8 @@ class Database:
     def get_note(self, url: str) -> Optional[model.Note]:
         query = self.execute(
             f"""
-            SELECT uuid, published_time, url, reply_to, content, tags
-            FROM notes
+            SELECT {NOTE_FIELDS}
+            FROM notes n
             WHERE url = :url
         """,
             {"url": url},
@@ -154,100 +443,340 @@ class Database:
         if query is None:
             return None
 
-        uuid, published, url, reply_to, content, tags = query
+        return self.make_note(query)
+
+    @profiling.timed("model")
+    def make_note(self, row: tuple) -> Optional[model.Note]:
+        """Returns None if the actor of the note is not in the configuration anymore."""
+        uuid, published, url, reply_to, html, tags, updated, username = row
+        actor = self.config.actors.get(username)
+
+        if actor is None:
+            return None
 
         return model.Note(
             id=url,
             in_reply_to=reply_to,
             published=datetime.fromtimestamp(published, tz=timezone.utc),
+            updated=(
+                datetime.fromtimestamp(updated, tz=timezone.utc)
+                if updated is not None
+                else None
+            ),
             url=url,
-            attributedTo=self.config.actor.id,
-            content=str(model.Markdown(content)),
-            cc=[self.config.actor.followers_link],
-            tag=json.loads(tags),
+            attributedTo=actor.id,
+            content=html,
+            cc=[actor.followers_link],
+            tag=[self.make_tag(tag) for tag in json.loads(tags)],
         )
 
+    def make_tag(self, tag: Union[str, dict]) -> model.Tag:
+        # The notes saved by the previous versions only have the names of their hashtags.
+        if isinstance(tag, str):
+            return model.Tag.make(self.config, tag)
+
+        return model.Tag(**tag)
+
+    @staticmethod
+    def get_hashtags(tags: [model.Tag]) -> {str}:
+        return {normalize_tag(tag.name) for tag in tags if tag.type == "Hashtag"}
+
+    def index_tags(self, uuid: UUID, tags: [model.Tag]):
+        self.execute("DELETE FROM note_tags WHERE note = :uuid", {"uuid": str(uuid)})
+        for tag in self.get_hashtags(tags):
+            self.execute(
+                """
+                INSERT INTO note_tags(tag, note, published_time)
+                SELECT :tag, uuid, published_time FROM notes WHERE uuid = :uuid
+            """,
+                {"tag": tag, "uuid": str(uuid)},
+            )
+
+    def count_tagged_notes(self, tag: str) -> int:
+        (count,) = self.execute(
+            "SELECT COUNT(*) FROM note_tags WHERE tag = :tag",
+            {"tag": normalize_tag(tag)},
+        ).fetchone()
+
+        return count
+
+    def get_tagged_notes(
+        self, tag: str, offset: int = 0, limit: int = -1
+    ) -> [model.Note]:
+        """Returns the notes with the given hashtag, the most recent first."""
+        results = self.execute(
+            f"""
+            SELECT {NOTE_FIELDS}
+            FROM note_tags t
+            JOIN notes n ON n.uuid = t.note
+            WHERE t.tag = :tag
+            ORDER BY t.published_time DESC
+            LIMIT :limit OFFSET :offset
+        """,
+            {"tag": normalize_tag(tag), "limit": limit, "offset": offset},
+        ).fetchall()
+
+        return [note for note in map(self.make_note, results) if note is not None]
+
+    def get_tags(self) -> [str]:
+        return [tag for (tag,) in self.execute("SELECT DISTINCT tag FROM note_tags")]
+
     def insert_note(
         self,
+        actor: Actor,
         content: str,
         published_on: datetime,
         url: str,
         reply_to: str = None,
-        tags: [str] = None,
-    ) -> (model.Note, UUID):
+        tags: [model.Tag] = None,
+        html: str = None,
+    ) -> UUID:
+        """Save the note. Its HTML is rendered from its content, unless it is given."""
         if tags is None:
             tags = []
 
         uuid = uuid4()
+        with self.transaction():
+            self.execute(
+                """
+                INSERT INTO notes(uuid, actor, content, html, published_time, reply_to, url, tags)
+                VALUES(:uuid, :actor, :content, :html, :published_time, :reply_to, :url, :tags)
+            """,
+                {
+                    "uuid": str(uuid),
+                    "actor": actor.preferred_username,
+                    "content": content,
+                    "html": html if html is not None else str(model.Markdown(content)),
+                    "published_time": int(
+                        published_on.astimezone(timezone.utc).timestamp()
+                    ),
+                    "reply_to": reply_to,
+                    "url": url,
+                    "tags": json.dumps([serialize(tag) for tag in tags]),
+                },
+            )
+            self.index_tags(uuid, tags)
+
+        return uuid
+
+    def update_note(
+        self,
+        uuid: UUID,
+        content: str,
+        updated_on: datetime,
+        tags: [model.Tag] = None,
+        html: str = None,
+    ):
+        if tags is None:
+            tags = []
+
+        with self.transaction():
+            self.execute(
+                """
+                UPDATE notes
+                SET content = :content, html = :html, tags = :tags, updated_time = :updated_time
+                WHERE uuid = :uuid
+            """,
+                {
+                    "uuid": str(uuid),
+                    "content": content,
+                    "html": html if html is not None else str(model.Markdown(content)),
+                    "tags": json.dumps([serialize(tag) for tag in tags]),
+                    "updated_time": int(
+                        updated_on.astimezone(timezone.utc).timestamp()
+                    ),
+                },
+            )
+            self.index_tags(uuid, tags)
+
+    def get_entries(
+        self, ids: [str], feeds: [str]
+    ) -> {str: {str: tuple[Optional[str], str]}}:
+        """Returns the known entries among the given IDs, in the given feeds, as {id: {feed: (hash, note UUID)}}."""
+        entries = {}
+        feeds = set(feeds)
+
+        # Query by chunks, to stay below the SQLite limit of variables per query.
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            for entry_id, feed, entry_hash, note in self.execute(
+                f"SELECT id, feed, hash, note FROM entries WHERE id IN ({placeholders})",
+                chunk,
+            ):
+                if feed in feeds:
+                    entries.setdefault(entry_id, {})[feed] = (entry_hash, note)
+
+        return entries
+
+    def set_entry(
+        self,
+        feed: str,
+        entry_id: str,
+        entry_hash: str,
+        note_uuid: Optional[UUID] = None,
+    ):
         self.execute(
             """
-            INSERT INTO notes(uuid, content, published_time, reply_to, url, tags)
-            VALUES(:uuid, :content, :published_time, :reply_to, :url, :tags)
+            INSERT INTO entries(id, feed, hash, note) VALUES(:id, :feed, :hash, :note)
+            ON CONFLICT(id, feed) DO UPDATE SET hash = excluded.hash, note = excluded.note
         """,
             {
-                "uuid": str(uuid),
-                "content": content,
-                "published_time": int(
-                    published_on.astimezone(timezone.utc).timestamp()
-                ),
-                "reply_to": reply_to,
-                "url": url,
-                "tags": json.dumps(tags),
+                "id": entry_id,
+                "feed": feed,
+                "hash": entry_hash,
+                "note": str(note_uuid) if note_uuid is not None else None,
             },
         )
 
-        return self.get_note(url), uuid
+    def get_subscription(self, uuid: UUID) -> Optional[tuple[str, str, str]]:
+        """Returns the feed, the topic and the secret of the WebSub subscription."""
+        return self.execute(
+            "SELECT feed, topic, secret FROM subscriptions WHERE uuid = :uuid",
+            {"uuid": str(uuid)},
+        ).fetchone()
 
-    def insert_message(
-        self, note_uuid: UUID, msg_type: str = "Create"
-    ) -> model.Message:
+    def get_feed_subscription(
+        self, feed: str
+    ) -> Optional[tuple[str, str, str, Optional[datetime]]]:
+        """Returns the UUID, the hub, the topic and the expiration date of the WebSub subscription of the feed.
+        The expiration date is None until the hub has verified the subscription.
+        """
+        result = self.execute(
+            "SELECT uuid, hub, topic, expiration_time FROM subscriptions WHERE feed = :feed",
+            {"feed": feed},
+        ).fetchone()
+
+        if result is None:
+            return None
+
+        uuid, hub, topic, expiration = result
+
+        return (
+            uuid,
+            hub,
+            topic,
+            (
+                datetime.fromtimestamp(expiration, tz=timezone.utc)
+                if expiration is not None
+                else None
+            ),
+        )
+
+    def insert_subscription(self, feed: str, hub: str, topic: str, secret: str) -> UUID:
+        """Replace the WebSub subscription of the feed. It is inactive until the hub verifies it."""
         uuid = uuid4()
         self.execute(
             """
-            INSERT INTO messages(uuid, msg_type, note)
-            VALUES(:uuid, :msg_type, :note_uuid)
+            INSERT OR REPLACE INTO subscriptions(uuid, feed, hub, topic, secret, expiration_time)
+            VALUES(:uuid, :feed, :hub, :topic, :secret, NULL)
         """,
             {
                 "uuid": str(uuid),
-                "msg_type": msg_type,
-                "note_uuid": str(note_uuid),
+                "feed": feed,
+                "hub": hub,
+                "topic": topic,
+                "secret": secret,
+            },
+        )
+
+        return uuid
+
+    def activate_subscription(self, uuid: UUID, lease_seconds: int):
+        self.execute(
+            "UPDATE subscriptions SET expiration_time = :expiration_time WHERE uuid = :uuid",
+            {
+                "uuid": str(uuid),
+                "expiration_time": int(datetime.now(tz=timezone.utc).timestamp())
+                + lease_seconds,
             },
         )
 
-        return self.get_message(uuid)
+    def delete_subscription(self, uuid: UUID):
+        self.execute(
+            "DELETE FROM subscriptions WHERE uuid = :uuid", {"uuid": str(uuid)}
+        )
+
+    def count_active_subscriptions(self) -> int:
+        (result,) = self.execute(
+            "SELECT COUNT(uuid) FROM subscriptions WHERE expiration_time > :now",
+            {"now": int(datetime.now(tz=timezone.utc).timestamp())},
+        ).fetchone()
+
+        return result
+
+    def insert_push(self, feed: str, content: bytes, content_type: Optional[str]):
+        self.execute(
+            """
+            INSERT INTO pushes(feed, content, content_type)
+            VALUES(:feed, :content, :content_type)
+        """,
+            {"feed": feed, "content": content, "content_type": content_type},
+        )
+
+    def pop_pushes(self) -> [tuple[str, bytes, Optional[str]]]:
+        """Remove the pushed contents from the database and return them, as (feed, content, content type) tuples."""
+        with sqlite3.connect(self.file_path) as connection:
+            cursor = connection.cursor()
+            pushes = cursor.execute(
+                "SELECT id, feed, content, content_type FROM pushes ORDER BY id"
+            ).fetchall()
 
-    def get_messages(self, order: str = "DESC") -> [dict]:
+            if len(pushes) > 0:
+                cursor.execute(
+                    "DELETE FROM pushes WHERE id <= :id", {"id": pushes[-1][0]}
+                )
+
+        return [
+            (feed, content, content_type) for _, feed, content, content_type in pushes
+        ]
+
+    def insert_message(self, note_uuid: UUID, msg_type: str = "Create") -> UUID:
+        uuid = uuid4()
+        with self.transaction():
+            self.execute(
+                """
+                INSERT INTO messages(uuid, msg_type, note)
+                VALUES(:uuid, :msg_type, :note_uuid)
+            """,
+                {
+                    "uuid": str(uuid),
+                    "msg_type": msg_type,
+                    "note_uuid": str(note_uuid),
+                },
+            )
+            (username,) = self.execute(
+                "SELECT actor FROM notes WHERE uuid = :uuid", {"uuid": str(note_uuid)}
+            ).fetchone()
+            self.add_to_counter("outbox", username, 1)
+
+        return uuid
+
+    def get_messages(
+        self, actor: Actor, order: str = "DESC", offset: int = 0, limit: int = -1
+    ) -> [model.Message]:
+        # The messages of the same note are ordered too, so the pages don't overlap.
         results = self.execute(
             f"""
-            SELECT m.uuid as m_uuid, m.msg_type, n.url
+            SELECT m.uuid, m.msg_type, {NOTE_FIELDS}
             FROM messages m
             JOIN notes n ON m.note = n.uuid
-            ORDER BY n.published_time {order}
-        """
+            WHERE n.actor = :actor
+            ORDER BY n.published_time {order}, m.rowid {order}
+            LIMIT :limit OFFSET :offset
+        """,
+            {"actor": actor.preferred_username, "offset": offset, "limit": limit},
         ).fetchall()
 
-        messages = []
-
-        for (
-            message_uuid,
-            message_type,
-            url,
-        ) in results:
-            note = self.get_note(url)
-            messages.append(
-                model.Message(
-                    id=f"https://{self.config.url}/messages/{message_uuid}",
-                    actor=self.config.actor.id,
-                    published=note.published,
-                    object=note,
-                )
-            )
+        return [self.make_message(row) for row in results]
 
-        return messages
+    def count_messages(self, actor: Actor) -> int:
+        return self.get_counter("outbox", actor)
 
-    def get_last_note_datetime(self) -> Union[None, datetime]:
+    def get_last_note_datetime(self, actor: Actor) -> Union[None, datetime]:
         (result,) = self.execute(
-            "SELECT MAX(published_time) as dt FROM notes"
+            "SELECT MAX(published_time) as dt FROM notes WHERE actor = :actor",
+            {"actor": actor.preferred_username},
         ).fetchone()
 
         if result is None:
@@ -255,45 +784,65 @@ class Database:
 
         return datetime.fromtimestamp(result, tz=timezone.utc)
 
-    def insert_follower(self, account: str) -> UUID:
+    def insert_follower(self, actor: Actor, account: str) -> UUID:
         uuid = uuid4()
-        self.execute(
-            """
-            INSERT INTO followers(uuid, follower_since, link)
-            VALUES(:uuid, :since, :account)
-        """,
-            {
-                "uuid": str(uuid),
-                "since": datetime.utcnow().timestamp(),
-                "account": account,
-            },
-        )
+        with self.transaction():
+            self.execute(
+                """
+                INSERT INTO followers(uuid, actor, follower_since, link)
+                VALUES(:uuid, :actor, :since, :account)
+            """,
+                {
+                    "uuid": str(uuid),
+                    "actor": actor.preferred_username,
+                    "since": datetime.utcnow().timestamp(),
+                    "account": account,
+                },
+            )
+            self.add_to_counter("followers", actor.preferred_username, 1)
 
         return uuid
 
-    def delete_follower(self, account: str):
-        self.execute(
-            """
-            DELETE FROM followers
-            WHERE link = :account
-        """,
-            {
-                "account": account,
-            },
-        )
+    def delete_follower(self, actor: Actor, account: str):
+        with self.transaction():
+            cursor = self.execute(
+                """
+                DELETE FROM followers
+                WHERE actor = :actor AND link = :account
+            """,
+                {
+                    "actor": actor.preferred_username,
+                    "account": account,
+                },
+            )
+            self.add_to_counter("followers", actor.preferred_username, -cursor.rowcount)
 
-    def count_followers(self) -> int:
-        (result,) = self.execute("SELECT COUNT(uuid) FROM followers").fetchone()
+    def delete_account(self, account: str):
+        """Remove the account from the followers of all the actors, when it has been deleted."""
+        with self.transaction():
+            counts = self.execute(
+                "SELECT actor, COUNT(uuid) FROM followers WHERE link = :account GROUP BY actor",
+                {"account": account},
+            ).fetchall()
+            self.execute(
+                "DELETE FROM followers WHERE link = :account", {"account": account}
+            )
+            for username, count in counts:
+                self.add_to_counter("followers", username, -count)
 
-        return result
+    def count_followers(self, actor: Actor) -> int:
+        return self.get_counter("followers", actor)
 
-    def get_followers(self) -> [str]:
+    def get_followers(self, actor: Actor, offset: int = 0, limit: int = -1) -> [str]:
         query = self.execute(
             """
             SELECT link
             FROM followers
-            ORDER BY follower_since DESC
-        """
+            WHERE actor = :actor
+            ORDER BY follower_since DESC, rowid DESC
+            LIMIT :limit OFFSET :offset
+        """,
+            {"actor": actor.preferred_username, "offset": offset, "limit": limit},
         ).fetchall()
 
         followers = []
@@ -301,3 +850,176 @@ class Database:
             followers.append(link)
 
         return followers
+
+    def insert_following(self, actor: Actor, follow_id: str, account: str):
+        with self.transaction():
+            exists = self.execute(
+                "SELECT 1 FROM followings WHERE actor = :actor AND link = :account",
+                {"actor": actor.preferred_username, "account": account},
+            ).fetchone()
+            self.execute(
+                """
+                INSERT OR REPLACE INTO followings(actor, link, follow_id, following_since)
+                VALUES(:actor, :account, :follow_id, :since)
+            """,
+                {
+                    "actor": actor.preferred_username,
+                    "account": account,
+                    "follow_id": follow_id,
+                    "since": datetime.utcnow().timestamp(),
+                },
+            )
+            if exists is None:
+                self.add_to_counter("following", actor.preferred_username, 1)
+
+    def count_followings(self, actor: Actor) -> int:
+        return self.get_counter("following", actor)
+
+    def get_followings(
+        self, actor: Actor, offset: int = 0, limit: int = -1
+    ) -> [tuple[str, str]]:
+        """Returns the accepted followings of the actor, as (follow activity ID, account) tuples."""
+        return self.execute(
+            """
+            SELECT follow_id, link
+            FROM followings
+            WHERE actor = :actor
+            ORDER BY following_since DESC, link
+            LIMIT :limit OFFSET :offset
+        """,
+            {"actor": actor.preferred_username, "offset": offset, "limit": limit},
+        ).fetchall()
+
+    def delete_followings(self, actor: Actor):
+        with self.transaction():
+            cursor = self.execute(
+                "DELETE FROM followings WHERE actor = :actor",
+                {"actor": actor.preferred_username},
+            )
+            self.add_to_counter("following", actor.preferred_username, -cursor.rowcount)
+
+    def insert_deliveries(self, actor: Actor, deliveries: [tuple[str, dict]]):
+        """Queue the activities to deliver, as (inbox, document) tuples."""
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        with self.transaction():
+            for inbox, document in deliveries:
+                self.execute(
+                    """
+                    INSERT INTO deliveries(actor, inbox, document, next_attempt_time)
+                    VALUES(:actor, :inbox, :document, :now)
+                """,
+                    {
+                        "actor": actor.preferred_username,
+                        "inbox": inbox,
+                        "document": encode_json(document).decode(),
+                        "now": now,
+                    },
+                )
+
+    def claim_deliveries(
+        self, claim: str, max_inboxes: int, ttl: int
+    ) -> [tuple[int, str, str, str, int]]:
+        """Claim the activities of at most max_inboxes inboxes for the given time to live, in seconds.
+        An inbox can only be claimed when none of its activities is claimed or waiting for a retry, so they stay in order.
+        Returns the claimed activities in the order to deliver them, as (id, actor, inbox, document, attempts) tuples.
+        The documents are returned as JSON, so one that can't be decoded only fails its own delivery.
+        """
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        # A single statement, so two workers can't claim the same inbox.
+        self.execute(
+            """
+            UPDATE deliveries
+            SET claim = :claim, claim_expiration_time = :expiration_time
+            WHERE inbox IN (
+                SELECT inbox FROM deliveries
+                GROUP BY inbox
+                HAVING MAX(next_attempt_time) <= :now AND MAX(COALESCE(claim_expiration_time, 0)) <= :now
+                ORDER BY MIN(id)
+                LIMIT :max_inboxes
+            )
+        """,
+            {
+                "claim": claim,
+                "expiration_time": now + ttl,
+                "now": now,
+                "max_inboxes": max_inboxes,
+            },
+        )
+
+        return self.execute(
+            """
+            SELECT id, actor, inbox, document, attempts
+            FROM deliveries
+            WHERE claim = :claim
+            ORDER BY id
+        """,
+            {"claim": claim},
+        ).fetchall()
+
+    def delete_delivery(self, delivery_id: int):
+        self.execute("DELETE FROM deliveries WHERE id = :id", {"id": delivery_id})
+
+    def postpone_deliveries(self, claim: str, inbox: str, failed_id: int, delay: int):
+        """Release the claimed activities of the inbox after a failed delivery, to retry them after the delay in seconds."""
+        with self.transaction():
+            self.execute(
+                "UPDATE deliveries SET attempts = attempts + 1 WHERE id = :id",
+                {"id": failed_id},
+            )
+            self.execute(
+                """
+                UPDATE deliveries
+                SET claim = NULL, claim_expiration_time = NULL, next_attempt_time = :next_attempt_time
+                WHERE claim = :claim AND inbox = :inbox
+            """,
+                {
+                    "claim": claim,
+                    "inbox": inbox,
+                    "next_attempt_time": int(datetime.now(tz=timezone.utc).timestamp())
+                    + delay,
+                },
+            )
+
+    def count_deliveries(self) -> int:
+        (result,) = self.execute("SELECT COUNT(id) FROM deliveries").fetchone()
+
+        return result
+
+    def pop_flag(self, key: str) -> bool:
+        """Unset the given metadata flag, and return True if this call is the one which unset it.
+        This is atomic, so only one process can get True, even if several ones try at the same time.
+        """
+        cursor = self.execute(
+            "UPDATE metadata SET value = '0' WHERE key = :key AND value = '1'",
+            {"key": key},
+        )
+
+        return cursor.rowcount == 1
+
+    def acquire_lock(self, name: str, owner: str, ttl: int) -> bool:
+        """Take or renew the lock for the given time to live, in seconds.
+        Returns True if the owner holds the lock.
+        """
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        self.execute(
+            """
+            INSERT INTO locks(name, owner, expiration_time)
+            VALUES(:name, :owner, :expiration_time)
+            ON CONFLICT(name) DO UPDATE
+            SET owner = excluded.owner, expiration_time = excluded.expiration_time
+            WHERE locks.owner = excluded.owner OR locks.expiration_time < :now
+        """,
+            {"name": name, "owner": owner, "expiration_time": now + ttl, "now": now},
+        )
+
+        result = self.execute(
+            "SELECT owner FROM locks WHERE name = :name", {"name": name}
+        ).fetchone()
+
+        return result is not None and result[0] == owner
+
+    def release_lock(self, name: str, owner: str):
+        self.execute(
+            "DELETE FROM locks WHERE name = :name AND owner = :owner",
+            {"name": name, "owner": owner},
+        )
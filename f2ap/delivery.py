@@ -0,0 +1,120 @@
+import json
+import logging
+
+from itertools import groupby
+from threading import Thread, Event
+from uuid import uuid4
+
+from . import postie
+from .config import Configuration
+from .data import Database
+
+# How many inboxes a worker claims at once, and for how long, in seconds.
+# The claim must last longer than the deliveries to an inbox, which time out after postie.DELIVERY_TIMEOUT each.
+MAX_CLAIMED_INBOXES = postie.MAX_CONCURRENT_DELIVERIES
+CLAIM_TTL = 600
+
+# How often the queue is checked when it is empty, in seconds.
+POLL_INTERVAL = 2
+
+# How long to wait after an unexpected error, e.g. a locked database, in seconds.
+ERROR_DELAY = 10
+
+# The delay before the next attempt doubles after each failure, and the activity is given up after the last one.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 6 * 3600
+MAX_ATTEMPTS = 10
+
+
+def is_permanent_failure(e: Exception) -> bool:
+    """The remote server refused the activity: sending it again won't help."""
+    return (
+        isinstance(e, postie.DeliveryException)
+        and 400 <= e.status_code < 500
+        and e.status_code not in [408, 429]
+    )
+
+
+class DeliveryThread(Thread):
+    """Deliver the activities queued in the database. Several threads, in one or more processes, can share the queue:
+    each inbox is claimed by one of them at a time, which delivers its activities in order.
+    """
+
+    def __init__(self, config: Configuration, db: Database):
+        super().__init__()
+        self.config = config
+        self.db = db
+        self.stopped = Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                delivered = self.deliver_claimed()
+            except Exception:
+                # E.g. a locked database: the thread must keep running, as it is all the deliver process does.
+                logging.exception("Could not deliver the queued messages.")
+                self.stopped.wait(ERROR_DELAY)
+                continue
+
+            if not delivered:
+                self.stopped.wait(POLL_INTERVAL)
+
+    def deliver_claimed(self) -> bool:
+        """Claim inboxes and deliver their activities. Returns False if there was nothing to deliver."""
+        claim = str(uuid4())
+        deliveries = self.db.claim_deliveries(claim, MAX_CLAIMED_INBOXES, CLAIM_TTL)
+
+        if len(deliveries) == 0:
+            return False
+
+        futures = [
+            postie.pool.executor.submit(
+                self.deliver_inbox, claim, inbox, list(inbox_deliveries)
+            )
+            for inbox, inbox_deliveries in groupby(
+                sorted(deliveries, key=lambda d: d[2]), key=lambda d: d[2]
+            )
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # The activities of the inbox stay claimed: they will be delivered again once the claim expires.
+                logging.exception("Could not deliver the activities of an inbox.")
+
+        return True
+
+    def deliver_inbox(self, claim: str, inbox: str, deliveries: [tuple]):
+        # The activities are delivered in order, so an update never arrives before its note.
+        for delivery_id, username, _, document, attempts in deliveries:
+            actor = self.config.actors.get(username)
+            if actor is None:
+                logging.warning(
+                    f"Dropping a message of {username} to {inbox}: this actor is not hosted anymore."
+                )
+                self.db.delete_delivery(delivery_id)
+                continue
+
+            try:
+                postie.deliver(actor, inbox, json.loads(document))
+            except Exception as e:
+                # Any failure counts as an attempt, e.g. a document that can't be signed,
+                # so the activity is given up in the end instead of blocking the next ones to this inbox.
+                if is_permanent_failure(e) or attempts + 1 >= MAX_ATTEMPTS:
+                    logging.error(f"Could not deliver a message to {inbox}: {e}")
+                    self.db.delete_delivery(delivery_id)
+                    continue
+
+                delay = min(RETRY_DELAY * 2**attempts, MAX_RETRY_DELAY)
+                logging.warning(
+                    f"Could not deliver a message to {inbox}, retrying in {delay} s: {e}"
+                )
+                self.db.postpone_deliveries(claim, inbox, delivery_id, delay)
+                return
+
+            self.db.delete_delivery(delivery_id)
+
+    def stop(self):
+        """Stop the thread, after the deliveries in progress."""
+        self.stopped.set()
+        self.join()
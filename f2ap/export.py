@@ -0,0 +1,181 @@
+import os
+import json
+import logging
+
+from typing import Any, Optional
+from urllib.parse import urlparse
+from pydantic import BaseModel
+
+from . import cache
+from .config import Configuration, Actor as ConfigActor
+from .data import Database
+from .json import encode_json
+from .serializers import serialize
+from .model import OrderedCollection, Actor
+from .webserver import make_webfinger, ACTIVITY_JSON_MIME_TYPE, JRDResponse
+
+MANIFEST_FILE = "manifest.json"
+
+
+class Exporter:
+    """Write the documents served by f2ap as static files, so a front proxy or a CDN can serve them.
+
+    Each document is written to a path that mirrors its URL: `index.json` for the document itself,
+    `page-N.json` for the Nth page of a collection. The `manifest.json` file at the root of the directory
+    maps every URL to its file, its content type and its ETag.
+    Notes and messages only change when their entry is modified, so they are only rendered again in this case.
+    The other documents are rewritten only when their content changes.
+    """
+
+    def __init__(self, config: Configuration, db: Database, directory: str):
+        self.config = config
+        self.db = db
+        self.directory = directory
+        self.previous_manifest = {}
+        self.manifest = {}
+        self.written = 0
+
+    def export(self) -> int:
+        """Export all the documents and return the number of files written."""
+        self.previous_manifest = self.read_manifest()
+        self.manifest = {}
+        self.written = 0
+
+        for actor in self.config.actors.values():
+            self.export_actor(actor)
+
+        for tag in self.db.get_tags():
+            self.add_collection(
+                f"https://{self.config.url}/tags/{tag}", self.db.get_tagged_notes(tag)
+            )
+
+        for url, entry in self.previous_manifest.items():
+            if url not in self.manifest:
+                self.remove(entry["file"])
+
+        self.write_manifest()
+        logging.info(f"Export finished: {self.written} file(s) written.")
+
+        return self.written
+
+    def export_actor(self, actor: ConfigActor):
+        webfinger = make_webfinger(actor)
+        self.add(
+            "/.well-known/webfinger",
+            webfinger,
+            query=f"resource={webfinger['subject']}",
+            content_type=JRDResponse.media_type,
+            # All the actors share the same path, so each one gets its own file.
+            file_name=f"{actor.preferred_username}.json",
+        )
+        self.add(f"/actors/{actor.preferred_username}", Actor.make(actor))
+
+        messages = self.db.get_messages(actor)
+        for message in messages:
+            version = (message.object.updated or message.object.published).isoformat()
+            self.add_object(urlparse(message.id).path, lambda: message, version)
+
+            note_url = urlparse(message.object.id)
+            if note_url.hostname == self.config.url:
+                self.add_object(note_url.path, lambda: message.object, version)
+
+        self.add_collection(actor.outbox, messages)
+        self.add_collection(actor.followers_link, self.db.get_followers(actor))
+        self.add_collection(
+            actor.following_link,
+            [account for _, account in self.db.get_followings(actor)],
+        )
+
+    def add_collection(self, endpoint: str, items: list):
+        path = urlparse(endpoint).path
+        self.add(path, OrderedCollection.make(endpoint, items))
+
+        page = 1
+        while True:
+            collection = OrderedCollection.make(endpoint, items, page)
+            if collection is None:
+                break
+
+            self.add(path, collection, query=f"page={page}")
+            page += 1
+
+    def add_object(self, path: str, get_document, version: str):
+        """Add a note or a message. They are rendered only if their version has changed since the last export."""
+        entry = self.previous_manifest.get(path)
+        if (
+            entry is not None
+            and entry.get("version") == version
+            and os.path.exists(self.get_full_path(entry["file"]))
+        ):
+            self.manifest[path] = entry
+            return
+
+        self.add(path, get_document())
+        self.manifest[path]["version"] = version
+
+    def add(
+        self,
+        path: str,
+        document: Any,
+        query: Optional[str] = None,
+        content_type: str = ACTIVITY_JSON_MIME_TYPE,
+        file_name: str = "index.json",
+    ):
+        url = path if query is None else f"{path}?{query}"
+        if query is not None and query.startswith("page="):
+            file_name = f"page-{query.removeprefix('page=')}.json"
+
+        file = os.path.join(path.strip("/"), file_name)
+        if isinstance(document, BaseModel):
+            document = serialize(document)
+        body = encode_json(document)
+        etag = cache.make_etag(body)
+
+        self.manifest[url] = {"file": file, "content_type": content_type, "etag": etag}
+
+        previous = self.previous_manifest.get(url)
+        full_path = self.get_full_path(file)
+        if (
+            previous is not None
+            and previous["etag"] == etag
+            and os.path.exists(full_path)
+        ):
+            return
+
+        self.write(full_path, body)
+        self.written += 1
+
+    def get_full_path(self, file: str) -> str:
+        return os.path.join(self.directory, file)
+
+    def write(self, full_path: str, content: bytes):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        # Write to a temporary file first, so the proxy never serves a partially written file.
+        temp_path = f"{full_path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(content)
+        os.replace(temp_path, full_path)
+
+    def remove(self, file: str):
+        try:
+            os.remove(self.get_full_path(file))
+        except FileNotFoundError:
+            pass
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(self.get_full_path(MANIFEST_FILE), "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def write_manifest(self):
+        self.write(
+            self.get_full_path(MANIFEST_FILE),
+            json.dumps(self.manifest, indent=2, sort_keys=True).encode(),
+        )
+
+
+def export(config: Configuration, db: Database, directory: str) -> int:
+    return Exporter(config, db, directory).export()
@@ -1,130 +1,838 @@
+import os
+import hashlib
 import feedparser
 import logging
+import requests
 
 from datetime import datetime, timezone
 from email.utils import parsedate_to_datetime
-from threading import Thread
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+from time import perf_counter, monotonic
+from typing import Iterator, Optional
+from uuid import UUID
+from itertools import islice
+from xml.etree import ElementTree
+from requests.adapters import HTTPAdapter
 
-from . import activitypub
+from . import activitypub, model, websub, metrics
 from .data import Database
-from .config import Configuration
-from .markdown import find_hashtags
+from .export import export
+from .config import Configuration, Feed, Actor
+from .leader import LeaderThread
+from .markdown import link_tags, parse_markdown
+from .streaming import StreamingFeed, FeedTooLargeException
+
+
+MAX_CONCURRENT_FETCHES = 8
+
+CHUNK_SIZE = 64 * 1024
+
+# The known entries are looked for in the database by batches of this size.
+ENTRIES_BATCH_SIZE = 100
+
+# The new entries are saved in transactions of this size.
+PUBLISH_BATCH_SIZE = 100
+
+# A streamed feed is not read further after this number of consecutive unchanged entries.
+KNOWN_ENTRIES_TO_STOP = 3
+
+# When a feed has not changed, the interval before its next check is multiplied by this factor, up to its max_update_freq.
+BACKOFF_FACTOR = 1.5
+
+# While WebSub subscriptions are active, how often the content pushed to the other processes is looked for, in seconds.
+PUSH_CHECK_INTERVAL = 10
+
+FEED_ACCEPT = "application/atom+xml, application/rss+xml, application/xml;q=0.9, text/xml;q=0.8, */*;q=0.1"
+
+
+class FeedResponse:
+    """A downloaded feed. If it is streamed, content is None and the feed is read from chunks."""
+
+    def __init__(
+        self,
+        content: Optional[bytes],
+        headers: {str: str},
+        chunks: Iterator[bytes] = None,
+    ):
+        self.content = content
+        self.headers = headers
+        self.chunks = chunks
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.headers.get("etag")
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.headers.get("last-modified")
+
+
+class FeedFetcher:
+    """Download the feeds through a pool of persistent connections, shared by all the actors.
+    The requests are conditional, so an unchanged feed is not downloaded again.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": "f2ap", "Accept": FEED_ACCEPT})
+
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch(
+        self,
+        url: str,
+        timeout: int,
+        max_size: int,
+        etag: str = None,
+        last_modified: str = None,
+        stream: bool = False,
+    ) -> Optional[FeedResponse]:
+        """Returns None if the feed has not changed since the given validators.
+        With stream=True, the content is read while it is iterated, and its size is limited by the parser.
+        """
+        if not url.startswith(("https://", "http://")):
+            return self.read_file(url, max_size, stream)
+
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+
+        response = self.session.get(url, headers=headers, timeout=timeout, stream=True)
+
+        if stream and response.status_code == 200:
+            return FeedResponse(None, response.headers, iter_response(response))
+
+        with response:
+            if response.status_code == 304:
+                return None
+
+            response.raise_for_status()
+
+            # The content is read by chunks, so a huge feed is not loaded in memory before being rejected.
+            # requests decompresses the content on the fly, so the limit applies to the actual size.
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                content.extend(chunk)
+                if len(content) > max_size:
+                    raise FeedTooLargeException(
+                        f"Feed {url} is larger than the limit of {max_size} bytes."
+                    )
+
+            return FeedResponse(bytes(content), response.headers)
+
+    def read_file(self, path: str, max_size: int, stream: bool = False) -> FeedResponse:
+        if stream:
+            return FeedResponse(None, {}, iter_file(path))
+
+        if os.path.getsize(path) > max_size:
+            raise FeedTooLargeException(
+                f"Feed {path} is larger than the limit of {max_size} bytes."
+            )
+
+        with open(path, "rb") as file:
+            return FeedResponse(file.read(), {})
+
+
+def iter_response(response: requests.Response) -> Iterator[bytes]:
+    # The response is closed when it has been read, or when the reading is stopped.
+    with response:
+        yield from response.iter_content(chunk_size=CHUNK_SIZE)
+
+
+def iter_file(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+
+
+def get_entry_id(item: feedparser.FeedParserDict) -> Optional[str]:
+    """The entries are identified by their link, which is also the ID of their note, or by their ID if they have no link."""
+    return item.get("link") or item.get("id")
+
+
+def get_tag_labels(item: feedparser.FeedParserDict) -> [str]:
+    # Atom categories may have a human-readable label, RSS ones only have a term.
+    return [tag.get("label") or tag.get("term") for tag in item.get("tags", [])]
+
+
+def get_entry_hash(item: feedparser.FeedParserDict) -> str:
+    """A fingerprint of the fields of the entry that are used to make its note."""
+    fingerprint = hashlib.blake2b(digest_size=16)
+
+    for value in [
+        item.get("title", ""),
+        item.get("link", ""),
+        item.get("summary", ""),
+        item.get("author", ""),
+        *get_tag_labels(item),
+    ]:
+        fingerprint.update((value or "").encode())
+        fingerprint.update(b"\0")
+
+    return fingerprint.hexdigest()
+
+
+class FeedEntry:
+    """An entry to publish. If it has a note UUID, it is an update of an already published entry."""
+
+    def __init__(
+        self,
+        feed: str,
+        entry_id: str,
+        entry_hash: str,
+        published: datetime,
+        item: feedparser.FeedParserDict,
+        note_uuid: Optional[str] = None,
+    ):
+        self.feed = feed
+        self.id = entry_id
+        self.hash = entry_hash
+        self.published = published
+        self.item = item
+        self.note_uuid = note_uuid
+        # The note, set by UpdateFeedThread.render().
+        self.content = None
+        self.tags = None
+        self.html = None
+
+
+class FeedUpdate:
+    """The result of the download of a feed."""
+
+    def __init__(
+        self,
+        feed: Feed,
+        response: FeedResponse,
+        parsed: feedparser.FeedParserDict,
+        fetch_duration: float,
+        parse_duration: float,
+        pushed: bool = False,
+    ):
+        self.feed = feed
+        self.response = response
+        self.parsed = parsed
+        self.fetch_duration = fetch_duration
+        self.parse_duration = parse_duration
+        self.pushed = pushed
+        self.changed = False
+        self.newest_entry_dt = None
+        # Entries to add to the index without publishing them, as (ID, hash, note UUID) tuples.
+        self.indexed_entries = []
+
+    @property
+    def streaming(self) -> bool:
+        return isinstance(self.parsed, StreamingFeed)
+
+    def close(self):
+        if self.streaming:
+            self.parsed.close()
 
 
 class UpdateFeedThread(Thread):
-    def __init__(self, config: Configuration, db: Database):
+    """Check the feeds of all the actors when they are due, and publish their new entries.
+    Each feed is checked every update_freq minutes after it has changed, then less and less often while it is quiet.
+    Between the checks, the thread sleeps until the next feed is due, it is asked to check now or it is stopped.
+    """
+
+    def __init__(self, config: Configuration, db: Database, leader: LeaderThread):
         super().__init__()
         self.config = config
         self.db = db
-        self.stop = False
+        self.leader = leader
+        self.stopped = Event()
+        self.wake_up = Event()
+        self.fetcher = FeedFetcher()
+        self.executor = ThreadPoolExecutor(
+            max_workers=min(len(config.feeds), MAX_CONCURRENT_FETCHES),
+            thread_name_prefix="feed",
+        )
+        self.next_updates = {url: 0.0 for url in config.feeds}
+        self.intervals = {
+            url: feed.update_freq * 60 for url, feed in config.feeds.items()
+        }
+        # For each actor, the messages of its first import that are still to be announced, and when the next one can be.
+        self.backfill_announces = {username: deque() for username in config.actors}
+        self.next_backfill_announce = {username: 0.0 for username in config.actors}
+        # The documents are exported once at start, for the changes of the profiles, then when the notes change.
+        self.export_pending = config.export is not None
 
     def run(self) -> None:
-        self.stop = False
-        while not self.stop:
-            activitypub.propagate_messages(
-                self.config, self.get_inboxes(), self.update()
+        while not self.stopped.is_set():
+            if self.leader.is_leader:
+                messages = self.update()
+
+                for username, announces in self.backfill_announces.items():
+                    if (
+                        len(announces) > 0
+                        and self.next_backfill_announce[username] <= monotonic()
+                    ):
+                        messages.append(announces.popleft())
+                        self.next_backfill_announce[username] = (
+                            monotonic()
+                            + self.config.actors[
+                                username
+                            ].website.backfill_announce_interval
+                        )
+
+                if self.export_pending:
+                    # Export first, so the new documents are available when the followers receive them.
+                    try:
+                        export(self.config, self.db, self.config.export.directory)
+                        self.export_pending = False
+                    except OSError as e:
+                        logging.error(f"Could not export the documents: {e}")
+
+                # The messages are delivered by the delivery workers, which may run in other processes.
+                for actor in self.config.actors.values():
+                    actor_messages = [
+                        message for message in messages if message.actor == actor.id
+                    ]
+                    if len(actor_messages) > 0:
+                        activitypub.queue_messages(
+                            self.db, actor, self.db.get_followers(actor), actor_messages
+                        )
+                wait = max(0.0, min(self.next_updates.values()) - monotonic())
+
+                if (
+                    any(actor.website.websub for actor in self.config.actors.values())
+                    and self.db.count_active_subscriptions() > 0
+                ):
+                    # The pushes can be received by another process, which can't wake this thread up.
+                    wait = min(wait, PUSH_CHECK_INTERVAL)
+
+                for username, announces in self.backfill_announces.items():
+                    if len(announces) > 0:
+                        wait = min(
+                            wait, self.next_backfill_announce[username] - monotonic()
+                        )
+            else:
+                logging.debug("Another process is the leader, skipping the update.")
+                wait = self.leader.ttl
+
+            self.wake_up.wait(wait)
+            self.wake_up.clear()
+
+        self.executor.shutdown()
+
+    def poll_now(self):
+        """Check all the feeds as soon as possible."""
+        if not self.leader.is_leader:
+            logging.warning("Another process is the leader, it will check the feeds.")
+            return
+
+        logging.info("Checking the feeds now.")
+        for url in self.next_updates:
+            self.next_updates[url] = 0.0
+        self.wake_up.set()
+
+    def notify_push(self):
+        """Process the pushed content as soon as possible."""
+        self.wake_up.set()
+
+    def stop(self):
+        """Stop the thread, after the current update if there is one."""
+        self.stopped.set()
+        self.wake_up.set()
+        self.join()
+
+    def get_due_feeds(self) -> [Feed]:
+        now = monotonic()
+        return [
+            feed
+            for feed in self.config.feeds.values()
+            if self.next_updates[feed.url] <= now
+        ]
+
+    def update(self, feeds: [Feed] = None) -> [model.Message]:
+        """Fetch the given feeds (by default, the ones that are due) concurrently, along with the pushed contents,
+        and save the new and modified entries of each actor in the order they were published.
+        """
+        if feeds is None:
+            feeds = self.get_due_feeds()
+
+        pushed_updates = self.get_pushed_updates()
+
+        if len(feeds) == 0 and len(pushed_updates) == 0:
+            return []
+
+        logging.info(
+            f"Update started for {len(feeds)} feed(s) and {len(pushed_updates)} push(es)"
+        )
+
+        fetched_updates = list(self.executor.map(self.fetch, feeds))
+        updates = [update for update in fetched_updates if update] + pushed_updates
+
+        messages = []
+        for actor in self.config.actors.values():
+            actor_updates = [update for update in updates if update.feed.actor is actor]
+            if len(actor_updates) > 0:
+                messages.extend(self.publish_updates(actor, actor_updates))
+
+        changed_feeds = {update.feed.url for update in updates if update.changed}
+        for feed, update in zip(feeds, fetched_updates):
+            subscribed = feed.actor.website.websub and self.update_subscription(
+                feed, update
             )
-            i = 0
+            self.schedule(feed, feed.url in changed_feeds, subscribed)
 
-            # we make smaller sleeps to prevent the thread being stuck when the app is stopped.
-            while not self.stop and i < self.config.website.update_freq * 60:
-                sleep(0.1)
-                i += 0.1
+        return messages
 
-    def get_inboxes(self):
-        for follower in self.db.get_followers():
-            actor = activitypub.get_actor(follower)
+    def publish_updates(self, actor: Actor, updates: [FeedUpdate]) -> [model.Message]:
+        """Save the new and modified entries of the feeds of the actor, and return the messages to send."""
+        last_dt = self.db.get_last_note_datetime(actor)
+        # On an empty outbox, the history of the feeds is imported without flooding the followers.
+        backfill = last_dt is None
 
-            if actor is None:
-                logging.warning(
-                    f"Could not get inbox for user {actor}, they won't receive the message."
+        entries = []
+        # The publication dates and UUIDs of the messages, to send them in the order of the entries.
+        messages = []
+        published_notes = {}
+        changed_feeds = set()
+        read_updates = []
+        for update in updates:
+            try:
+                new_entries = self.get_new_entries(update, last_dt)
+                if update.streaming:
+                    # The entries are published as they are read, so a huge feed is never loaded in memory,
+                    # even when all its entries are new.
+                    while batch := list(islice(new_entries, PUBLISH_BATCH_SIZE)):
+                        messages.extend(
+                            self.publish_batch(actor, batch, published_notes)
+                        )
+                        changed_feeds.add(update.feed.url)
+                else:
+                    entries.extend(new_entries)
+                read_updates.append(update)
+            except (
+                ElementTree.ParseError,
+                requests.RequestException,
+                FeedTooLargeException,
+            ) as e:
+                # Only the streamed feeds can fail here, as they are read while their entries are processed.
+                logging.error(f"Could not read the feed {update.feed.url}: {e}")
+            finally:
+                update.close()
+        updates = read_updates
+
+        # The other feeds are merged, so their notes are published in the order of the entries.
+        entries.sort(key=lambda entry: entry.published)
+        changed_feeds.update(entry.feed for entry in entries)
+
+        # The entries are committed in batches, which is much faster than one by one when there are many of them,
+        # without holding the lock of the database long enough to block the other processes.
+        for start in range(0, len(entries), PUBLISH_BATCH_SIZE):
+            messages.extend(
+                self.publish_batch(
+                    actor, entries[start : start + PUBLISH_BATCH_SIZE], published_notes
                 )
-                continue
+            )
 
-            yield actor["inbox"]
+        messages.sort(key=lambda message: message[0])
+        message_uuids = [uuid for _, uuid in messages]
 
-    def update(self):
-        logging.info("Update started")
+        with self.db.transaction():
+            for update in updates:
+                # The feed state is saved with the entries, so they are not lost if something fails.
+                url = update.feed.url
+                for entry_id, entry_hash, note_uuid in update.indexed_entries:
+                    self.db.set_entry(url, entry_id, entry_hash, note_uuid)
 
-        last_dt = self.db.get_last_note_datetime()
-        if last_dt is not None:
-            logging.debug(f"Last known article on {last_dt.isoformat()}.")
-        else:
-            logging.debug("No article known, fetching all the articles.")
+                if not update.pushed:
+                    self.db.set_metadata(f"feed_etag:{url}", update.response.etag)
+                    self.db.set_metadata(
+                        f"feed_last_modified:{url}", update.response.last_modified
+                    )
+                if update.newest_entry_dt is not None:
+                    self.db.set_metadata(
+                        f"feed_last_published:{url}",
+                        update.newest_entry_dt.timestamp(),
+                    )
+
+        for update in updates:
+            update.changed = update.feed.url in changed_feeds
+
+        logging.info(
+            f"Update finished for {actor.preferred_username}: {len(message_uuids)} new or modified entries"
+        )
+
+        if len(message_uuids) > 0 and self.config.export is not None:
+            self.export_pending = True
 
-        feed = feedparser.parse(self.config.website.feed, sanitize_html=True)
+        if backfill and len(message_uuids) > 0:
+            announced = actor.website.backfill_announce
+            newest = message_uuids[-announced:] if announced > 0 else []
+            logging.info(
+                f"First import: {len(message_uuids)} entries added to the outbox of {actor.preferred_username}, "
+                f"{len(newest)} of them will be announced."
+            )
+            self.backfill_announces[actor.preferred_username].extend(
+                self.db.get_message(uuid) for uuid in newest
+            )
+            return []
+
+        return [self.db.get_message(uuid) for uuid in message_uuids]
+
+    def publish_batch(
+        self, actor: Actor, batch: [FeedEntry], published_notes: {str: str}
+    ) -> [tuple[datetime, UUID]]:
+        """Save the entries in one transaction, and return the publication dates and UUIDs of their messages.
+        The notes are rendered before the transaction, which is then short.
+        published_notes maps the IDs of the entries already published in this update to their notes, and is completed.
+        """
+        for entry in batch:
+            if entry.id not in published_notes:
+                self.render(actor, entry)
 
         messages = []
+        with self.db.transaction():
+            for entry in batch:
+                if entry.id in published_notes:
+                    # The same entry can be in several feeds: it is published once, and indexed in the other feeds.
+                    self.db.set_entry(
+                        entry.feed, entry.id, entry.hash, published_notes[entry.id]
+                    )
+                    continue
 
-        for item in feed.entries:
-            if "published" in item:
-                published = item.published
-            else:
-                published = item.updated
+                messages.append((entry.published, self.publish(actor, entry)))
+                published_notes[entry.id] = entry.note_uuid
+
+        return messages
+
+    def schedule(self, feed: Feed, changed: bool, subscribed: bool = False):
+        if subscribed:
+            # The new entries are pushed, the polling is only a fallback.
+            interval = feed.max_update_freq * 60
+        elif changed:
+            interval = feed.update_freq * 60
+        else:
+            interval = min(
+                self.intervals[feed.url] * BACKOFF_FACTOR, feed.max_update_freq * 60
+            )
+
+        self.intervals[feed.url] = interval
+        self.next_updates[feed.url] = monotonic() + interval
+        logging.debug(
+            f"Feed {feed.url} will be checked again in {interval / 60:.1f} min"
+        )
+
+    def update_subscription(self, feed: Feed, update: Optional[FeedUpdate]) -> bool:
+        """Subscribe to the WebSub hub of the feed, or renew the subscription when it is about to expire.
+        Returns True if the subscription is active.
+        """
+        subscription = self.db.get_feed_subscription(feed.url)
 
-            if feed.version.startswith("atom"):
-                published = datetime.fromisoformat(published)
-            elif feed.version.startswith("rss"):
-                published = parsedate_to_datetime(published)
+        if update is not None:
+            hub, topic = websub.find_hub(
+                update.parsed.feed.get("links", []), update.response.headers
+            )
+            if hub is None:
+                if subscription is not None:
+                    logging.info(f"Feed {feed.url} does not advertise a hub anymore.")
+                    self.db.delete_subscription(subscription[0])
+                return False
+            topic = topic if topic is not None else feed.url
+        elif subscription is not None:
+            _, hub, topic, _ = subscription
+        else:
+            return False
 
-            if published.tzinfo is None:
-                # If naive, consider UTC
-                published = published.replace(tzinfo=timezone.utc)
+        if websub.needs_subscription(subscription, hub, topic):
+            websub.subscribe(self.config, self.db, feed, hub, topic)
+            subscription = self.db.get_feed_subscription(feed.url)
 
-            if last_dt is not None and published <= last_dt:
+        expiration = subscription[3]
+        return expiration is not None and expiration > datetime.now(tz=timezone.utc)
+
+    def get_pushed_updates(self) -> [FeedUpdate]:
+        feeds = self.config.feeds
+        updates = []
+
+        for url, content, content_type in self.db.pop_pushes():
+            if url not in feeds:
                 continue
 
-            logging.debug(
-                f'New article: "{item.title}", published on {published.isoformat()} ({item.link})'
+            response = FeedResponse(content, {"content-type": content_type or ""})
+            updates.append(self.parse(feeds[url], response, 0.0, pushed=True))
+
+        return updates
+
+    def fetch(self, feed: Feed) -> Optional[FeedUpdate]:
+        """Download and parse the feed. Returns None if it could not be fetched or has not changed."""
+        start = perf_counter()
+        try:
+            website = feed.actor.website
+            response = self.fetcher.fetch(
+                feed.url,
+                website.fetch_timeout,
+                website.max_feed_size * 1024 * 1024,
+                self.db.get_metadata(f"feed_etag:{feed.url}"),
+                self.db.get_metadata(f"feed_last_modified:{feed.url}"),
+                stream=feed.streaming,
             )
+        except (requests.RequestException, OSError, FeedTooLargeException) as e:
+            logging.error(f"Could not fetch the feed {feed.url}: {e}")
+            return None
+        fetch_duration = perf_counter() - start
+        metrics.feed_fetch_duration.observe(fetch_duration, feed.url)
+        # The server answers 304 when the feed has not changed since the last fetch.
+        metrics.cache_requests.inc("feed", "miss" if response is not None else "hit")
 
-            if "tags" in item:
-                hashtags, tags = self.make_tags(tag["label"] for tag in item.tags)
-            else:
-                hashtags, tags = "", []
-
-            message = self.parse_hashtags(
-                self.config.message.format.format(
-                    title=item.title if "title" in item else "",
-                    url=item.link if "link" in item else "",
-                    published=published,
-                    summary=item.summary if "summary" in item else "",
-                    author=item.author if "author" in item else "",
-                    tags=hashtags,
-                )
+        if response is None:
+            logging.info(
+                f"Feed {feed.url} not modified (fetched in {fetch_duration:.3f}s)"
             )
+            return None
+
+        return self.parse(feed, response, fetch_duration)
 
-            note, note_uuid = self.db.insert_note(
-                message, published, item.link, tags=tags
+    def parse(
+        self,
+        feed: Feed,
+        response: FeedResponse,
+        fetch_duration: float,
+        pushed: bool = False,
+    ) -> FeedUpdate:
+        if response.content is None:
+            logging.info(
+                f"Feed {feed.url} opened in {fetch_duration:.3f}s, its entries are parsed while it is read"
             )
-            logging.debug("Note saved: %s" % note_uuid)
-            message = self.db.insert_message(note_uuid)
-            logging.debug("Message saved: %s" % message.id)
+            website = feed.actor.website
+            parsed = StreamingFeed(
+                response.chunks,
+                feed.url,
+                website.max_streamed_feed_size * 1024 * 1024,
+                website.max_streamed_entries,
+            )
+            return FeedUpdate(feed, response, parsed, fetch_duration, 0.0, pushed)
 
-            messages.append(message)
+        start = perf_counter()
+        parsed = feedparser.parse(
+            response.content,
+            sanitize_html=True,
+            response_headers={
+                "content-location": feed.url,
+                "content-type": response.headers.get("content-type", ""),
+            },
+        )
+        parse_duration = perf_counter() - start
+        metrics.feed_parse_duration.observe(parse_duration, feed.url)
 
-        logging.info("Update finished")
+        if pushed:
+            logging.info(f"Feed {feed.url} pushed, parsed in {parse_duration:.3f}s")
+        else:
+            logging.info(
+                f"Feed {feed.url} fetched in {fetch_duration:.3f}s, parsed in {parse_duration:.3f}s"
+            )
 
-        return messages
+        return FeedUpdate(
+            feed, response, parsed, fetch_duration, parse_duration, pushed
+        )
+
+    def get_new_entries(
+        self, update: FeedUpdate, last_note_dt: Optional[datetime]
+    ) -> Iterator[FeedEntry]:
+        """Yield the entries that are new or have changed since the last update.
+        The known entries are recognized by their fingerprint, before any other processing.
+        A streamed feed is read while the entries are iterated.
+        """
+        feed = update.parsed
 
-    def make_tags(self, tags: [str]) -> (str, [str]):
-        formatter = self.config.message.get_tags_formatter()
+        # If the feed has never been read, only take the entries newer than the last known note,
+        # so adding a feed does not flood the followers with its whole history.
+        first_read = (
+            self.db.get_metadata(f"feed_last_published:{update.feed.url}") is None
+        )
+
+        known_in_a_row = 0
+        read = 0
+        feed_entries = iter(feed.entries)
+
+        # The entries are processed by batches, so a streamed feed is not loaded in memory all at once.
+        while batch := list(islice(feed_entries, ENTRIES_BATCH_SIZE)):
+            read += len(batch)
+            items = [(get_entry_id(item), item) for item in batch]
+            known_entries = self.db.get_entries(
+                [entry_id for entry_id, _ in items if entry_id is not None],
+                [feed.url for feed in update.feed.actor.website.feeds],
+            )
+
+            for entry_id, item in items:
+                if entry_id is None:
+                    logging.warning("Ignoring an entry with no link nor ID.")
+                    continue
+
+                entry_hash = get_entry_hash(item)
+                known_in_feeds = known_entries.get(entry_id, {})
+                known_entry = known_in_feeds.get(update.feed.url)
+
+                if known_entry is not None and known_entry[0] == entry_hash:
+                    known_in_a_row += 1
+                    if update.streaming and known_in_a_row >= KNOWN_ENTRIES_TO_STOP:
+                        # The feeds list their newest entries first: the next ones are known too.
+                        logging.info(
+                            f"Feed {update.feed.url} read up to its known entries ({read} entries read)"
+                        )
+                        return
+                    continue
+
+                known_in_a_row = 0
+
+                if known_entry is None and len(known_in_feeds) > 0:
+                    # Already known from another feed, or indexed before the feeds were: it is not a new entry.
+                    notes = [note for _, note in known_in_feeds.values() if note]
+                    update.indexed_entries.append(
+                        (entry_id, entry_hash, notes[0] if notes else None)
+                    )
+                    continue
+
+                if known_entry is not None:
+                    known_hash, note_uuid = known_entry
+
+                    if known_hash is None or note_uuid is None:
+                        # Never published: just remember its fingerprint.
+                        update.indexed_entries.append((entry_id, entry_hash, note_uuid))
+                        continue
+
+                    logging.debug(
+                        f'Modified article: "{item.get("title")}" ({entry_id})'
+                    )
+                    yield FeedEntry(
+                        update.feed.url,
+                        entry_id,
+                        entry_hash,
+                        self.get_published(feed, item),
+                        item,
+                        note_uuid,
+                    )
+                    continue
+
+                published = self.get_published(feed, item)
+
+                if update.newest_entry_dt is None or published > update.newest_entry_dt:
+                    update.newest_entry_dt = published
+
+                if (
+                    first_read
+                    and last_note_dt is not None
+                    and published <= last_note_dt
+                ):
+                    update.indexed_entries.append((entry_id, entry_hash, None))
+                    continue
+
+                logging.debug(
+                    f'New article: "{item.get("title")}", published on {published.isoformat()} ({entry_id})'
+                )
+                yield FeedEntry(update.feed.url, entry_id, entry_hash, published, item)
+
+        if update.streaming:
+            logging.info(f"Feed {update.feed.url} read entirely ({read} entries)")
+
+    @staticmethod
+    def get_published(
+        feed: feedparser.FeedParserDict, item: feedparser.FeedParserDict
+    ) -> datetime:
+        if "published" in item:
+            published = item.published
+        else:
+            published = item.updated
+
+        if feed.version.startswith("atom"):
+            published = datetime.fromisoformat(published)
+        elif feed.version.startswith("rss"):
+            published = parsedate_to_datetime(published)
+
+        if published.tzinfo is None:
+            # If naive, consider UTC
+            published = published.replace(tzinfo=timezone.utc)
+
+        return published
+
+    def render(self, actor: Actor, entry: FeedEntry):
+        """Make the note of the entry, in Markdown and in HTML."""
+        item = entry.item
+        hashtags, tags = self.make_tags(actor, get_tag_labels(item))
+
+        content, tags = self.parse_hashtags(
+            actor.message.format.format(
+                title=item.title if "title" in item else "",
+                url=item.link if "link" in item else "",
+                published=entry.published,
+                summary=item.summary if "summary" in item else "",
+                author=item.author if "author" in item else "",
+                tags=hashtags,
+            ),
+            tags,
+        )
+
+        entry.content = content
+        entry.tags = tags
+        entry.html = parse_markdown(content)
+
+    def publish(self, actor: Actor, entry: FeedEntry) -> UUID:
+        """Save the note of the entry and the message announcing it, and return the UUID of the message.
+        A modified entry updates its existing note and is announced with an Update message.
+        """
+        if entry.html is None:
+            self.render(actor, entry)
+
+        if entry.note_uuid is not None:
+            note_uuid = entry.note_uuid
+            self.db.update_note(
+                note_uuid,
+                entry.content,
+                datetime.now(tz=timezone.utc),
+                tags=entry.tags,
+                html=entry.html,
+            )
+            logging.debug("Note updated: %s" % note_uuid)
+            message_uuid = self.db.insert_message(note_uuid, "Update")
+        else:
+            note_uuid = self.db.insert_note(
+                actor,
+                entry.content,
+                entry.published,
+                entry.item.link,
+                tags=entry.tags,
+                html=entry.html,
+            )
+            logging.debug("Note saved: %s" % note_uuid)
+            message_uuid = self.db.insert_message(note_uuid)
+            entry.note_uuid = note_uuid
+
+        logging.debug("Message saved: %s" % message_uuid)
+        self.db.set_entry(entry.feed, entry.id, entry.hash, note_uuid)
+
+        return message_uuid
+
+    def make_tags(self, actor: Actor, tags: [str]) -> (str, [model.Tag]):
+        formatter = actor.message.get_tags_formatter()
 
         hashtags_in_msg = []
         tags_list = []
         for tag in tags:
             formatted_tag = formatter(tag)
             hashtags_in_msg.append(f"#{formatted_tag}")
-            tags_list.append(formatted_tag)
+            tags_list.append(model.Tag.make(self.config, formatted_tag))
 
         return " ".join(hashtags_in_msg), tags_list
 
-    def parse_hashtags(self, msg: str) -> str:
-        new_msg = msg
-        for hashtag in find_hashtags(msg):
-            new_msg = new_msg.replace(
-                f"#{hashtag}", f"[#{hashtag}](https://{self.config.url}/tags/{hashtag})"
-            )
+    def parse_hashtags(self, msg: str, tags: [model.Tag] = None) -> (str, [model.Tag]):
+        """Link the hashtags and the mentions of the message in a single pass.
+        Returns the message and the given tags, completed with the ones found in the message.
+        """
+        msg, found = link_tags(msg, f"https://{self.config.url}/tags")
+
+        tags = list(tags or [])
+        names = {tag.name for tag in tags}
+        for tag_type, name, href in found:
+            if name not in names:
+                tags.append(model.Tag(type=tag_type, name=name, href=href))
+                names.add(name)
 
-        return new_msg
+        return msg, tags
@@ -2,11 +2,47 @@ import json
 
 from datetime import datetime
 from typing import Any
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class ActivityJsonEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Any:
         if isinstance(o, datetime):
             return o.isoformat()
+        if isinstance(o, BaseModel):
+            return dict(o)
 
         return o
+
+
+def orjson_default(o: Any) -> Any:
+    # orjson already handles the datetimes, this is only a safety net for their subclasses.
+    if isinstance(o, datetime):
+        return o.isoformat()
+    # The models nested in a document which was converted with dict(), like the tags of a note.
+    if isinstance(o, BaseModel):
+        return dict(o)
+
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def encode_json(content: Any) -> bytes:
+    """Serialize the content to compact UTF-8 JSON.
+    orjson is used when it is installed; for the documents f2ap makes, the output is the same as with the standard library.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=orjson_default)
+
+    return json.dumps(
+        content,
+        cls=ActivityJsonEncoder,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
@@ -0,0 +1,60 @@
+import logging
+import sqlite3
+
+from threading import Thread, Event
+from uuid import uuid4
+
+from .data import Database
+
+LEADER_LOCK = "leader"
+
+LEADER_LOCK_TTL = 60
+
+
+class LeaderThread(Thread):
+    """Elect the process that runs the background tasks, when several processes share the same database.
+    The leader holds a lock row in the database, that it renews regularly. If it dies, the lock expires
+    and another process takes the lead.
+    """
+
+    def __init__(self, db: Database, ttl: int = LEADER_LOCK_TTL):
+        super().__init__(daemon=True)
+        self.db = db
+        self.ttl = ttl
+        self.owner = str(uuid4())
+        self.elected = Event()
+        self.stopped = Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self.elected.is_set()
+
+    def campaign(self):
+        if self.db.acquire_lock(LEADER_LOCK, self.owner, self.ttl):
+            if not self.is_leader:
+                logging.info("This process is now the leader.")
+            self.elected.set()
+        elif self.is_leader:
+            logging.warning("This process is not the leader anymore.")
+            self.elected.clear()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.campaign()
+            except sqlite3.Error as e:
+                # The lock may expire before the next renewal, so this process can't consider itself the leader.
+                logging.error(f"Could not renew the leader lock: {e}")
+                if self.is_leader:
+                    logging.warning("This process is not the leader anymore.")
+                    self.elected.clear()
+
+            self.stopped.wait(self.ttl / 3)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+        if self.is_leader:
+            self.db.release_lock(LEADER_LOCK, self.owner)
+            self.elected.clear()
@@ -1,41 +1,95 @@
 import re
+import threading
 
-from markdown import markdown as _markdown
-from markdown.preprocessors import Preprocessor
-from markdown.extensions import Extension
+from typing import Optional
+
+from . import profiling
 
 EXT_NL2BR = "markdown.extensions.nl2br"
 EXT_LINKIFY = "mdx_linkify"
 
+# The hashtags and the mentions, and the text that must be left as is, so they are found in a single pass:
+# the Markdown links, the URLs (which may contain a "#" fragment), the HTML tags and the HTML entities.
+TOKEN_PATTERN = re.compile(
+    r"(?P<verbatim>\[[^\]]*\]\([^)]*\)|https?://[^\s<>\"')]+|<[^>]*>|&#?[a-zA-Z0-9]+;)"
+    r"|#(?P<hashtag>[^\s0-9.,;:!?'\"()\[\]<>#-][^\s.,;:!?'\"()\[\]<>#-]*)"
+    r"|@(?P<username>[a-zA-Z0-9_]+)@(?P<domain>[a-z0-9_-]+(?:\.[a-z0-9_-]+)+)"
+)
 
-def find_hashtags(s: str) -> [str]:
-    pattern = re.compile("#([^0-9-][^. -]*)")
-    for tag in pattern.findall(s):
-        yield tag
-
-
-class FediverseTagsParser(Preprocessor):
-    def run(self, lines: list[str]) -> list[str]:
-        pattern = re.compile("@(?P<username>[a-zA-Z0-9_]+)@(?P<domain>[a-z0-9_.-]+)")
-        _lines = []
-
-        for line in lines:
-            for username, domain in pattern.findall(line):
-                actor_id = f"https://{domain}/@{username}"
-                line = line.replace(
-                    f"@{username}@{domain}", f"[@{username}@{domain}]({actor_id})"
-                )
+# Building a Markdown instance and its extensions is much slower than rendering a note,
+# so each thread keeps one instance for each combination of options, and resets it between the renderings.
+_instances = threading.local()
 
-            _lines.append(line)
-
-        return _lines
 
+def find_hashtags(s: str) -> [str]:
+    for match in TOKEN_PATTERN.finditer(s):
+        if match.group("hashtag") is not None:
+            yield match.group("hashtag")
+
+
+def link_tags(
+    text: str, tags_url: Optional[str] = None
+) -> (str, [tuple[str, str, str]]):
+    """Link the mentions of the text, and its hashtags to `{tags_url}/{tag}` if tags_url is given.
+    Returns the text in Markdown, and the tags found as (type, name, href), without duplicates.
+    """
+    parts = []
+    tags = {}
+    end = 0
+
+    for match in TOKEN_PATTERN.finditer(text):
+        hashtag, username = match.group("hashtag"), match.group("username")
+
+        if hashtag is not None and tags_url is not None:
+            name, href = f"#{hashtag}", f"{tags_url}/{hashtag}"
+            tags.setdefault(name, ("Hashtag", name, href))
+        elif username is not None:
+            name = f"@{username}@{match.group('domain')}"
+            href = f"https://{match.group('domain')}/@{username}"
+            tags.setdefault(name, ("Mention", name, href))
+        else:
+            continue
+
+        parts.append(text[end : match.start()])
+        parts.append(f"[{name}]({href})")
+        end = match.end()
+
+    parts.append(text[end:])
+
+    return "".join(parts), list(tags.values())
+
+
+def get_markdown(nl2br: bool, autolink: bool, parse_fediverse_tags: bool):
+    """Returns the Markdown instance of the current thread for the given options.
+    The markdown package is only imported when the first instance is built, as the notes are rendered when they are
+    imported: the processes which only serve them don't need it.
+    """
+    if not hasattr(_instances, "cache"):
+        _instances.cache = {}
+
+    key = (nl2br, autolink, parse_fediverse_tags)
+    md = _instances.cache.get(key)
+
+    if md is None:
+        from markdown import Markdown
+        from .markdown_extension import FediverseExtension
+
+        extensions = []
+
+        if nl2br:
+            extensions.append(EXT_NL2BR)
+        if autolink:
+            extensions.append(EXT_LINKIFY)
+        if parse_fediverse_tags:
+            extensions.append(FediverseExtension())
+
+        md = Markdown(extensions=extensions)
+        _instances.cache[key] = md
 
-class FediverseExtension(Extension):
-    def extendMarkdown(self, md):
-        md.preprocessors.register(FediverseTagsParser(md), "fediverse_tags_parser", 0)
+    return md
 
 
+@profiling.timed("markdown")
 def parse_markdown(
     text: str,
     one_paragraph: bool = False,
@@ -43,22 +97,13 @@ def parse_markdown(
     autolink: bool = True,
     parse_fediverse_tags: bool = True,
 ) -> str:
-    extensions = []
-
-    if nl2br:
-        extensions.append(EXT_NL2BR)
-    if autolink:
-        extensions.append(EXT_LINKIFY)
-    if parse_fediverse_tags:
-        extensions.append(FediverseExtension())
+    md = get_markdown(nl2br, autolink, parse_fediverse_tags)
 
     # Replace the "#" characters with &num; to prevent the markdown package to parse it as a title.
     # See https://github.com/Python-Markdown/markdown/blob/383de86c64101b8d14768d9a247c9efc97d703bd/tests/test_syntax/blocks/test_headers.py#L202-L207
-    md = _markdown(
-        text.replace("#", "&num;").replace("&&num;", "&#"), extensions=extensions
-    )
+    html = md.reset().convert(text.replace("#", "&num;").replace("&&num;", "&#"))
 
     if one_paragraph:
-        md = md.removeprefix("<p>").removesuffix("</p>")
+        html = html.removeprefix("<p>").removesuffix("</p>")
 
-    return md
+    return html
@@ -0,0 +1,14 @@
+from markdown.preprocessors import Preprocessor
+from markdown.extensions import Extension
+
+from .markdown import link_tags
+
+
+class FediverseTagsParser(Preprocessor):
+    def run(self, lines: list[str]) -> list[str]:
+        return [link_tags(line)[0] for line in lines]
+
+
+class FediverseExtension(Extension):
+    def extendMarkdown(self, md):
+        md.preprocessors.register(FediverseTagsParser(md), "fediverse_tags_parser", 0)
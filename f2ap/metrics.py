@@ -0,0 +1,186 @@
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+# The content type of the Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+_metrics = []
+
+
+def format_labels(names: (str,), values: (str,), extra: str = None) -> str:
+    labels = [
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra is not None:
+        labels.append(extra)
+
+    return "{%s}" % ",".join(labels) if len(labels) > 0 else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up, for each combination of its labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: (str,) = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> [str]:
+        with self.lock:
+            values = list(self.values.items())
+
+        return [
+            f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Histogram:
+    """The distribution of observed values, like durations, in cumulative buckets, for each combination of its labels."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: (str,) = (),
+        buckets: (float,) = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # For each combination of labels: the count of each bucket (the last one is +Inf), then the sum.
+        self.values = {}
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels: str):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 2)
+                self.values[labels] = counts
+
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> [str]:
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            for le, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le_label = f'le="{format_value(le)}"'
+                samples.append(
+                    f"{self.name}_bucket{format_labels(self.labels, labels, le_label)} {cumulative}"
+                )
+
+            samples.append(
+                f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(counts[-1])}"
+            )
+            samples.append(
+                f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+            )
+
+        return samples
+
+
+def render() -> str:
+    """Returns all the metrics of the process in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+
+    return "\n".join(lines) + "\n"
+
+
+# The metrics are kept in memory by each process. With several workers, each one exposes its own requests.
+request_duration = Histogram(
+    "f2ap_http_request_duration_seconds",
+    "Duration of the HTTP requests, by route.",
+    ("method", "route"),
+)
+inbox_activities = Counter(
+    "f2ap_inbox_activities_total",
+    "Activities received in the inboxes, by type.",
+    ("type",),
+)
+deliveries = Counter(
+    "f2ap_deliveries_total",
+    "Activities sent to the remote inboxes, by host.",
+    ("host",),
+)
+delivery_failures = Counter(
+    "f2ap_delivery_failures_total",
+    "Activities that could not be delivered, by host.",
+    ("host",),
+)
+delivery_duration = Histogram(
+    "f2ap_delivery_duration_seconds",
+    "Duration of the deliveries, by host.",
+    ("host",),
+)
+feed_fetch_duration = Histogram(
+    "f2ap_feed_fetch_duration_seconds",
+    "Duration of the download of the feeds.",
+    ("feed",),
+)
+feed_parse_duration = Histogram(
+    "f2ap_feed_parse_duration_seconds",
+    "Duration of the parsing of the feeds.",
+    ("feed",),
+)
+query_duration = Histogram(
+    "f2ap_db_query_duration_seconds",
+    "Duration of the SQLite queries, by statement.",
+    ("statement",),
+    QUERY_BUCKETS,
+)
+cache_requests = Counter(
+    "f2ap_cache_requests_total",
+    "Lookups in the caches, by cache and result (hit or miss).",
+    ("cache", "result"),
+)
@@ -1,9 +1,9 @@
-import mimetypes
-from typing import Optional
+from typing import Callable, Optional
 
 from pydantic import BaseModel
 from datetime import datetime
 
+from . import serializers, profiling
 from .markdown import parse_markdown
 from .config import Actor as ConfigActor, Configuration
 
@@ -38,7 +38,11 @@ class Markdown:
         )
 
 
-def activitystream(*additional_contexts: str):
+def activitystream(*additional_contexts: str, omit_none: bool = False):
+    """Declare the model as an ActivityStreams document with its additional JSON-LD contexts.
+    Use serializers.serialize() to get its JSON-ready dict.
+    """
+
     def decorator(cls: type):
         if not issubclass(cls, BaseModel):
             raise TypeError(
@@ -46,37 +50,7 @@ def activitystream(*additional_contexts: str):
                 % (cls.__name__, BaseModel.__name__)
             )
 
-        cls.old_dict = cls.dict
-
-        def new_dict(
-            self,
-            *,
-            include=None,
-            exclude=None,
-            by_alias=False,
-            skip_defaults=None,
-            exclude_unset=False,
-            exclude_defaults=False,
-            exclude_none=False,
-        ):
-            d = {
-                "@context": ["https://www.w3.org/ns/activitystreams"]
-                + list(additional_contexts)
-            }
-            for key, value in self.old_dict(
-                include=include,
-                exclude=exclude,
-                by_alias=by_alias,
-                skip_defaults=skip_defaults,
-                exclude_unset=exclude_unset,
-                exclude_defaults=exclude_defaults,
-                exclude_none=exclude_none,
-            ).items():
-                d[key] = value
-
-            return d
-
-        cls.dict = new_dict
+        serializers.register(cls, additional_contexts, omit_none)
         return cls
 
     return decorator
@@ -89,15 +63,7 @@ class File(BaseModel):
 
 
 class ImageFile(File):
-    @classmethod
-    def from_file(cls, path: str, url: str):
-        file_type, _ = mimetypes.guess_type(path, strict=True)
-        if file_type.split("/")[0] != "image":
-            raise TypeError(
-                f'Invalid file type for file "{path}". Check it is a valid image.'
-            )
-
-        return cls(type="Image", mediaType=file_type, url=url)
+    type: str = "Image"
 
 
 class Attachment(BaseModel):
@@ -136,31 +102,33 @@ class Actor(BaseModel):
 
     @classmethod
     def make_attachments(cls, attachments: {str: str}) -> list[Attachment]:
+        """Make the attachments from their name and their value, already in HTML."""
         l = []
         for key, value in attachments.items():
-            l.append(PropertyValueAttachment(key, str(Markdown(value))))
+            l.append(PropertyValueAttachment(key, value))
 
         return l
 
     @classmethod
+    @profiling.timed("model")
     def make(cls, actor: ConfigActor):
         return cls(
             id=actor.id,
-            url=actor.config.website.url,
+            url=actor.website.url,
             preferredUsername=actor.preferred_username,
             name=actor.display_name,
-            summary=str(Markdown(actor.summary)),
+            summary=actor.summary_html,
             icon=(
-                ImageFile.from_file(actor.avatar, f"{actor.id}/avatar")
+                ImageFile(mediaType=actor.avatar_type, url=f"{actor.id}/avatar")
                 if actor.avatar is not None
                 else None
             ),
             image=(
-                ImageFile.from_file(actor.header, f"{actor.id}/header")
+                ImageFile(mediaType=actor.header_type, url=f"{actor.id}/header")
                 if actor.header is not None
                 else None
             ),
-            attachment=cls.make_attachments(actor.attachments),
+            attachment=cls.make_attachments(actor.attachments_html),
             following=f"{actor.id}/following",
             followers=f"{actor.id}/followers",
             inbox=f"{actor.id}/inbox",
@@ -173,19 +141,30 @@ class Actor(BaseModel):
         )
 
 
+class Tag(BaseModel):
+    type: str = "Hashtag"
+    href: str
+    name: str
+
+    @classmethod
+    def make(cls, config: Configuration, name: str):
+        return cls(name=f"#{name}", href=f"https://{config.url}/tags/{name}")
+
+
 @activitystream()
 class Note(BaseModel):
     id: str
     type: str = "Note"
     inReplyTo: Optional[str] = None
     published: datetime
+    updated: Optional[datetime] = None
     url: str
     attributedTo: str
     to: list[str] = [W3C_ACTIVITYSTREAMS_PUBLIC]
     cc: list[str] = []
     content: str
     attachment: list[File] = []
-    tag: list[str] = []
+    tag: list[Tag] = []
 
 
 @activitystream()
@@ -199,7 +178,7 @@ class Message(BaseModel):
     object: Note
 
 
-@activitystream()
+@activitystream(omit_none=True)
 class OrderedCollection(BaseModel):
     type: str = "OrderedCollection"
     totalItems: int
@@ -213,9 +192,29 @@ class OrderedCollection(BaseModel):
     def make(
         cls, endpoint: str, items: [str], page: int = None, items_per_page: int = 10
     ):
+        return cls.make_indexed(
+            endpoint,
+            len(items),
+            lambda offset, limit: items[offset : offset + limit],
+            page,
+            items_per_page,
+        )
+
+    @classmethod
+    def make_indexed(
+        cls,
+        endpoint: str,
+        total_items: int,
+        get_items: Callable[[int, int], list],
+        page: int = None,
+        items_per_page: int = 10,
+    ):
+        """Make the collection, or its page, without loading all its items.
+        get_items(offset, limit) returns the items of a page.
+        """
         first_page = 1
-        last_page = int(len(items) / items_per_page) + (
-            1 if len(items) % items_per_page > 0 else 0
+        last_page = int(total_items / items_per_page) + (
+            1 if total_items % items_per_page > 0 else 0
         )
 
         if page is None:
@@ -223,9 +222,11 @@ class OrderedCollection(BaseModel):
 
         if page > 0:
             collection_type = "OrderedCollectionPage"
-            first = (page - 1) * items_per_page
-            last = first + items_per_page
-            ordered_items = items[first:last]
+            ordered_items = (
+                get_items((page - 1) * items_per_page, items_per_page)
+                if page <= last_page
+                else []
+            )
 
             if len(ordered_items) == 0:
                 return None
@@ -235,7 +236,7 @@ class OrderedCollection(BaseModel):
 
             return cls(
                 type=collection_type,
-                totalItems=len(items),
+                totalItems=total_items,
                 first=f"{endpoint}?page={first_page}",
                 last=f"{endpoint}?page={last_page}",
                 prev=(
@@ -247,21 +248,11 @@ class OrderedCollection(BaseModel):
                 orderedItems=ordered_items,
             )
 
-        if len(items) > 0:
+        if total_items > 0:
             return cls(
-                totalItems=len(items),
+                totalItems=total_items,
                 first=f"{endpoint}?page={first_page}",
                 last=f"{endpoint}?page={last_page}",
             )
 
         return cls(totalItems=0)
-
-
-class Tag(BaseModel):
-    type: str = "Hashtag"
-    href: str
-    name: str
-
-    @classmethod
-    def make(cls, config: Configuration, name: str):
-        return cls(name=f"#{name}", href=f"https://{config.url}/tags/{name}")
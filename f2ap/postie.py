@@ -1,16 +1,40 @@
 import requests
-import json
 import base64
 import hashlib
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from email.utils import format_datetime
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 
-from . import signature
-from .config import Configuration
-from .json import ActivityJsonEncoder
+from . import signature, metrics
+from .config import Actor
+from .json import encode_json
+
+MAX_CONCURRENT_DELIVERIES = 16
+
+# How long to wait for the remote servers, in seconds.
+DELIVERY_TIMEOUT = 30
+
+
+class DeliveryPool:
+    """The connections and the threads shared by all the actors to talk to the remote servers.
+    The connections to each server are kept alive, and the threads are only started when they are needed.
+    """
+
+    def __init__(self, max_workers: int):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="delivery"
+        )
+
+
+pool = DeliveryPool(MAX_CONCURRENT_DELIVERIES)
 
 
 class DeliveryException(requests.exceptions.HTTPError):
@@ -22,7 +46,7 @@ class DeliveryException(requests.exceptions.HTTPError):
         return f"Got HTTP {self.status_code} status code. Message was: {self.message}"
 
 
-def deliver(config: Configuration, inbox: str, message: dict):
+def deliver(actor: Actor, inbox: str, message: dict):
     parsed_inbox = urlparse(inbox)
 
     if "@context" not in message:
@@ -31,7 +55,9 @@ def deliver(config: Configuration, inbox: str, message: dict):
     logging.debug(f"Sending message to {inbox}:")
     logging.debug(message)
 
-    digest = hashlib.sha256(json.dumps(message, cls=ActivityJsonEncoder).encode())
+    # The body is serialized once, so the digest is always computed on the exact bytes that are sent.
+    body = encode_json(message)
+    digest = hashlib.sha256(body)
     b64digest = base64.b64encode(digest.digest()).decode()
     fdt = datetime.now(tz=timezone.utc)
 
@@ -43,13 +69,21 @@ def deliver(config: Configuration, inbox: str, message: dict):
         "Accept": "application/activity+json",
     }
 
-    headers["Signature"] = signature.sign_headers(config, parsed_inbox.path, headers)
+    headers["Signature"] = signature.sign_headers(actor, parsed_inbox.path, headers)
 
-    req = requests.post(
-        inbox, data=json.dumps(message, cls=ActivityJsonEncoder), headers=headers
-    )
+    host = parsed_inbox.hostname
+    metrics.deliveries.inc(host)
+    try:
+        with metrics.delivery_duration.time(host):
+            req = pool.session.post(
+                inbox, data=body, headers=headers, timeout=DELIVERY_TIMEOUT
+            )
+    except requests.RequestException:
+        metrics.delivery_failures.inc(host)
+        raise
 
     try:
         req.raise_for_status()
     except requests.HTTPError:
+        metrics.delivery_failures.inc(host)
         raise DeliveryException(req.status_code, req.content.decode())
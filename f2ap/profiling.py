@@ -0,0 +1,91 @@
+import os
+import cProfile
+import functools
+import logging
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter, time
+from typing import Optional
+
+# The total duration and the number of calls of each span of the current request,
+# or None when the request is not profiled, so the spans cost almost nothing outside of the profiled requests.
+_spans: ContextVar[Optional[dict]] = ContextVar("spans", default=None)
+
+# cProfile can only profile one request at a time.
+_profiler_lock = Lock()
+
+
+@contextmanager
+def collect():
+    """Collect the spans recorded until the end of the block, in the current context and the tasks it starts."""
+    spans = {}
+    token = _spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _spans.reset(token)
+
+
+def record(name: str, duration: float):
+    spans = _spans.get()
+    if spans is not None:
+        total, count = spans.get(name, (0.0, 0))
+        spans[name] = (total + duration, count + 1)
+
+
+def timed(name: str):
+    """Record the duration of each call of the decorated function in the span of the given name."""
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _spans.get() is None:
+                return f(*args, **kwargs)
+
+            start = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(name, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(spans: dict, total: float) -> str:
+    """Make the Server-Timing header of the spans. The durations are in milliseconds, as the header expects."""
+    metrics = [
+        f'{name};dur={duration * 1000:.3f};desc="{count} call(s)"'
+        for name, (duration, count) in spans.items()
+    ]
+    metrics.append(f"total;dur={total * 1000:.3f}")
+
+    return ", ".join(metrics)
+
+
+@contextmanager
+def profile(directory: str, name: str):
+    """Profile the block with cProfile and write the statistics to a file of the directory, to open with pstats.
+    If another block is already being profiled, this one is not.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{int(time() * 1000)}-{name}.prof")
+        profiler.dump_stats(path)
+        logging.debug(f"Profile written to {path}")
+    finally:
+        _profiler_lock.release()
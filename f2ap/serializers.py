@@ -0,0 +1,125 @@
+import typing
+
+from typing import Any, Callable, Optional
+from pydantic import BaseModel
+
+from . import profiling
+
+W3C_ACTIVITYSTREAMS = "https://www.w3.org/ns/activitystreams"
+
+# The JSON-LD contexts of the models serialized as ActivityStreams documents, and their options.
+_documents = {}
+_serializers = {}
+
+
+def register(cls: type, contexts: [str], omit_none: bool = False):
+    """Serialize the model as an ActivityStreams document with the given additional contexts.
+    If omit_none is True, its fields that are None are left out.
+    """
+    _documents[cls] = ([W3C_ACTIVITYSTREAMS] + list(contexts), omit_none)
+
+
+def get_fields(cls: type) -> [str]:
+    # Pydantic 2 lists the fields in model_fields, pydantic 1 in __fields__.
+    fields = getattr(cls, "model_fields", None)
+    if fields is None:
+        fields = cls.__fields__
+
+    return list(fields.keys())
+
+
+def get_model(annotation: Any) -> (Optional[type], bool, bool, bool):
+    """Returns the model of an annotation, whether it is optional, whether it is a list of this model,
+    and whether its values must be inspected at runtime as they may contain models of unknown types.
+    """
+    optional = False
+    args = typing.get_args(annotation)
+
+    if typing.get_origin(annotation) is typing.Union and type(None) in args:
+        optional = True
+        args = [arg for arg in args if arg is not type(None)]
+        annotation = args[0] if len(args) == 1 else Any
+        args = typing.get_args(annotation)
+
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation, optional, False, False
+
+    if annotation is list or typing.get_origin(annotation) is list:
+        item = args[0] if len(args) == 1 else Any
+        if isinstance(item, type) and issubclass(item, BaseModel):
+            return item, optional, True, False
+        return None, optional, False, item is Any
+
+    return None, optional, False, annotation is Any
+
+
+def serialize_value(value: Any) -> Any:
+    """Serialize a value whose type is not known in advance, like the items of a collection."""
+    if isinstance(value, BaseModel):
+        return get_serializer(type(value))(value)
+    if isinstance(value, list):
+        return [serialize_value(item) for item in value]
+
+    return value
+
+
+def compile_serializer(cls: type, document: bool) -> Callable[[BaseModel], dict]:
+    """Generate the function that makes the JSON-ready dict of the model in one pass.
+    The values that are not models are kept as they are: the datetimes are left to the JSON encoder.
+    """
+    contexts, omit_none = (
+        _documents.get(cls, (None, False)) if document else (None, False)
+    )
+    hints = typing.get_type_hints(cls)
+    namespace = {"serialize_value": serialize_value, "contexts": contexts}
+    items = [] if contexts is None else ['"@context": contexts']
+
+    for i, field in enumerate(get_fields(cls)):
+        model, optional, is_list, dynamic = get_model(hints.get(field, Any))
+        value = f"o.{field}"
+
+        if model is not None:
+            namespace[f"serialize_{i}"] = get_serializer(model)
+            if is_list:
+                expression = f"[serialize_{i}(item) for item in {value}]"
+            else:
+                expression = f"serialize_{i}({value})"
+            if optional:
+                expression = f"(None if {value} is None else {expression})"
+        elif dynamic:
+            expression = f"serialize_value({value})"
+        else:
+            expression = value
+
+        items.append(f"{field!r}: {expression}")
+
+    result = "{%s}" % ", ".join(items)
+    if omit_none:
+        result = (
+            f"{{key: value for key, value in {result}.items() if value is not None}}"
+        )
+
+    code = f"def serialize(o):\n    return {result}\n"
+    exec(compile(code, f"<serializer of {cls.__name__}>", "exec"), namespace)
+
+    return namespace["serialize"]
+
+
+def get_serializer(cls: type, document: bool = False) -> Callable[[BaseModel], dict]:
+    """Returns the serializer of the model, compiled on its first use.
+    If document is True, the model is serialized as a top-level document, with its JSON-LD context.
+    """
+    key = (cls, document)
+    serializer = _serializers.get(key)
+
+    if serializer is None:
+        serializer = compile_serializer(cls, document)
+        _serializers[key] = serializer
+
+    return serializer
+
+
+@profiling.timed("serialize")
+def serialize(o: BaseModel) -> dict:
+    """Returns the JSON-ready dict of the model, as a top-level document."""
+    return get_serializer(type(o), document=True)(o)
@@ -1,14 +1,20 @@
 import base64
 
+from functools import lru_cache
 from Crypto.Signature import pkcs1_15
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 
-from .config import Configuration
+from . import profiling
+from .config import Actor
 
+# The public keys of the actors who post to the inbox, most of whom post several times.
+import_public_key = lru_cache(maxsize=1024)(RSA.import_key)
 
+
+@profiling.timed("sign")
 def sign_headers(
-    config: Configuration, request_target: str, headers: dict, http_method: str = "post"
+    actor: Actor, request_target: str, headers: dict, http_method: str = "post"
 ) -> str:
     signed_headers = ["(request-target)"] + list(
         map(lambda s: s.lower(), headers.keys())
@@ -18,8 +24,7 @@ def sign_headers(
     for header in headers:
         to_sign.append(f"{header.lower()}: {headers[header]}")
 
-    key = RSA.import_key(config.actor.private_key)
-    signer = pkcs1_15.new(key)
+    signer = pkcs1_15.new(actor.signing_key)
     hash = SHA256.new()
     hash.update("\n".join(to_sign).encode())
 
@@ -27,7 +32,7 @@ def sign_headers(
 
     return ",".join(
         [
-            f'keyId="{config.actor.key_id}"',
+            f'keyId="{actor.key_id}"',
             'algorithm="rsa-sha256"',
             f'headers="{" ".join(signed_headers)}"',
             f'signature="{signature}"',
@@ -35,6 +40,7 @@ def sign_headers(
     )
 
 
+@profiling.timed("verify")
 def validate_headers(
     public_key: str, headers: dict, request_target: str, http_method: str = "post"
 ):
@@ -59,7 +65,7 @@ def validate_headers(
 
     message = "\n".join(message)
 
-    key = RSA.import_key(public_key)
+    key = import_public_key(public_key)
     verifier = pkcs1_15.new(key)
     hash = SHA256.new()
     hash.update(message.encode())
@@ -0,0 +1,137 @@
+import feedparser
+
+from typing import Iterator
+from xml.etree import ElementTree
+
+ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
+RSS1_NAMESPACE = "http://purl.org/rss/1.0/"
+RDF_NAMESPACE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+
+ATOM_FEED = f"{{{ATOM_NAMESPACE}}}feed"
+ATOM_ENTRY = f"{{{ATOM_NAMESPACE}}}entry"
+ATOM_LINK = f"{{{ATOM_NAMESPACE}}}link"
+RSS1_ITEM = f"{{{RSS1_NAMESPACE}}}item"
+RDF_ROOT = f"{{{RDF_NAMESPACE}}}RDF"
+
+# The version as named by feedparser, and the document the entries are wrapped in to be parsed, for each root element.
+FORMATS = {
+    ATOM_FEED: ("atom10", f'<feed xmlns="{ATOM_NAMESPACE}">{{entry}}</feed>'),
+    "rss": ("rss20", '<rss version="2.0"><channel>{entry}</channel></rss>'),
+    RDF_ROOT: (
+        "rss10",
+        f'<rdf:RDF xmlns:rdf="{RDF_NAMESPACE}" xmlns="{RSS1_NAMESPACE}">{{entry}}</rdf:RDF>',
+    ),
+}
+
+# The elements that contain the entries.
+CONTAINERS = {ATOM_FEED, "channel", RDF_ROOT}
+
+
+class FeedTooLargeException(Exception):
+    pass
+
+
+class StreamingFeed:
+    """Parse a feed entry by entry, while it is downloaded.
+    Each entry is removed from the document once it is parsed, so the memory used does not depend on the size of the feed.
+    It quacks like the result of feedparser.parse(), but its entries are a generator: they are read as they are iterated,
+    and the download stops when the iteration does.
+    Reading the feed raises FeedTooLargeException when it exceeds max_size bytes or max_entries entries.
+    """
+
+    def __init__(
+        self,
+        chunks: Iterator[bytes],
+        url: str,
+        max_size: int = None,
+        max_entries: int = None,
+    ):
+        self.chunks = chunks
+        self.url = url
+        self.max_size = max_size
+        self.max_entries = max_entries
+        # The entries are serialized in UTF-8, whatever the encoding of the feed.
+        self.response_headers = {
+            "content-location": url,
+            "content-type": "application/xml; charset=utf-8",
+        }
+        self.version = ""
+        self.wrapper = None
+        # Only the links of the feed are kept, for the WebSub discovery.
+        self.feed = feedparser.FeedParserDict(links=[])
+        self.entries = self.read_entries()
+
+    def read_entries(self) -> Iterator[feedparser.FeedParserDict]:
+        parser = ElementTree.XMLPullParser(events=("start", "end"))
+        parents = []
+        size = 0
+        count = 0
+
+        try:
+            for chunk in self.chunks:
+                size += len(chunk)
+                if self.max_size is not None and size > self.max_size:
+                    raise FeedTooLargeException(
+                        f"Feed {self.url} is larger than the limit of {self.max_size} bytes."
+                    )
+
+                parser.feed(chunk)
+                # The entries read from a chunk are parsed together, as feedparser is slow to start.
+                elements = []
+
+                for event, element in parser.read_events():
+                    if event == "start":
+                        if len(parents) == 0:
+                            self.set_format(element.tag)
+                        parents.append(element)
+                        continue
+
+                    parents.pop()
+                    parent = parents[-1] if len(parents) > 0 else None
+                    if parent is None or parent.tag not in CONTAINERS:
+                        continue
+
+                    if element.tag in (ATOM_ENTRY, "item", RSS1_ITEM):
+                        count += 1
+                        if self.max_entries is not None and count > self.max_entries:
+                            raise FeedTooLargeException(
+                                f"Feed {self.url} has more than the limit of {self.max_entries} entries."
+                            )
+                        elements.append(
+                            ElementTree.tostring(element, encoding="unicode")
+                        )
+                    elif element.tag == ATOM_LINK:
+                        self.feed.links.append(dict(element.attrib))
+                    else:
+                        continue
+
+                    parent.remove(element)
+
+                if len(elements) > 0:
+                    yield from self.parse_entries(elements)
+
+            parser.close()
+        finally:
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                close()
+
+    def set_format(self, root: str):
+        if root not in FORMATS:
+            raise ElementTree.ParseError(f"Unsupported feed format: {root}")
+
+        self.version, self.wrapper = FORMATS[root]
+
+    def parse_entries(self, elements: [str]) -> [feedparser.FeedParserDict]:
+        document = self.wrapper.format(entry="".join(elements))
+        parsed = feedparser.parse(
+            document.encode(),
+            sanitize_html=True,
+            response_headers=self.response_headers,
+        )
+
+        return parsed.entries
+
+    def close(self):
+        """Stop reading the feed."""
+        self.entries.close()
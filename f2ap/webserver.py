@@ -1,43 +1,90 @@
+import os
+import re
 import logging
 import threading
 
 import uvicorn
 import requests
-import mimetypes
-import json
 import base64
 import hashlib
+import inspect
+import functools
+
+from time import perf_counter, monotonic
 
 from uuid import UUID
-from typing import Union, Any, Optional
-from fastapi import FastAPI, BackgroundTasks
+from typing import Union, Any, Optional, Callable
+from fastapi import FastAPI, BackgroundTasks, Depends, Query
 from fastapi import Request
-from fastapi.responses import Response, JSONResponse, RedirectResponse
+from fastapi.responses import Response, JSONResponse, FileResponse
 from pydantic import BaseModel
-
-from . import postie, signature, activitypub
-from .config import Configuration
+from starlette.datastructures import Headers
+from starlette.routing import compile_path
+from starlette.types import Scope, Receive, Send
+
+from . import (
+    postie,
+    signature,
+    activitypub,
+    cache,
+    compression,
+    websub,
+    metrics,
+    profiling,
+)
+from .config import Configuration, Actor as ConfigActor
 from .data import Database
 from .model import OrderedCollection, Actor
-from .json import ActivityJsonEncoder
+from .json import encode_json
+from .serializers import serialize
 
 ACTIVITY_JSON_MIME_TYPE = "application/activity+json"
 
 W3C_ACTIVITY_STREAM = "https://www.w3.org/ns/activitystreams"
 
+FOLLOW_PENDING_FLAG = "follow_pending"
+
+# How often the web server checks if the users must be followed, in seconds: the flag can be set again by a poller
+# which restarted, while the web server kept running.
+FOLLOW_CHECK_INTERVAL = 60
+
+# The activities counted by type in the metrics. The other ones are counted together, so the senders can't make them grow.
+INBOX_ACTIVITY_TYPES = {
+    "Accept",
+    "Add",
+    "Announce",
+    "Block",
+    "Create",
+    "Delete",
+    "Flag",
+    "Follow",
+    "Like",
+    "Move",
+    "Reject",
+    "Remove",
+    "Undo",
+    "Update",
+}
+
 
 class FollowThread(threading.Thread):
-    def __init__(self, config: Configuration, users: [str]):
+    def __init__(self, config: Configuration):
         super().__init__()
         self.config = config
-        self.users = users
 
     def run(self) -> None:
-        activitypub.follow_users(self.config, self.users)
+        for actor in self.config.actors.values():
+            activitypub.follow_users(actor, actor.following)
 
 
 class ActivityJSONResponse(JSONResponse):
-    """A special version of JSONResponse, with the good media type."""
+    """A special version of JSONResponse, with the good media type.
+    Successful responses get an ETag computed from their content, and conditional requests are answered with a 304.
+    Large documents are compressed if the client accepts it. With cache_compressed, the compressed versions are
+    kept by ETag, for the documents which are requested many times without changing, like the notes.
+    """
+
+    media_type = ACTIVITY_JSON_MIME_TYPE
 
     def __init__(
         self,
@@ -45,20 +92,57 @@ class ActivityJSONResponse(JSONResponse):
         status_code: int = 200,
         headers: {str: str} = None,
         background: BackgroundTasks = None,
+        cache_compressed: bool = False,
     ):
-        super().__init__(
-            content, status_code, headers, "application/activity+json", background
-        )
+        super().__init__(content, status_code, headers, self.media_type, background)
+        self.cache_compressed = cache_compressed
+
+        if self.status_code == 200:
+            self.headers.setdefault("etag", cache.make_etag(self.body))
 
+    @profiling.timed("json")
     def render(self, content: Any) -> bytes:
-        return json.dumps(
-            content,
-            cls=ActivityJsonEncoder,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-        ).encode("utf-8")
+        return encode_json(content)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.status_code != 200:
+            await super().__call__(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = None
+
+        if len(self.body) >= compression.MINIMUM_SIZE:
+            self.headers["vary"] = "Accept-Encoding"
+            encoding = compression.choose_encoding(
+                request_headers.get("accept-encoding")
+            )
+
+        if encoding is not None:
+            # Each encoding is a different representation, so it needs its own ETag.
+            etag = self.headers["etag"]
+            self.headers["etag"] = cache.make_etag_variant(etag, encoding)
+
+        if scope["method"] in ["GET", "HEAD"] and cache.is_not_modified(
+            request_headers, self.headers
+        ):
+            await cache.not_modified(self.headers)(scope, receive, send)
+            return
+
+        if encoding is not None:
+            if self.cache_compressed:
+                self.body = compression.compressed_cache.get(etag, self.body, encoding)
+            else:
+                self.body = compression.compress(self.body, encoding)
+
+            self.headers["content-encoding"] = encoding
+            self.headers["content-length"] = str(len(self.body))
+
+        await super().__call__(scope, receive, send)
+
+
+class JRDResponse(ActivityJSONResponse):
+    media_type = "application/jrd+json"
 
 
 def respond(o: BaseModel, status_if_none: int = 404) -> Union[BaseModel, Response]:
@@ -68,23 +152,112 @@ def respond(o: BaseModel, status_if_none: int = 404) -> Union[BaseModel, Respons
     return o
 
 
+def image_response(
+    request: Request, path: str, media_type: str, max_age: int
+) -> Response:
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        logging.error(f"Image {path} does not exist.")
+        return Response(status_code=404)
+
+    # The file is sent with sendfile when the server supports it, so it never gets loaded in memory.
+    response = FileResponse(
+        path,
+        media_type=media_type,
+        stat_result=stat_result,
+        headers={"Cache-Control": cache.cache_control(max_age)},
+    )
+
+    if cache.is_not_modified(request.headers, response.headers):
+        return cache.not_modified(response.headers)
+
+    return response
+
+
+def set_cache_control(max_age: int):
+    def dependency(response: Response):
+        response.headers["Cache-Control"] = cache.cache_control(max_age)
+
+    return dependency
+
+
+def make_webfinger(actor: ConfigActor) -> dict:
+    return {
+        "subject": f"acct:{actor.preferred_username}@{actor.config.url}",
+        "links": [
+            {
+                "rel": "self",
+                "type": "application/activity+json",
+                "href": actor.id,
+            }
+        ],
+    }
+
+
+def find_webfinger_actor(config: Configuration, resource: str) -> Optional[ConfigActor]:
+    """Returns the actor of a resource like acct:username@domain."""
+    username, _, domain = resource.removeprefix("acct:").partition("@")
+    if not resource.startswith("acct:") or domain != config.url:
+        return None
+
+    return config.actors.get(username)
+
+
 def get_activitypub_decorator(self: FastAPI):
     def decorator(
         path: str,
-        responds_with: Any = None,
         method: str = "get",
-        ignore_unset: bool = False,
         status_code: int = 200,
+        max_age: Optional[int] = None,
+        cache_compressed: bool = False,
     ):
         def f(coroutine):
+            signature = inspect.signature(coroutine)
+            wants_response = "response" in signature.parameters
+
+            # The models returned by the route are serialized with their compiled serializer rather than by FastAPI,
+            # so the response it is given to set its headers is always requested.
+            @functools.wraps(coroutine)
+            async def endpoint(*args, response: Response, **kwargs):
+                if wants_response:
+                    kwargs["response"] = response
+
+                result = await coroutine(*args, **kwargs)
+                if not isinstance(result, BaseModel):
+                    return result
+
+                return ActivityJSONResponse(
+                    serialize(result),
+                    status_code=response.status_code or status_code,
+                    headers=response.headers,
+                    cache_compressed=cache_compressed,
+                )
+
+            if not wants_response:
+                endpoint.__signature__ = signature.replace(
+                    parameters=[
+                        *signature.parameters.values(),
+                        inspect.Parameter(
+                            "response",
+                            inspect.Parameter.KEYWORD_ONLY,
+                            annotation=Response,
+                        ),
+                    ]
+                )
+
             return self.add_api_route(
                 path,
                 status_code=status_code,
-                endpoint=coroutine,
+                endpoint=endpoint,
                 methods=[method],
                 response_class=ActivityJSONResponse,
-                response_model_exclude_unset=ignore_unset,
-                response_model=responds_with,
+                response_model=None,
+                dependencies=(
+                    [Depends(set_cache_control(max_age))]
+                    if max_age is not None
+                    else None
+                ),
             )
 
         return f
@@ -92,17 +265,14 @@ def get_activitypub_decorator(self: FastAPI):
     return decorator
 
 
-def start_server(
-    config: Configuration, port: int, log_level: str, skip_following: bool = False
-):
+def create_app(config: Configuration, on_push: Callable = None) -> FastAPI:
+    """Build the application.
+    on_push is called when a WebSub hub pushes a feed, if the feeds are updated in the same process.
+    """
     app = FastAPI(docs_url=None)
     app.activitypub = get_activitypub_decorator(app)
     db = Database(config)
-    start_server.following = None
-
-    if skip_following:
-        start_server.following = []
-        logging.debug("Following is disabled.")
+    app.state.next_follow_check = 0.0
 
     @app.middleware("http")
     async def on_request(request: Request, call_next):
@@ -110,11 +280,13 @@ def start_server(
             f"{request.method} {request.url} with headers: {dict(request.headers)}"
         )
 
-        # If the server has just started, follow the users specified in the configuration.
-        if not skip_following and start_server.following is None:
-            start_server.following = []
-            follow_task = FollowThread(config, config.actor.following)
-            follow_task.start()
+        # If the leader has just started, follow the users specified in the configuration.
+        # The flag is set by the leader process and shared by all the workers, so only one of them sends the requests.
+        if app.state.next_follow_check <= monotonic():
+            app.state.next_follow_check = monotonic() + FOLLOW_CHECK_INTERVAL
+            if db.pop_flag(FOLLOW_PENDING_FLAG):
+                follow_task = FollowThread(config)
+                follow_task.start()
 
         # Check if user has asked for a known URL (e.g. the URL of a blog post)
         request_url = str(request.url)
@@ -125,14 +297,78 @@ def start_server(
         note = db.get_note(url=request_url)
         if note is not None:
             logging.debug("Note found!")
-            return ActivityJSONResponse(dict(note))
+            return ActivityJSONResponse(
+                serialize(note),
+                headers={
+                    "Cache-Control": cache.cache_control(config.cache.objects_max_age),
+                    "Last-Modified": cache.http_date(note.updated or note.published),
+                },
+                cache_compressed=True,
+            )
 
         return await call_next(request)
 
-    @app.on_event("shutdown")
-    async def on_stop():
-        if start_server.following is not None:
-            activitypub.unfollow_users(config, start_server.following)
+    if config.metrics is not None:
+
+        @app.middleware("http")
+        async def measure_request(request: Request, call_next):
+            start = perf_counter()
+            response = await call_next(request)
+
+            # The notes served by the middleware above and the unknown URLs have no route.
+            route = request.scope.get("route")
+            metrics.request_duration.observe(
+                perf_counter() - start,
+                request.method,
+                route.path if route is not None else "other",
+            )
+
+            return response
+
+        @app.get("/metrics")
+        async def get_metrics(request: Request) -> Response:
+            if (
+                config.metrics.token is not None
+                and request.headers.get("authorization")
+                != f"Bearer {config.metrics.token}"
+            ):
+                return Response(status_code=401)
+
+            return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    if config.profiling is not None:
+        # The routes to profile with cProfile, with the name of their dumps.
+        profiled_routes = [
+            (compile_path(route)[0], re.sub(r"\W+", "_", route).strip("_") or "root")
+            for route in config.profiling.routes
+        ]
+
+        @app.middleware("http")
+        async def profile_request(request: Request, call_next):
+            dump_name = next(
+                (
+                    f"{request.method}-{name}"
+                    for regex, name in profiled_routes
+                    if regex.match(request.url.path)
+                ),
+                None,
+            )
+
+            start = perf_counter()
+            with profiling.collect() as spans:
+                if dump_name is not None:
+                    with profiling.profile(config.profiling.directory, dump_name):
+                        response = await call_next(request)
+                else:
+                    response = await call_next(request)
+            total = perf_counter() - start
+
+            timing = profiling.server_timing(spans, total)
+            logging.debug(f"{request.method} {request.url.path}: {timing}")
+            if config.profiling.server_timing:
+                response.headers["Server-Timing"] = timing
+
+            return response
 
     @app.get("/robots.txt")
     async def robots() -> Response:
@@ -148,107 +384,123 @@ def start_server(
 
     @app.get("/.well-known/webfinger")
     async def webfinger(resource: Union[str, None]) -> Response:
-        subject = f"acct:{config.actor.preferred_username}@{config.url}"
-        if resource is None or resource != subject:
+        actor = find_webfinger_actor(config, resource) if resource else None
+        if actor is None:
             return Response(status_code=404)
 
-        return JSONResponse(
-            media_type="application/jrd+json",
-            content={
-                "subject": subject,
-                "links": [
-                    {
-                        "rel": "self",
-                        "type": "application/activity+json",
-                        "href": config.actor.id,
-                    }
-                ],
-            },
-        )
+        return JRDResponse(content=make_webfinger(actor))
 
-    @app.activitypub("/actors/{username}")
+    @app.activitypub("/actors/{username}", max_age=config.cache.collections_max_age)
     async def get_actor(username: str):
-        if username != config.actor.preferred_username:
+        actor = config.actors.get(username)
+        if actor is None:
             return Response(status_code=404)
 
-        return respond(Actor.make(config.actor))
+        return respond(Actor.make(actor))
 
     @app.head("/actors/{username}/avatar")
     @app.get("/actors/{username}/avatar")
-    async def get_actor_avatar(username: str) -> Response:
-        if username != config.actor.preferred_username or config.actor.avatar is None:
-            return Response(status_code=404)
-
-        file_type, _ = mimetypes.guess_type(config.actor.avatar)
-
-        if file_type not in ["image/jpeg", "image/png"]:
+    async def get_actor_avatar(username: str, request: Request) -> Response:
+        actor = config.actors.get(username)
+        if actor is None or actor.avatar is None:
             return Response(status_code=404)
 
-        with open(config.actor.avatar, "rb") as file:
-            return Response(file.read(), headers={"Content-Type": file_type})
+        return image_response(
+            request,
+            actor.avatar,
+            actor.avatar_type,
+            config.cache.images_max_age,
+        )
 
     @app.head("/actors/{username}/header")
     @app.get("/actors/{username}/header")
-    async def get_actor_header(username: str) -> Response:
-        if username != config.actor.preferred_username or config.actor.header is None:
+    async def get_actor_header(username: str, request: Request) -> Response:
+        actor = config.actors.get(username)
+        if actor is None or actor.header is None:
             return Response(status_code=404)
 
-        file_type, _ = mimetypes.guess_type(config.actor.header)
-
-        if file_type not in ["image/jpeg", "image/png"]:
-            return Response(status_code=404)
-
-        with open(config.actor.header, "rb") as file:
-            return Response(file.read(), headers={"Content-Type": file_type})
+        return image_response(
+            request,
+            actor.header,
+            actor.header_type,
+            config.cache.images_max_age,
+        )
 
     @app.activitypub(
         "/actors/{username}/following",
-        ignore_unset=True,
-        responds_with=OrderedCollection,
+        max_age=config.cache.collections_max_age,
     )
     async def get_following(username, page: Optional[int] = 0) -> Response:
-        if username != config.actor.preferred_username:
+        actor = config.actors.get(username)
+        if actor is None:
             return Response(status_code=404)
 
-        following = []
-        for _, account in start_server.following:
-            following.append(account)
-
         return respond(
-            OrderedCollection.make(f"{config.actor.id}/following", following, page)
+            OrderedCollection.make_indexed(
+                f"{actor.id}/following",
+                db.count_followings(actor),
+                lambda offset, limit: [
+                    account for _, account in db.get_followings(actor, offset, limit)
+                ],
+                page,
+            )
         )
 
     @app.activitypub(
         "/actors/{username}/followers",
-        ignore_unset=True,
-        responds_with=OrderedCollection,
+        max_age=config.cache.collections_max_age,
     )
     async def get_followers(username: str, page: Optional[int] = 0):
-        if username != config.actor.preferred_username:
+        actor = config.actors.get(username)
+        if actor is None:
             return Response(status_code=404)
 
         return respond(
-            OrderedCollection.make(
-                f"{config.actor.id}/followers", db.get_followers(), page
+            OrderedCollection.make_indexed(
+                f"{actor.id}/followers",
+                db.count_followers(actor),
+                lambda offset, limit: db.get_followers(actor, offset, limit),
+                page,
             )
         )
 
     @app.activitypub(
-        "/actors/{username}/outbox", ignore_unset=True, responds_with=OrderedCollection
+        "/actors/{username}/outbox",
+        max_age=config.cache.collections_max_age,
     )
     async def get_outbox(username: str, page: Optional[int] = None):
-        if username != config.actor.preferred_username:
+        actor = config.actors.get(username)
+        if actor is None:
             return Response(status_code=404)
 
         return respond(
-            OrderedCollection.make(f"{config.actor.id}/outbox", db.get_messages(), page)
+            OrderedCollection.make_indexed(
+                f"{actor.id}/outbox",
+                db.count_messages(actor),
+                lambda offset, limit: db.get_messages(
+                    actor, offset=offset, limit=limit
+                ),
+                page,
+            )
+        )
+
+    @app.activitypub("/tags/{tag}", max_age=config.cache.collections_max_age)
+    async def get_tag(tag: str, page: Optional[int] = None):
+        return respond(
+            OrderedCollection.make_indexed(
+                f"https://{config.url}/tags/{tag}",
+                db.count_tagged_notes(tag),
+                lambda offset, limit: db.get_tagged_notes(tag, offset, limit),
+                page,
+            )
         )
 
     @app.activitypub("/actors/{username}/inbox", method="POST", status_code=202)
     async def post_inbox(
         username: str, request: Request, background_tasks: BackgroundTasks
     ) -> Union[None, Response]:
-        if username != config.actor.preferred_username:
+        local_actor = config.actors.get(username)
+        if local_actor is None:
             return Response(status_code=404)
 
         body = await request.body()
@@ -263,6 +515,12 @@ def start_server(
             return Response("Invalid digest", status_code=401)
 
         inbox = await request.json()
+        activity_type = inbox.get("type")
+        metrics.inbox_activities.inc(
+            activity_type
+            if isinstance(activity_type, str) and activity_type in INBOX_ACTIVITY_TYPES
+            else "other"
+        )
 
         try:
             actor = requests.get(
@@ -275,7 +533,7 @@ def start_server(
             if inbox.get("type") == "Delete" and inbox.get("actor") == inbox.get(
                 "object"
             ):
-                db.delete_follower(inbox.get("object"))
+                db.delete_account(inbox.get("object"))
 
             return
 
@@ -298,38 +556,118 @@ def start_server(
         activity_response = None
 
         if inbox.get("type") == "Follow":
-            db.insert_follower(inbox.get("actor"))
+            db.insert_follower(local_actor, inbox.get("actor"))
             activity_response = {"type": "Accept", "object": inbox}
         elif (
             inbox.get("type") == "Accept"
             and inbox.get("object", {}).get("type") == "Follow"
         ):
-            start_server.following.append(
-                (inbox.get("object").get("id"), inbox.get("actor"))
+            db.insert_following(
+                local_actor, inbox.get("object").get("id"), inbox.get("actor")
             )
             logging.debug(f"Following {inbox.get('actor')} successful.")
         elif (
             inbox.get("type") == "Undo"
             and inbox.get("object", {}).get("type") == "Follow"
         ):
-            db.delete_follower(inbox.get("actor"))
+            db.delete_follower(local_actor, inbox.get("actor"))
 
         if activity_response is not None:
             activity_response["@context"] = W3C_ACTIVITY_STREAM
             background_tasks.add_task(
-                postie.deliver, config, actor_inbox, activity_response
+                postie.deliver, local_actor, actor_inbox, activity_response
             )
 
         return
 
-    @app.activitypub("/messages/{uuid}")
-    async def get_messages(uuid: UUID):
-        return respond(db.get_message(uuid))
+    # The messages embed their note, which changes when its entry is modified in the feed.
+    @app.activitypub(
+        "/messages/{uuid}",
+        max_age=config.cache.objects_max_age,
+        cache_compressed=True,
+    )
+    async def get_messages(uuid: UUID, response: Response):
+        message = db.get_message(uuid)
+        if message is not None:
+            response.headers["Last-Modified"] = cache.http_date(
+                message.object.updated or message.published
+            )
+
+        return respond(message)
+
+    @app.get("/websub/{uuid}")
+    async def verify_websub_subscription(
+        uuid: UUID,
+        mode: str = Query(alias="hub.mode"),
+        topic: str = Query(alias="hub.topic"),
+        challenge: Optional[str] = Query(None, alias="hub.challenge"),
+        lease_seconds: Optional[int] = Query(None, alias="hub.lease_seconds"),
+    ) -> Response:
+        subscription = db.get_subscription(uuid)
+        if subscription is None or subscription[1] != topic:
+            return Response(status_code=404)
+
+        if mode == "denied":
+            logging.warning(f"The hub refused the subscription to {topic}.")
+            db.delete_subscription(uuid)
+            return Response()
+
+        if mode != "subscribe" or challenge is None:
+            return Response(status_code=404)
+
+        db.activate_subscription(
+            uuid, lease_seconds if lease_seconds is not None else websub.LEASE_SECONDS
+        )
+        logging.info(f"Subscription to {topic} verified.")
+
+        return Response(challenge, media_type="text/plain")
+
+    @app.post("/websub/{uuid}", status_code=202)
+    async def receive_websub_push(uuid: UUID, request: Request) -> Response:
+        subscription = db.get_subscription(uuid)
+        if subscription is None or subscription[0] not in config.feeds:
+            # Tell the hub that this subscription does not exist anymore.
+            return Response(status_code=410)
+
+        feed, topic, secret = subscription
+        max_size = config.feeds[feed].actor.website.max_feed_size * 1024 * 1024
+        content = bytearray()
+        async for chunk in request.stream():
+            content.extend(chunk)
+            if len(content) > max_size:
+                logging.warning(
+                    f"Ignoring a push for {topic}: the content is too large."
+                )
+                return Response(status_code=413)
+
+        # The hub must get a success response even if the signature is invalid, so it does not retry.
+        if not websub.is_signature_valid(
+            secret, bytes(content), request.headers.get("x-hub-signature")
+        ):
+            logging.warning(f"Ignoring a push for {topic}: invalid signature.")
+            return Response(status_code=202)
+
+        db.insert_push(feed, bytes(content), request.headers.get("content-type"))
+        logging.debug(f"Push received for {topic}.")
+
+        if on_push is not None:
+            on_push()
+
+        return Response(status_code=202)
+
+    return app
+
 
+def start_server(app: Union[FastAPI, str], port: int, log_level: str, workers: int = 1):
+    """Run the web server.
+    To run several workers, app must be the import string of a factory that builds the application.
+    """
     uvicorn.run(
         app,
         host="0.0.0.0",
         port=port,
         log_level=log_level.lower(),
         headers=[("server", "f2ap")],
+        workers=workers,
+        factory=isinstance(app, str),
     )
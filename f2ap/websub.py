@@ -0,0 +1,99 @@
+import hmac
+import hashlib
+import logging
+import secrets
+import requests
+
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from uuid import UUID
+from requests.utils import parse_header_links
+
+from .config import Configuration, Feed
+from .data import Database
+
+# The duration of the subscriptions asked to the hubs, in seconds.
+LEASE_SECONDS = 10 * 86400
+
+# A subscription is renewed when it expires in less than this.
+RENEW_MARGIN = timedelta(days=1)
+
+SIGNATURE_METHODS = {
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "sha384": hashlib.sha384,
+    "sha512": hashlib.sha512,
+}
+
+
+def find_hub(links: [dict], headers: {str: str}) -> (Optional[str], Optional[str]):
+    """Returns the hub and the topic advertised by a feed, in its Link headers or in its content."""
+    links = parse_header_links(headers.get("link", "")) + links
+    hub = next((link["href"] for link in links if link.get("rel") == "hub"), None)
+    topic = next((link["href"] for link in links if link.get("rel") == "self"), None)
+
+    return hub, topic
+
+
+def get_callback(config: Configuration, uuid: UUID) -> str:
+    return f"https://{config.url}/websub/{uuid}"
+
+
+def is_signature_valid(secret: str, content: bytes, signature: Optional[str]) -> bool:
+    """Check the X-Hub-Signature header, which is the HMAC of the content with the secret of the subscription."""
+    if signature is None:
+        return False
+
+    method, _, digest = signature.partition("=")
+    if method not in SIGNATURE_METHODS:
+        return False
+
+    expected = hmac.new(secret.encode(), content, SIGNATURE_METHODS[method])
+    return hmac.compare_digest(expected.hexdigest(), digest)
+
+
+def needs_subscription(
+    subscription: Optional[tuple], hub: Optional[str], topic: Optional[str]
+) -> bool:
+    if subscription is None:
+        return True
+
+    _, known_hub, known_topic, expiration = subscription
+    if (hub, topic) != (known_hub, known_topic):
+        return True
+
+    return (
+        expiration is None or expiration - datetime.now(tz=timezone.utc) < RENEW_MARGIN
+    )
+
+
+def subscribe(config: Configuration, db: Database, feed: Feed, hub: str, topic: str):
+    """Ask the hub to push the new entries of the feed.
+    The subscription becomes active when the hub verifies it, by calling the callback.
+    """
+    subscription = db.get_feed_subscription(feed.url)
+
+    if subscription is not None and subscription[1:3] == (hub, topic):
+        # Renew the existing subscription.
+        uuid = subscription[0]
+        _, _, secret = db.get_subscription(uuid)
+    else:
+        secret = secrets.token_hex(32)
+        uuid = db.insert_subscription(feed.url, hub, topic, secret)
+
+    try:
+        response = requests.post(
+            hub,
+            data={
+                "hub.mode": "subscribe",
+                "hub.topic": topic,
+                "hub.callback": get_callback(config, uuid),
+                "hub.secret": secret,
+                "hub.lease_seconds": LEASE_SECONDS,
+            },
+            timeout=feed.actor.website.fetch_timeout,
+        )
+        response.raise_for_status()
+        logging.info(f"Subscription to {topic} requested to the hub {hub}.")
+    except requests.RequestException as e:
+        logging.warning(f"Could not subscribe to {topic} on the hub {hub}: {e}")
@@ -0,0 +1,699 @@
+"""A load-testing harness that simulates a part of the Fediverse locally, to see how f2ap behaves with many followers.
+
+The mock instances are served by a single local server. Each instance has its own latency, error rate and rate of
+429 responses, and some of them can be dead: their URLs point to a closed port. The mock instances accept the
+deliveries and serve the actors of their users, who all share the same key pair.
+
+f2ap and the mock instances run in their own processes, so they don't share the interpreter with the load generator.
+Everything runs in a temporary directory, with a new database. Each scenario prints its results as JSON.
+
+Run with: python -m tools.loadtest <scenario> [options], from the root of the repository. The scenarios are:
+- follow: register followers through signed Follow activities sent to the inbox.
+- burst: send a burst of signed activities of various types to the inbox.
+- fanout: queue messages for the followers and measure how long the delivery workers take to deliver them.
+- get: measure the throughput of the actor, outbox and note URLs.
+- mock: only run the mock instances, e.g. to test a real f2ap server.
+
+Example: python -m tools.loadtest fanout --followers 50000 --instances 500 --latency 50 --dead-rate 0.02
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import asyncio
+import hashlib
+import logging
+import tempfile
+import statistics
+import subprocess
+
+import toml
+import uvicorn
+import requests
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from Crypto.PublicKey import RSA
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, JSONResponse
+from requests.adapters import HTTPAdapter
+
+from f2ap import activitypub
+from f2ap.config import get_config
+from f2ap.data import Database
+from f2ap.signature import sign_headers
+
+ACTIVITY_JSON_MIME_TYPE = "application/activity+json"
+
+BURST_TYPES = ["Follow", "Undo", "Like", "Announce", "Create", "Delete"]
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(durations: [float]) -> dict:
+    if len(durations) < 2:
+        return {"p50": None, "p95": None, "p99": None}
+
+    quantiles = statistics.quantiles(durations, n=100)
+    return {
+        "p50": quantiles[49] * 1000,
+        "p95": quantiles[94] * 1000,
+        "p99": quantiles[98] * 1000,
+    }
+
+
+class Fediverse:
+    """The addresses and the behavior of the mock instances and of their users."""
+
+    def __init__(self, args, mock_port: int, dead_port: int):
+        self.args = args
+        self.mock_port = mock_port
+        self.dead_port = dead_port
+        rng = random.Random(args.seed)
+        self.dead = {n for n in range(args.instances) if rng.random() < args.dead_rate}
+
+    def get_instance_url(self, n: int) -> str:
+        port = self.dead_port if n in self.dead else self.mock_port
+        return f"http://127.0.0.1:{port}/instances/{n}"
+
+    def get_user_url(self, i: int) -> str:
+        return f"{self.get_instance_url(i % self.args.instances)}/users/user{i}"
+
+    def get_users(self, count: int, live_only: bool = False) -> [str]:
+        return [
+            self.get_user_url(i)
+            for i in range(count)
+            if not live_only or i % self.args.instances not in self.dead
+        ]
+
+
+def create_mock_app(args, public_key: str) -> FastAPI:
+    """The mock instances. GET /stats returns what they received."""
+    app = FastAPI(docs_url=None)
+    rng = random.Random(args.seed)
+    # Each instance has its own latency, around the given one.
+    latencies = [
+        max(0.0, rng.gauss(args.latency, args.jitter)) / 1000
+        for _ in range(args.instances)
+    ]
+    stats = {
+        "statuses": {},
+        "deliveries": 0,
+        "first_delivery": None,
+        "last_delivery": None,
+    }
+
+    async def behave(n: int, kind: str) -> Response:
+        await asyncio.sleep(latencies[n % args.instances])
+
+        draw = rng.random()
+        if draw < args.error_rate:
+            status = 500
+        elif draw < args.error_rate + args.throttle_rate:
+            status = 429
+        else:
+            status = None
+
+        key = f"{kind} {status or 200}"
+        stats["statuses"][key] = stats["statuses"].get(key, 0) + 1
+        if status == 429:
+            return Response(status_code=429, headers={"Retry-After": "30"})
+        if status is not None:
+            return Response(status_code=status)
+
+        return None
+
+    @app.get("/instances/{n}/users/{username}")
+    async def get_user(n: int, username: str, request: Request) -> Response:
+        error = await behave(n, "actor")
+        if error is not None:
+            return error
+
+        base = f"{request.url.scheme}://{request.url.netloc}/instances/{n}"
+        user_id = f"{base}/users/{username}"
+        return JSONResponse(
+            {
+                "@context": "https://www.w3.org/ns/activitystreams",
+                "id": user_id,
+                "type": "Person",
+                "preferredUsername": username,
+                "inbox": f"{user_id}/inbox",
+                "endpoints": {"sharedInbox": f"{base}/inbox"},
+                "publicKey": {
+                    "id": f"{user_id}#main-key",
+                    "owner": user_id,
+                    "publicKeyPem": public_key,
+                },
+            },
+            media_type=ACTIVITY_JSON_MIME_TYPE,
+        )
+
+    @app.post("/instances/{n}/inbox")
+    @app.post("/instances/{n}/users/{username}/inbox")
+    async def post_inbox(n: int, request: Request) -> Response:
+        await request.body()
+        error = await behave(n, "inbox")
+        if error is not None:
+            return error
+
+        now = time.time()
+        stats["deliveries"] += 1
+        stats["first_delivery"] = stats["first_delivery"] or now
+        stats["last_delivery"] = now
+        return Response(status_code=202)
+
+    @app.get("/stats")
+    async def get_stats() -> Response:
+        return JSONResponse(stats)
+
+    @app.post("/stats/reset")
+    async def reset_stats() -> Response:
+        stats.update(
+            {
+                "statuses": {},
+                "deliveries": 0,
+                "first_delivery": None,
+                "last_delivery": None,
+            }
+        )
+        return Response()
+
+    return app
+
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The process serving {url} has stopped.")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f"{url} is still not available after {timeout} s.")
+
+
+class Environment:
+    """A temporary f2ap configuration with its keys and feed, and the processes of the mock instances and of f2ap."""
+
+    def __init__(self, args):
+        self.args = args
+        self.directory = tempfile.TemporaryDirectory()
+        self.processes = []
+        self.mock_port = args.mock_port or get_free_port()
+        self.port = args.port or get_free_port()
+        self.fediverse = Fediverse(args, self.mock_port, get_free_port())
+        self.mock_url = f"http://127.0.0.1:{self.mock_port}"
+        self.url = f"http://127.0.0.1:{self.port}"
+
+        key = RSA.generate(2048)
+        self.signing_key = key
+        self.private_key = key.export_key().decode()
+        self.public_key = key.public_key().export_key().decode()
+        self.config_path = self.write_config()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory.name, name)
+
+    def write_config(self) -> str:
+        for name, content in [
+            ("private.pem", self.private_key),
+            ("public.pem", self.public_key),
+        ]:
+            with open(self.path(name), "w") as file:
+                file.write(content)
+
+        self.write_feed(self.path("feed.xml"), self.args.notes)
+
+        config = {
+            # The notes are found by their URL, so it must be the URL of the local server.
+            "url": f"127.0.0.1:{self.port}",
+            "db": self.path("db.sqlite"),
+            "website": {
+                "url": f"https://127.0.0.1:{self.port}/blog/",
+                "feed": self.path("feed.xml"),
+                "update_freq": 60,
+                "websub": False,
+            },
+            "actor": {
+                "username": "blog",
+                "display_name": "Blog",
+                "summary": "A blog under load.",
+                "public_key": self.path("public.pem"),
+                "private_key": self.path("private.pem"),
+            },
+            "message": {"format": "[{title}]({url})\n{summary}\n{tags}"},
+        }
+        with open(self.path("config.toml"), "w") as file:
+            toml.dump(config, file)
+
+        return self.path("config.toml")
+
+    def write_feed(self, path: str, count: int):
+        published = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(
+                '<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel>'
+            )
+            file.write(
+                f"<title>Blog</title><link>https://127.0.0.1:{self.port}/blog/</link>"
+            )
+            for i in range(count):
+                url = f"https://127.0.0.1:{self.port}/blog/{i}"
+                file.write(
+                    f"<item><title>Article n°{i}</title><link>{url}</link><guid>{url}</guid>"
+                    f"<pubDate>{format_datetime(published - timedelta(hours=i))}</pubDate>"
+                    f"<category>python</category><description>A summary.</description></item>\n"
+                )
+            file.write("</channel></rss>")
+
+    def start(self, process: [str], url: str = None):
+        logging.info(f"Starting {' '.join(process)}")
+        self.processes.append(subprocess.Popen(process))
+        if url is not None:
+            wait_for(url, self.processes[-1])
+
+    def start_mock(self):
+        args = [
+            sys.executable,
+            "-m",
+            "tools.loadtest",
+            "mock",
+            "--mock-port",
+            str(self.mock_port),
+            "--public-key",
+            self.path("public.pem"),
+        ] + get_fediverse_args(self.args)
+        self.start(args, f"{self.mock_url}/stats")
+
+    def start_f2ap(self):
+        self.start(
+            [
+                sys.executable,
+                "-m",
+                "f2ap",
+                "--config",
+                self.config_path,
+                "--port",
+                str(self.port),
+                "--workers",
+                str(self.args.workers),
+                "--log-level",
+                "WARNING",
+                "--skip-following",
+            ],
+            f"{self.url}/robots.txt",
+        )
+
+    def start_delivery_workers(self):
+        for _ in range(self.args.delivery_workers):
+            self.start(
+                [
+                    sys.executable,
+                    "-m",
+                    "f2ap",
+                    "--config",
+                    self.config_path,
+                    "--log-level",
+                    "WARNING",
+                    "deliver",
+                ]
+            )
+
+    def get_stats(self) -> dict:
+        return requests.get(f"{self.mock_url}/stats").json()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        self.directory.cleanup()
+
+
+def get_fediverse_args(args) -> [str]:
+    """The arguments that describe the behavior of the mock instances, to pass them to their process."""
+    return [
+        f"--instances={args.instances}",
+        f"--latency={args.latency}",
+        f"--jitter={args.jitter}",
+        f"--error-rate={args.error_rate}",
+        f"--throttle-rate={args.throttle_rate}",
+        f"--dead-rate={args.dead_rate}",
+        f"--seed={args.seed}",
+    ]
+
+
+def make_session(concurrency: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    return session
+
+
+def send_activity(
+    env: Environment, session: requests.Session, user: str, activity: dict
+) -> (int, float):
+    """Send the activity to the inbox of the actor, signed like a remote instance does.
+    Returns the status code and the duration of the request.
+    """
+    path = "/actors/blog/inbox"
+    body = json.dumps(activity).encode()
+    headers = {
+        "Host": urlparse(env.url).netloc,
+        "Date": format_datetime(datetime.now(tz=timezone.utc), usegmt=True),
+        "Digest": f"SHA-256={base64.b64encode(hashlib.sha256(body).digest()).decode()}",
+        "Content-Type": ACTIVITY_JSON_MIME_TYPE,
+    }
+    # All the users of the mock instances share the same key.
+    signer = SimpleNamespace(signing_key=env.signing_key, key_id=f"{user}#main-key")
+    headers["Signature"] = sign_headers(signer, path, headers)
+
+    start = time.perf_counter()
+    try:
+        status = session.post(
+            f"{env.url}{path}", data=body, headers=headers, timeout=60
+        ).status_code
+    except requests.RequestException:
+        status = 0
+
+    return status, time.perf_counter() - start
+
+
+def send_activities(env: Environment, activities: [(str, dict)]) -> dict:
+    session = make_session(env.args.concurrency)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=env.args.concurrency) as executor:
+        results = list(
+            executor.map(lambda item: send_activity(env, session, *item), activities)
+        )
+    duration = time.perf_counter() - start
+
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    return {
+        "sent": len(results),
+        "duration": duration,
+        "per_second": len(results) / duration if duration > 0 else None,
+        "statuses": statuses,
+        "latency_ms": percentiles([d for _, d in results]),
+    }
+
+
+def make_follow(env: Environment, user: str) -> dict:
+    return {
+        "@context": "https://www.w3.org/ns/activitystreams",
+        "id": f"{user}#follows/{random.getrandbits(64):x}",
+        "type": "Follow",
+        "actor": user,
+        "object": f"https://{urlparse(env.url).netloc}/actors/blog",
+    }
+
+
+def follow(env: Environment) -> dict:
+    """Register the followers through the inbox. The users of the dead instances can't send anything."""
+    env.start_mock()
+    env.start_f2ap()
+    users = env.fediverse.get_users(env.args.followers, live_only=True)
+    result = send_activities(env, [(user, make_follow(env, user)) for user in users])
+
+    db = Database(get_config(env.config_path))
+    result["followers"] = db.count_followers(db.config.actor)
+    return result
+
+
+def burst(env: Environment) -> dict:
+    env.start_mock()
+    env.start_f2ap()
+    users = env.fediverse.get_users(env.args.followers, live_only=True)
+    rng = random.Random(env.args.seed)
+    activities = []
+
+    for i in range(env.args.count):
+        user = users[i % len(users)]
+        activity_type = rng.choice(BURST_TYPES)
+        activity = make_follow(env, user)
+        if activity_type == "Undo":
+            activity = {**activity, "id": f"{activity['id']}/undo", "object": activity}
+        activity["type"] = activity_type
+        activities.append((user, activity))
+
+    return send_activities(env, activities)
+
+
+def count_due_deliveries(db: Database) -> int:
+    """The deliveries which are in progress or still to try. The ones postponed after a failure are not counted."""
+    (result,) = db.execute(
+        "SELECT COUNT(id) FROM deliveries WHERE claim IS NOT NULL OR next_attempt_time <= :now",
+        {"now": int(time.time())},
+    ).fetchone()
+
+    return result
+
+
+def fanout(env: Environment) -> dict:
+    """Queue messages for the followers like the feed poller does, and deliver them with the delivery workers of f2ap.
+    The fan-out is complete when each inbox has received the messages or is waiting to retry.
+    """
+    env.start_mock()
+    config = get_config(env.config_path)
+    db = Database(config)
+    db.init_database()
+    actor = config.actor
+
+    with db.transaction():
+        for user in env.fediverse.get_users(env.args.followers):
+            db.insert_follower(actor, user)
+        uuids = [
+            db.insert_message(
+                db.insert_note(
+                    actor,
+                    f"Message n°{i} #loadtest",
+                    datetime.now(tz=timezone.utc),
+                    f"https://{config.url}/blog/fanout-{i}",
+                )
+            )
+            for i in range(env.args.messages)
+        ]
+    messages = [db.get_message(uuid) for uuid in uuids]
+    followers = db.get_followers(actor)
+
+    start = time.time()
+    activitypub.queue_messages(db, actor, followers, messages)
+    queued = time.time()
+    queued_deliveries = db.count_deliveries()
+
+    env.start_delivery_workers()
+    while count_due_deliveries(db) > 0:
+        time.sleep(0.1)
+    duration = time.time() - start
+    stats = env.get_stats()
+
+    return {
+        "followers": len(followers),
+        "messages": len(messages),
+        "instances": env.args.instances,
+        "dead_instances": len(env.fediverse.dead),
+        "delivery_workers": env.args.delivery_workers,
+        "queue_duration": queued - start,
+        "queued_deliveries": queued_deliveries,
+        "duration": duration,
+        "deliveries_received": stats["deliveries"],
+        "last_delivery_after": (
+            stats["last_delivery"] - start if stats["last_delivery"] else None
+        ),
+        "waiting_for_retry": db.count_deliveries(),
+        "mock_statuses": stats["statuses"],
+    }
+
+
+def get(env: Environment) -> dict:
+    env.start_f2ap()
+    session = make_session(env.args.concurrency)
+
+    # The notes of the feed are imported when f2ap starts.
+    deadline = time.monotonic() + 300
+    while (
+        session.get(f"{env.url}/actors/blog/outbox").json()["totalItems"]
+        < env.args.notes
+    ):
+        if time.monotonic() > deadline:
+            raise RuntimeError("The notes of the feed were not imported in time.")
+        time.sleep(0.5)
+
+    urls = {
+        "actor": [f"{env.url}/actors/blog"],
+        "outbox": [f"{env.url}/actors/blog/outbox?page=1"],
+        "note": [f"{env.url}/blog/{i}" for i in range(env.args.notes)],
+    }
+    results = {}
+
+    for name, targets in urls.items():
+
+        def hit(i: int) -> (int, float):
+            start = time.perf_counter()
+            status = session.get(
+                targets[i % len(targets)],
+                headers={"Accept": ACTIVITY_JSON_MIME_TYPE},
+            ).status_code
+            return status, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=env.args.concurrency) as executor:
+            hits = list(executor.map(hit, range(env.args.count)))
+        duration = time.perf_counter() - start
+
+        results[name] = {
+            "requests": len(hits),
+            "per_second": len(hits) / duration,
+            "errors": sum(1 for status, _ in hits if status != 200),
+            "latency_ms": percentiles([d for _, d in hits]),
+        }
+
+    return results
+
+
+def mock(args):
+    with open(args.public_key) as file:
+        public_key = file.read()
+
+    uvicorn.run(
+        create_mock_app(args, public_key),
+        host="127.0.0.1",
+        port=args.mock_port,
+        log_level="warning",
+    )
+
+
+SCENARIOS = {"follow": follow, "burst": burst, "fanout": fanout, "get": get}
+
+
+def get_args():
+    args = ArgumentParser(
+        prog="python -m tools.loadtest", description=__doc__.split("\n")[0]
+    )
+    args.add_argument("scenario", choices=list(SCENARIOS) + ["mock"])
+    args.add_argument("--followers", type=int, default=1000)
+    args.add_argument("--instances", type=int, default=50)
+    args.add_argument(
+        "--latency",
+        type=float,
+        default=50,
+        help="Mean latency of the instances, in ms.",
+    )
+    args.add_argument(
+        "--jitter", type=float, default=20, help="Spread of the latencies, in ms."
+    )
+    args.add_argument(
+        "--error-rate",
+        dest="error_rate",
+        type=float,
+        default=0.0,
+        help="Share of the requests answered with a 500 error.",
+    )
+    args.add_argument(
+        "--throttle-rate",
+        dest="throttle_rate",
+        type=float,
+        default=0.0,
+        help="Share of the requests answered with a 429 error.",
+    )
+    args.add_argument(
+        "--dead-rate",
+        dest="dead_rate",
+        type=float,
+        default=0.0,
+        help="Share of the instances that are unreachable.",
+    )
+    args.add_argument("--seed", type=int, default=1)
+    args.add_argument(
+        "--count",
+        type=int,
+        default=1000,
+        help="Number of activities of a burst, or of requests to each URL with get.",
+    )
+    args.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Number of requests sent at the same time.",
+    )
+    args.add_argument(
+        "--messages",
+        type=int,
+        default=1,
+        help="Number of messages delivered to each follower with fanout.",
+    )
+    args.add_argument(
+        "--notes", type=int, default=100, help="Number of notes in the feed of f2ap."
+    )
+    args.add_argument(
+        "--workers", type=int, default=1, help="Number of processes of f2ap."
+    )
+    args.add_argument(
+        "--delivery-workers",
+        dest="delivery_workers",
+        type=int,
+        default=1,
+        help="Number of delivery processes of f2ap, with fanout.",
+    )
+    args.add_argument("--port", type=int, default=None, help="Port of f2ap.")
+    args.add_argument(
+        "--mock-port",
+        dest="mock_port",
+        type=int,
+        default=None,
+        help="Port of the mock instances.",
+    )
+    args.add_argument(
+        "--public-key",
+        dest="public_key",
+        type=str,
+        default=None,
+        help="Key of the users of the mock instances, with mock.",
+    )
+
+    return args.parse_args()
+
+
+def main() -> int:
+    args = get_args()
+    logging.basicConfig(level="INFO")
+
+    if args.scenario == "mock":
+        if args.public_key is None or args.mock_port is None:
+            logging.critical("mock needs --public-key and --mock-port.")
+            return 1
+
+        mock(args)
+        return 0
+
+    env = Environment(args)
+    try:
+        result = SCENARIOS[args.scenario](env)
+    finally:
+        env.stop()
+
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
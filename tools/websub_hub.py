@@ -0,0 +1,120 @@
+"""A minimal WebSub hub, to test the push subscriptions locally.
+
+It verifies the subscriptions and pushes the topics to their subscribers, signed with their secret.
+It keeps everything in memory and does not retry, so it must not be used in production.
+
+Run with: python tools/websub_hub.py --port 8081 --callback-base http://localhost:8000
+
+Then add these links to the feed (an Atom feed here):
+    <link rel="hub" href="http://localhost:8081/"/>
+    <link rel="self" href="http://localhost:8080/feed.xml"/>
+
+And publish it when it changes:
+    curl -d hub.mode=publish -d hub.url=http://localhost:8080/feed.xml http://localhost:8081/
+"""
+
+import hmac
+import hashlib
+import logging
+import secrets
+import uvicorn
+import requests
+
+from argparse import ArgumentParser
+from urllib.parse import parse_qs, urlparse, urlunparse
+from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi.responses import Response
+
+
+def create_app(callback_base: str = None) -> FastAPI:
+    app = FastAPI(docs_url=None)
+    # {topic: {callback: secret}}
+    subscriptions = {}
+
+    def rewrite(callback: str) -> str:
+        # f2ap builds the callbacks from its public domain name, which is not reachable locally.
+        if callback_base is None:
+            return callback
+
+        base = urlparse(callback_base)
+        return urlunparse(
+            urlparse(callback)._replace(scheme=base.scheme, netloc=base.netloc)
+        )
+
+    def verify(topic: str, callback: str, secret: str, lease_seconds: str):
+        challenge = secrets.token_hex(16)
+        response = requests.get(
+            rewrite(callback),
+            params={
+                "hub.mode": "subscribe",
+                "hub.topic": topic,
+                "hub.challenge": challenge,
+                "hub.lease_seconds": lease_seconds,
+            },
+        )
+
+        if response.status_code != 200 or response.text != challenge:
+            logging.warning(f"Subscription of {callback} to {topic} not verified.")
+            return
+
+        subscriptions.setdefault(topic, {})[callback] = secret
+        logging.info(f"Subscription of {callback} to {topic} verified.")
+
+    def distribute(topic: str):
+        response = requests.get(topic)
+        response.raise_for_status()
+
+        for callback, secret in subscriptions.get(topic, {}).items():
+            digest = hmac.new(secret.encode(), response.content, hashlib.sha256)
+            result = requests.post(
+                rewrite(callback),
+                data=response.content,
+                headers={
+                    "Content-Type": response.headers.get(
+                        "content-type", "application/atom+xml"
+                    ),
+                    "X-Hub-Signature": f"sha256={digest.hexdigest()}",
+                },
+            )
+            logging.info(f"Pushed {topic} to {callback}: {result.status_code}")
+
+    @app.post("/")
+    async def hub(request: Request, background_tasks: BackgroundTasks) -> Response:
+        form = {k: v[0] for k, v in parse_qs((await request.body()).decode()).items()}
+        mode = form.get("hub.mode")
+
+        if mode == "subscribe":
+            background_tasks.add_task(
+                verify,
+                form["hub.topic"],
+                form["hub.callback"],
+                form.get("hub.secret", ""),
+                form.get("hub.lease_seconds", "864000"),
+            )
+        elif mode == "publish":
+            background_tasks.add_task(distribute, form["hub.url"])
+        else:
+            return Response(f"Unsupported mode: {mode}", status_code=400)
+
+        return Response(status_code=202)
+
+    return app
+
+
+def main():
+    args = ArgumentParser(description="A minimal WebSub hub, for local tests.")
+    args.add_argument("--port", type=int, default=8081)
+    args.add_argument(
+        "--callback-base",
+        type=str,
+        default=None,
+        help="Send the requests to the callbacks on this scheme and host instead of theirs, e.g. http://localhost:8000",
+    )
+    args = args.parse_args()
+
+    logging.basicConfig(level="INFO")
+    uvicorn.run(create_app(args.callback_base), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()